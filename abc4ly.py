@@ -4,22 +4,39 @@
 from __future__ import print_function
 import string
 import sys
+import os
+import time
 import math
+import re
+import io
+import array
+import mmap
+import struct
+import zlib
 import optparse
-import copy
-
+import types
+import concurrent.futures
+import hashlib
+import json
+import marshal
+import sqlite3
+import shutil
+import subprocess
+import tempfile
+
+__version__ = "0.2"
 
 # ------------------------------------------------------------------------
 #     Exceptions
 # ------------------------------------------------------------------------
 
 class AbcSyntaxError(Exception):
-    def __init__(self):
-        self.what = ""
-        self.filename = ""
-        self.abc_line = ""
-        self.lineno = 0 # line count starts at 1 (idem Emacs)
-        self.colno = 0  # column count starts at 0 (idem Emacs)
+    def __init__(self, what="", filename="", abc_line="", lineno=0, colno=0):
+        self.what = what
+        self.filename = filename
+        self.abc_line = abc_line
+        self.lineno = lineno # line count starts at 1 (idem Emacs)
+        self.colno = colno   # column count starts at 0 (idem Emacs)
 
     def __str__(self):
         return """In "{0}", line {1}, column {2}:
@@ -29,160 +46,553 @@ class AbcSyntaxError(Exception):
                  self.abc_line,
                  " " * self.colno, self.what)
 
+# ------------------------------------------------------------------------
+#     Tune events: the translated tune, independent of the output format
+# ------------------------------------------------------------------------
+
+# translate_notes() translates the notes into events, stored in a
+# TuneEvents: one array per column (struct of arrays), one row per event.
+# The columns of a row depend on its kind:
+# - a note: pitch (see mc_ly_pitches), octave (number of "'" in
+#   lilypond), ticks, flags (tie, triplet) and chord (0 if none, else
+#   1 + index of the chord name in chord_names)
+# - a rest: ticks, flags and chord
+# - the end of a line of the melody: flags (bar, block of an alternative,
+#   anacrusis)
+# - the repeats and alternatives: no column
+#
+# The events are read by the output backends (see LilypondEmitter): a
+# tune is translated once, whatever the number of outputs.
+
+mc_event_note = 0
+mc_event_rest = 1
+mc_event_line = 2
+mc_event_open_repeat = 3
+mc_event_close_repeat = 4
+mc_event_begin_alternative_1 = 5
+mc_event_begin_alternative_2 = 6
+mc_event_end_alternative = 7
+
+# Flags of the notes and rests
+mc_flag_tied = 1
+mc_flag_triplet_begin = 2
+mc_flag_triplet_end = 4
+
+# Flags of the ends of lines
+mc_flag_block = 1 # a whole block: "{ ... }"
+mc_flag_block_begin = 2
+mc_flag_block_end = 4
+mc_flag_in_block = 8
+mc_flag_bar = 16
+mc_flag_double_bar = 32
+mc_flag_final_bar = 64
+mc_flag_anacrusis = 128 # the first line (see anacrusis_ticks)
+
+# The pitches in lilypond format: 7 notes x 5 alterations, from "ceses"
+# to "bisis". The pitch of a note is its index in mc_ly_pitches: the note
+# is pitch // 5 (0 = c) and the alteration pitch % 5 - 2 (in semi-tones).
+
+mc_ly_pitches = [note + alteration for note in "cdefgab"
+                 for alteration in ["eses", "es", "", "is", "isis"]]
+mc_ly_pitch_ids = dict((ly_pitch, pitch) for (pitch, ly_pitch) in enumerate(mc_ly_pitches))
+
+class TuneEvents():
+    __slots__ = ("kinds", "pitches", "octaves", "ticks", "flags", "chords",
+                 "chord_names", "chord_ids", "anacrusis_ticks", "anacrusis_unit")
+
+    def __init__(self):
+        self.kinds = array.array('B')
+        self.pitches = array.array('B')
+        self.octaves = array.array('B')
+        self.ticks = array.array('H')
+        self.flags = array.array('B')
+        self.chords = array.array('H')
+        self.chord_names = []
+        self.chord_ids = {}
+
+        # The duration of the anacrusis, and its shortest simple duration
+        # (see TuneContext.add_bar_ticks())
+        self.anacrusis_ticks = 0
+        self.anacrusis_unit = 0
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def append(self, kind, pitch=0, octave=0, ticks=0, flags=0, chord=0):
+        self.kinds.append(kind)
+        self.pitches.append(pitch)
+        self.octaves.append(octave)
+        self.ticks.append(ticks)
+        self.flags.append(flags)
+        self.chords.append(chord)
+
+    def get_chord(self, chord_name):
+        chord = self.chord_ids.get(chord_name)
+        if chord == None:
+            self.chord_names.append(chord_name)
+            chord = len(self.chord_names)
+            self.chord_ids[chord_name] = chord
+        return chord
+
+    # Append the events of other (e.g. the events of the next line)
+    def extend(self, other):
+        for k in range(len(other)):
+            if other.flags[k] & mc_flag_anacrusis and other.kinds[k] == mc_event_line:
+                self.anacrusis_ticks = other.anacrusis_ticks
+                self.anacrusis_unit = other.anacrusis_unit
+            chord = other.chords[k]
+            if chord != 0:
+                chord = self.get_chord(other.chord_names[chord - 1])
+            self.append(other.kinds[k], other.pitches[k], other.octaves[k],
+                        other.ticks[k], other.flags[k], chord)
+
+    # The memory used by the events, in bytes (without the chord names)
+    def get_size(self):
+        return sum(column.itemsize * len(column)
+                   for column in [self.kinds, self.pitches, self.octaves,
+                                  self.ticks, self.flags, self.chords])
+
+# ------------------------------------------------------------------------
+#     The lilypond emitter and its output sinks
+# ------------------------------------------------------------------------
+
+# The lilypond emitter translates the events of a tune into the lilypond
+# lines of the melody, and writes them into its sink. emit() can be
+# called while the events are appended (the tune context calls it after
+# each line of ABC notes), so that the output is written as the tune is
+# read.
+
+class LilypondEmitter():
+    def __init__(self, sink):
+        self.sink = sink
+        self.next_event = 0
+        self.indent_level = 0
+        self.ly_notes = [] # the notes of the current line
+
+    # The lilypond fragment of a note is looked up in mc_ly_fragments: a
+    # tune uses a few dozen distinct notes, many times. The key of a note
+    # packs its kind, pitch, octave, flags and duration into an integer
+    # (with its chord name, if any).
+    def emit(self, tc):
+        events = tc.events
+        (kinds, pitches, octaves, ticks, flags, chords) = (events.kinds, events.pitches,
+                                                           events.octaves, events.ticks,
+                                                           events.flags, events.chords)
+        table = mc_ly_fragments
+        fragments = table.fragments
+        misses = table.misses
+        ly_notes = self.ly_notes
+        nnotes = 0
+        for k in range(self.next_event, len(events)):
+            kind = kinds[k]
+            if kind <= mc_event_rest: # a note or a rest
+                key = kind | pitches[k] << 1 | octaves[k] << 7 | \
+                      (flags[k] & mc_note_flags) << 11 | ticks[k] << 14
+                if chords[k] != 0:
+                    key = (key, events.chord_names[chords[k] - 1])
+                ly_note = fragments.get(key)
+                if ly_note == None:
+                    ly_note = table.add(key, get_ly_note(events, k))
+                ly_notes.append(ly_note)
+                nnotes += 1
+            elif kind == mc_event_line:
+                self.emit_line(tc, events.flags[k])
+            elif kind == mc_event_open_repeat:
+                self.sink.write_line(tc, "\\repeat volta 2 {")
+                self.indent_level += 1
+            elif kind == mc_event_close_repeat:
+                self.sink.write_line(tc, "}")
+                self.indent_level -= 1
+            elif kind == mc_event_begin_alternative_1:
+                self.sink.write_line(tc, "\\alternative {")
+                self.indent_level += 1
+            elif kind == mc_event_end_alternative:
+                self.sink.write_line(tc, "}")
+                self.indent_level -= 1
+        self.next_event = len(events)
+        table.hits += nnotes - (table.misses - misses)
+
+    def emit_line(self, tc, flags):
+        line = "    " * self.indent_level
+
+        if flags & mc_flag_anacrusis:
+            line += get_partial(tc.meter, tc.events.anacrusis_ticks,
+                                tc.events.anacrusis_unit)
+
+        if flags & (mc_flag_block | mc_flag_block_begin):
+            line += "{ "
+        if flags & (mc_flag_block_end | mc_flag_in_block):
+            line += "  "
+        line += " ".join(self.ly_notes)
+        if flags & (mc_flag_block | mc_flag_block_end):
+            line += " }"
+        if flags & mc_flag_double_bar:
+            line += r' \bar "||"'
+        elif flags & mc_flag_final_bar:
+            line += r' \bar "|."'
+        elif flags & mc_flag_bar:
+            line += " |"
+
+        self.sink.write_line(tc, line)
+        self.ly_notes.clear()
+
+    def close(self, tc):
+        self.emit(tc)
+        self.sink.close(tc)
+
+# The lilypond fragment of a note or rest: e.g. "cis''8. ~"
+
+def get_ly_note(events, k):
+    if events.kinds[k] == mc_event_rest:
+        ly_note = "r"
+    else:
+        ly_note = mc_ly_pitches[events.pitches[k]] + "'" * events.octaves[k]
+    ly_note += mc_ly_durations[events.ticks[k]]
+    flags = events.flags[k]
+    if flags & mc_flag_tied:
+        ly_note += " ~"
+    if events.chords[k] != 0:
+        ly_note += ' ^"{0}"'.format(events.chord_names[events.chords[k] - 1])
+    if flags & mc_flag_triplet_begin:
+        ly_note = "\\times 2/3 { " + ly_note
+    if flags & mc_flag_triplet_end:
+        ly_note += " }"
+    return ly_note
+
+# A bounded memo table of the lilypond fragments of the notes, shared by
+# all the tunes of the process. The fragments are interned: the lines of
+# the tunes share them. When the table is full, it is cleared (the
+# fragments of the current tunes come back quickly).
+
+class FragmentTable():
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.fragments = {}
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, key, fragment):
+        if len(self.fragments) >= self.max_size:
+            self.fragments.clear() # the same dictionary (see emit())
+        fragment = sys.intern(fragment)
+        self.fragments[key] = fragment
+        self.misses += 1
+        return fragment
+
+    def clear(self):
+        self.fragments.clear()
+        self.hits = 0
+        self.misses = 0
+
+mc_ly_fragments = FragmentTable()
+
+# The flags of a note that change its fragment
+mc_note_flags = mc_flag_tied | mc_flag_triplet_begin | mc_flag_triplet_end
+
+# The partial measure of an anacrusis: a duration of ticks (whose
+# shortest simple duration is unit) in a given meter
+
+def get_partial(meter, ticks, unit):
+    if ticks == 0:
+        return ""
+
+    if ticks % 3 != 0:
+        # After an irregular triplet (e.g. "(3 D2 E F"): a third of a
+        # simple duration
+        unit = get_simple_ticks(ticks * 3)
+        return "\\partial {0}*{1}/3 ".format(mc_ticks_per_whole // unit,
+                                             ticks * 3 // unit)
+
+    (meter_num, meter_den) = map(int, meter.split("/"))
+
+    # Express the duration of the bar with the meter unit if possible
+    # (example: in 4/4, "\partial 8*2" => "\partial 4"), else with the
+    # shortest simple duration of the bar (example: "\partial 8*3")
+    meter_unit = mc_ticks_per_whole // meter_den
+    if meter_den & (meter_den - 1) == 0 and ticks % meter_unit == 0:
+        base = meter_den
+        mult = ticks // meter_unit
+    else:
+        base = mc_ticks_per_whole // unit
+        mult = ticks // unit
+
+    if meter_num == mult and meter_den == base:
+        partial_string = ""
+    elif mult == 1:
+        partial_string = "\\partial {0} ".format(base)
+    else:
+        partial_string = "\\partial {0}*{1} ".format(base, mult)
+    return partial_string
+
+# A sink has two methods:
+# - write_line(tc, line): write a line of the melody (without indentation
+#   nor end of line)
+# - close(tc): the tune is over
+
+# Keep the lines in a list (tc.output): used by the unit tests
+
+class ListSink():
+    def __init__(self):
+        self.lines = []
+
+    def write_line(self, tc, line):
+        self.lines.append(line)
+
+    def close(self, tc):
+        pass
+
+# Drop the lines: the tune is only translated into events (e.g. to write
+# a MIDI file, or to check its syntax). With a NullSink, the tune context
+# has a NullEmitter: the events are not even formatted.
+
+class NullSink():
+    def write_line(self, tc, line):
+        pass
+
+    def close(self, tc):
+        pass
+
+class NullEmitter():
+    def __init__(self, sink):
+        self.sink = sink
+
+    def emit(self, tc):
+        pass
+
+    def close(self, tc):
+        self.sink.close(tc)
+
+# Write a complete lilypond file into one or more files (e.g. the output
+# file and a buffer for the conversion cache). The beginning of the file
+# (header, key and time signatures) is written with the first line of the
+# melody: the information fields of the tune are read by then.
+
+class LilypondSink():
+    def __init__(self, *ly_files):
+        self.ly_files = ly_files
+        self.started = False
+
+    def write(self, text):
+        for ly_file in self.ly_files:
+            ly_file.write(text)
+
+    def start(self, tc):
+        write_ly_preamble(tc, self)
+        self.started = True
+
+    def write_line(self, tc, line):
+        if not self.started:
+            self.start(tc)
+        self.write("    " + line + "\n")
+
+    def close(self, tc):
+        if not self.started:
+            self.start(tc)
+        write_ly_postamble(self)
+
+# A sink writing the lilypond text of a tune as a \bookpart of a
+# lilypond book (see write_book()): its header, then its score, the
+# melody written in the score itself (the book has no variable per tune).
+# The score has no \midi block: a book is for printing, the MIDI files
+# are written by abc4ly itself (see write_midi()).
+
+class BookPartSink():
+    def __init__(self, ly_file):
+        self.ly_file = ly_file
+        self.started = False
+
+    def start(self, tc):
+        check_time_signature(tc)
+        self.ly_file.write("    " r'''\bookpart {''' "\n")
+        write_header(tc, self.ly_file, "        ")
+        self.ly_file.write(r'''        \score {
+            \new Staff {
+                \clef treble
+''')
+        self.ly_file.write("                " + tc.key_signature + "\n")
+        write_time_signature(self.ly_file, tc.meter, "                ")
+        self.ly_file.write("\n")
+        self.started = True
+
+    def write_line(self, tc, line):
+        if not self.started:
+            self.start(tc)
+        self.ly_file.write("                " + line + "\n")
+
+    def close(self, tc):
+        if not self.started:
+            self.start(tc)
+        self.ly_file.write(r'''            }
+            \layout { }
+        }
+    }
+''')
+
 # ------------------------------------------------------------------------
 #     Tune context
 # ------------------------------------------------------------------------
 
 class TuneContext():
-    def __init__(self):
+    __slots__ = ("filename", "lineno",
+                 "refnum", "title", "composer", "rythm", "meter", "key_signature",
+                 "pitch_dico", "default_note_duration",
+                 "state", "alternative", "alternative_bar_count",
+                 "alternative_count_down", "first_note", "note",
+                 "prev_note", "in_triplet", "triplet_count", "triplet_ticks",
+                 "in_broken_rythm", "first_bar", "bar_ticks", "bar_unit",
+                 "events", "emitter", "errors")
+
+    def __init__(self, sink=None):
         self.filename = ""
         self.lineno = 1
 
+        self.refnum = ""
         self.title = ""
         self.composer = ""
         self.rythm = ""
         self.meter = ""
         self.key_signature = ""
-        self.pitch_dico = create_pitch_dico("\key c \major")
+        self.pitch_dico = mc_pitch_dicos[r"\key c \major"]
 
-        self.default_note_duration = 0
+        self.default_note_duration = 8 # L:1/8 without M: field
 
         self.state = "start"
-        self.indent_level = 0
         self.alternative = 0
-        self.first_note = True # 1st not in the bar
+        self.alternative_bar_count = 0
+        self.alternative_count_down = 0
+        self.first_note = True # 1st not in the line
         self.note = Note()
-        self.prev_note = None
+        self.prev_note = Note() # no previous note while its pitch is ""
         self.in_triplet = False
         self.triplet_count = 0
-        self.triplet_duration = Duration()
+        self.triplet_ticks = 0
         self.in_broken_rythm = False
 
         self.first_bar = True
-        self.bar_duration = Duration()
+        self.bar_ticks = 0
+        self.bar_unit = 0 # the shortest simple duration added to bar_ticks
+
+        self.events = TuneEvents()
+        if sink == None:
+            sink = ListSink()
+        if isinstance(sink, NullSink):
+            self.emitter = NullEmitter(sink)
+        else:
+            self.emitter = LilypondEmitter(sink)
 
-        self.ly_line = ""
-        self.output = []
+        # The syntax errors are raised, unless they are collected in a
+        # list (recovery mode)
+        self.errors = None
+
+    # The lines written so far (only with a ListSink)
+    @property
+    def output(self):
+        return self.emitter.sink.lines
 
     def dump_note(self):
-        if self.note.pitch == "":
+        note = self.note
+        if note.pitch == "":
             return
 
         # Increase the duration of the current bar with the duration of
         # the note. If the note is inside a triplet, update the duration
         # only when the last note of the triplet is encountered.
 
+        flags = 0
+        if note.tied:
+            flags |= mc_flag_tied
         if self.in_triplet:
-            self.triplet_duration.add(self.note.duration, self.note.dotted)
+            self.triplet_ticks += note.ticks
+            if self.triplet_count == 1:
+                flags |= mc_flag_triplet_begin
             if self.triplet_count == 3:
-                # 8+8+8 (= also 4+8) = 8*3
                 # triplet = \times 2/3
-                # 8*3 / 3 = 8
-                # 8 / 2 = 4
-                assert(self.triplet_duration.mult == 3)
-                assert(self.triplet_duration.base % 2 == 0)
-                triplet_duration = self.triplet_duration.base / 2
-                self.bar_duration.add(triplet_duration)
+                self.add_bar_ticks(self.triplet_ticks * 2 // 3)
+                flags |= mc_flag_triplet_end
+                self.in_triplet = False
+                self.triplet_count = 0
+                self.triplet_ticks = 0
         else:
-            self.bar_duration.add(self.note.duration, self.note.dotted)
-
-        # Update self.ly_line with the lilypond representation of the
-        # current Note. Manage inter-note spacing and triplets.
+            self.add_bar_ticks(note.ticks)
 
-        if not self.first_note:
-            self.ly_line += " "
+        chord = 0
+        if note.chord != "":
+            chord = self.events.get_chord(note.chord)
+        if note.pitch == "r":
+            self.events.append(mc_event_rest, 0, 0, note.ticks, flags, chord)
         else:
-            self.first_note = False
+            self.events.append(mc_event_note, mc_ly_pitch_ids[note.pitch],
+                               len(note.octaver), note.ticks, flags, chord)
+        self.first_note = False
 
-        if self.in_triplet and self.triplet_count == 1:
-            self.ly_line += "\times 2/3 { "
-
-        self.ly_line += self.note.lilyfy()
-
-        if self.in_triplet and self.triplet_count == 3:
-            self.ly_line += " }"
-            self.in_triplet = False
-            self.triplet_count = 0
-            self.triplet_duration.clear()
+        # The current note becomes the previous note, and the buffer of
+        # the previous note is reused for the next note
+        (self.prev_note, self.note) = (self.note, self.prev_note)
+        self.note.clear()
 
-        self.prev_note = copy.copy(self.note)
+    # After a syntax error (recovery mode): forget the note being read. A
+    # triplet goes on with the next notes.
+    def reset_note(self):
         self.note.clear()
+        self.prev_note.tied = False
+        self.in_broken_rythm = False
+        self.state = "start"
 
-    def get_partial(self):
-        if self.bar_duration.base == 0:
-            return ""
-
-        (meter_num, meter_den) = map(int, self.meter.split("/"))
-
-        # Normalize self.bar_duration.x with respect to meter_den
-        # Example: in 4/4, "\partial 8*2" => "\partial 4"
-        if self.bar_duration.base > meter_den:
-            if self.bar_duration.base % meter_den == 0:
-                q = self.bar_duration.base / meter_den
-                if self.bar_duration.mult % q == 0:
-                    self.bar_duration.base = meter_den
-                    self.bar_duration.mult /= q
-        elif self.bar_duration.base < meter_den:
-            if meter_den % self.bar_duration.base == 0:
-                q = meter_den / self.bar_duration.base
-                self.bar_duration.base = meter_den
-                self.bar_duration.mult *= q
-
-        if meter_num == self.bar_duration.mult and meter_den == self.bar_duration.base:
-            partial_string = ""
-        elif self.bar_duration.mult == 1:
-            partial_string = "\partial {0} ".format(int(self.bar_duration.base))
-        else:
-            partial_string = "\partial {0}*{1} ".format(int(self.bar_duration.base),
-                                                        int(self.bar_duration.mult))
-        return partial_string
+    def add_bar_ticks(self, ticks):
+        self.bar_ticks += ticks
+        unit = get_simple_ticks(ticks)
+        if self.bar_unit == 0 or unit < self.bar_unit:
+            self.bar_unit = unit
 
     def flush_line(self, abc_bar="", block=False, block_begin=False, block_end=False, in_block=False):
-        line_to_flush = "    " * self.indent_level
+        flags = 0
 
         if self.first_bar:
-            line_to_flush += self.get_partial()
+            self.events.anacrusis_ticks = self.bar_ticks
+            self.events.anacrusis_unit = self.bar_unit
+            flags |= mc_flag_anacrusis
             self.first_bar = False
 
-        if block or block_begin:
-            line_to_flush += "{ "
-        if block_end or in_block:
-            line_to_flush += "  "
-        line_to_flush += self.ly_line
-        if block or block_end:
-            line_to_flush += " }"
-        if abc_bar != "":
-            if abc_bar == "||":
-                bar_glyph = r'\bar "||"'
-            elif abc_bar == "|]":
-                bar_glyph = r'\bar "|."'
-            else:
-                bar_glyph = "|"
-            line_to_flush += " " + bar_glyph
-
-        self.output.append(line_to_flush)
+        if block:
+            flags |= mc_flag_block
+        if block_begin:
+            flags |= mc_flag_block_begin
+        if block_end:
+            flags |= mc_flag_block_end
+        if in_block:
+            flags |= mc_flag_in_block
+        if abc_bar == "||":
+            flags |= mc_flag_double_bar
+        elif abc_bar == "|]":
+            flags |= mc_flag_final_bar
+        elif abc_bar != "":
+            flags |= mc_flag_bar
+
+        self.events.append(mc_event_line, flags=flags)
+        self.first_note = True
+
+        # The duration of the bars is only needed for the anacrusis: it is
+        # not accumulated over the tune (the parser state at a line
+        # boundary does not depend on the previous bars)
+        self.bar_ticks = 0
+        self.bar_unit = 0
 
     def open_repeat(self):
-        self.output.append("\repeat volta 2 {")
-        self.indent_level += 1
+        self.events.append(mc_event_open_repeat)
 
     def close_repeat(self):
-        #self.flush_line()
-        self.output.append("}")
-        self.indent_level -= 1
+        self.events.append(mc_event_close_repeat)
 
     def begin_alternative_1(self):
-        self.output.append(r"\alternative {")
+        self.events.append(mc_event_begin_alternative_1)
         self.alternative = 1
-        self.indent_level += 1
-        # Remark: No way not to use raw strings with this crazy "\a"
 
     def begin_alternative_2(self):
+        self.events.append(mc_event_begin_alternative_2)
         self.alternative = 2
 
     def end_alternative(self):
-        self.output.append("}")
-        self.indent_level -= 1
+        self.events.append(mc_event_end_alternative)
         self.alternative = 0
 
 
@@ -191,15 +601,17 @@ class TuneContext():
 # ------------------------------------------------------------------------
 
 class Note():
+    __slots__ = ("accidental", "abc_pitch", "pitch", "octaver", "ticks", "tied", "chord")
+
     def __init__(self):
         self.clear()
 
     def clear(self):
         self.accidental = ""
+        self.abc_pitch = "" # as in the abc file, for the errors of the octave marks
         self.pitch = ""
         self.octaver = ""
-        self.duration = ""
-        self.dotted = False
+        self.ticks = 0
         self.tied = ""
         self.chord = ""
 
@@ -214,50 +626,40 @@ class Note():
         # self.pitch. So self.accidental is not used in the comparison
         # of note pitches.
 
-    def lilyfy(self):
-        ly_note = self.pitch + self.octaver
-        ly_note += str(int(self.duration))
-        if self.dotted:
-            ly_note += "."
-        if self.tied:
-            ly_note += " ~"
-        if self.chord != "":
-            ly_note += ' ^"{0}"'.format(self.chord)
-        return ly_note
-
 
 # ------------------------------------------------------------------------
-#     The duet representation of a LilyPond duration: (base, multiplier)
+#     Durations: integer numbers of ticks
 # ------------------------------------------------------------------------
 
-class Duration():
-    def __init__(self):
-        self.clear()
+# All the durations (notes, bars, triplets) are integer numbers of ticks.
+# A whole note is 3 * 512 ticks: a 512th note and the notes of a triplet
+# of 256th notes last an integer number of ticks.
 
-    def clear(self):
-        self.base = 0
-        self.mult = 1
-
-    # Add a simple_duration in lilypond format (4=quarter note, 8=eighth
-    # note, ...) to the object.
-    def add(self, simple_duration, dotted=False):
-        if self.base == 0:
-            self.base = simple_duration
-        elif self.base == simple_duration:
-            self.mult += 1
-        elif self.base > simple_duration:
-            assert(self.base % simple_duration == 0)
-            q = self.base / simple_duration
-            self.mult += q
-        elif self.base < simple_duration:
-            assert(simple_duration % self.base == 0)
-            q = simple_duration / self.base
-            self.base = simple_duration
-            self.mult *= q
-            self.mult += 1
-
-        if dotted:
-            self.add(simple_duration * 2)
+mc_ticks_per_whole = 3 * 512
+
+# The lilypond durations, by number of ticks: simple durations (1, 2, 4,
+# ... 512) and dotted durations (1., 2., ... 256.)
+
+def create_ly_durations():
+    ly_durations = {}
+    for exponent in range(10):
+        simple_duration = 2 ** exponent
+        ticks = mc_ticks_per_whole // simple_duration
+        ly_durations[ticks] = str(simple_duration)
+        if ticks % 2 == 0:
+            ly_durations[ticks * 3 // 2] = str(simple_duration) + "."
+    return ly_durations
+
+mc_ly_durations = create_ly_durations()
+
+# The longest simple duration (in ticks) that divides a duration (in ticks)
+# (example: a dotted quarter note is made of 3 eighth notes)
+
+def get_simple_ticks(ticks):
+    simple_ticks = mc_ticks_per_whole
+    while ticks % simple_ticks != 0 and simple_ticks % 2 == 0:
+        simple_ticks //= 2
+    return simple_ticks
 
 
 # ------------------------------------------------------------------------
@@ -292,7 +694,9 @@ def read_info_line(tc, line):
     # Remove leading/trailing spaces, and substititue any occurence
     # of more than one space by just one space
     nice_field = " ".join(raw_field.split())
-    if line[0] == 'T':
+    if line[0] == 'X':
+        tc.refnum = nice_field
+    elif line[0] == 'T':
         if tc.title == "":
             tc.title = nice_field
     elif line[0] == 'C':
@@ -300,37 +704,616 @@ def read_info_line(tc, line):
     elif line[0] == 'R':
         tc.rythm = nice_field
     elif line[0] == 'M':
-        tc.meter = normalize_time_signature(nice_field)
-        tc.default_note_duration = get_default_note_duration(tc.meter)
+        # The field is parsed before the context is changed: an invalid
+        # field (e.g. "4/0") is ignored as a whole in recovery mode
+        try:
+            meter = normalize_time_signature(nice_field)
+            default_note_duration = get_default_note_duration(meter)
+        except (AbcSyntaxError, ZeroDivisionError):
+            raise AbcSyntaxError("Invalid time signature", tc.filename, line.rstrip(),
+                                 tc.lineno, 2)
+        tc.meter = meter
+        tc.default_note_duration = default_note_duration
     elif line[0] == 'L':
-        tab = nice_field.split("/")
-        tc.default_note_duration = int(tab[1])
+        # e.g. "1/", "1/x" or "1"
+        try:
+            (numerator, denominator) = nice_field.split("/")
+            default_note_duration = int(denominator)
+        except ValueError:
+            default_note_duration = 0
+        if default_note_duration < 1 or \
+           not mc_ticks_per_whole // default_note_duration in mc_ly_durations:
+            raise AbcSyntaxError("Invalid default note length", tc.filename, line.rstrip(),
+                                 tc.lineno, 2)
+        tc.default_note_duration = default_note_duration
     elif line[0] == 'K':
         tc.key_signature = translate_key_signature(tc, line)
-        tc.pitch_dico = create_pitch_dico(tc.key_signature)
+        tc.pitch_dico = mc_pitch_dicos[tc.key_signature]
 
 def read_line(tc, line):
-    if line[0] in string.ascii_uppercase and line[1] == ":":
-        read_info_line(tc, line)
-    elif line.isspace() or line.lstrip()[0] == "%":
+    if line[0:1] in string.ascii_uppercase and line[1:2] == ":":
+        try:
+            read_info_line(tc, line)
+        except AbcSyntaxError as e:
+            # The field is ignored in recovery mode
+            if tc.errors == None:
+                raise
+            tc.errors.append(e)
+        except (ValueError, LookupError, ArithmeticError) as e:
+            # Any other failure to parse a field is a syntax error too: it
+            # must not abort the other tunes of the file
+            error = AbcSyntaxError("Invalid field ({0})".format(e), tc.filename,
+                                   line.rstrip(), tc.lineno, 2)
+            if tc.errors == None:
+                raise error
+            tc.errors.append(error)
+    elif line.isspace() or line.lstrip()[0:1] == "%":
         # Silently ignore comments (lines starting with '%') and empty lines
         pass
     else:
         translate_notes(tc, line, last_line=False)
     tc.lineno += 1
 
+# ------------------------------------------------------------------------
+#     Tunebooks: several tunes in one ABC file
+# ------------------------------------------------------------------------
+
+# Split the lines of an ABC file (or of any iterable over lines) into
+# tunes. A tune starts with its "X:" line (reference number) and lasts
+# until the next "X:" line. Yield (refnum, lineno, lines) for each tune,
+# lineno being the number of the first line of the tune in the file.
+#
+# Only one tune is held in memory at a time. The lines found before the
+# first "X:" line are the file header, and are ignored; but a file
+# without any "X:" line is a single tune.
+
+def split_tunes(abc_lines):
+    refnum = None # None: in the file header
+    lineno = 1
+    lines = []
+
+    for (n, line) in enumerate(abc_lines, 1):
+        if line.startswith("X:"):
+            if refnum != None:
+                yield (refnum, lineno, lines)
+            refnum = " ".join(line[2:].split())
+            lineno = n
+            lines = []
+        lines.append(line)
+
+    if refnum != None:
+        yield (refnum, lineno, lines)
+    elif lines:
+        yield ("", lineno, lines)
+
+# Parse the lines of one tune into a fresh tune context. With an errors
+# list, the syntax errors are appended to errors instead of being raised
+# (recovery mode).
+
+def read_tune(lines, filename="", lineno=1, sink=None, errors=None):
+    tc = TuneContext(sink)
+    tc.filename = filename
+    tc.lineno = lineno
+    tc.errors = errors
+
+    for line in lines:
+        read_line(tc, line)
+    translate_notes(tc, "", last_line = True) # flush the last line
+    tc.emitter.close(tc)
+
+    return tc
+
+# A lazy iterator over the tunes of an ABC file: yield a tune context for
+# each tune, or only for the tunes whose reference number is in refnums.
+# The tunes that are not selected are not parsed.
+
+def read_tunes(abc_file, filename="", refnums=None):
+    for (refnum, lineno, lines) in split_tunes(abc_file):
+        if refnums and not refnum in refnums:
+            continue
+        yield read_tune(lines, filename, lineno)
+
+# ------------------------------------------------------------------------
+#     Tunebook index: random access to the tunes of a big ABC file
+# ------------------------------------------------------------------------
+
+# The index of an ABC file is a sidecar file ("tunebook.abc.idx") that
+# maps the reference number of each tune to its position in the ABC
+# file. It is made of:
+# - a header: magic, size and modification time of the ABC file, number
+#   of records
+# - the records, sorted by reference number (then by offset): refnum,
+#   offset and length of the tune (in bytes), number of the first line
+#   of the tune, CRC32 of the tune, offset and length of the title in
+#   the string table
+# - the string table (UTF-8 titles)
+#
+# The index is read through mmap: finding a tune is a binary search over
+# the records, and does not depend on the size of the ABC file. The index
+# is rebuilt when the size or the modification time of the ABC file
+# change, or when the CRC32 of the tune found does not match.
+#
+# Only the tunes with an integer reference number are indexed.
+
+mc_index_magic = b"ABC4LYX1"
+mc_index_header = struct.Struct("<8sQqII")
+mc_index_record = struct.Struct("<qQQIIII")
+
+def get_index_filename(abc_filename):
+    return abc_filename + ".idx"
+
+# Scan an ABC file in binary mode. Yield (refnum, offset, length, lineno,
+# crc, title) for each tune with an integer reference number.
+
+def scan_tune_offsets(abc_filename):
+    def make_entry():
+        (refnum, offset, lineno, crc, title) = tune
+        return (refnum, offset, position - offset, lineno, crc, title)
+
+    tune = None
+    position = 0
+    with open(abc_filename, 'rb') as abc_file:
+        for (n, line) in enumerate(abc_file, 1):
+            if line.startswith(b"X:"):
+                if tune != None:
+                    yield make_entry()
+                try:
+                    tune = [int(line[2:]), position, n, 0, None]
+                except ValueError:
+                    tune = None
+            if tune != None:
+                tune[3] = zlib.crc32(line, tune[3])
+                if tune[4] == None and line.startswith(b"T:"):
+                    tune[4] = b" ".join(line[2:].split())
+            position += len(line)
+    if tune != None:
+        yield make_entry()
+
+def build_index(abc_filename, index_filename=None):
+    if index_filename == None:
+        index_filename = get_index_filename(abc_filename)
+
+    stat = os.stat(abc_filename)
+    records = []
+    titles = []
+    titles_length = 0
+    for (refnum, offset, length, lineno, crc, title) in scan_tune_offsets(abc_filename):
+        title = title or b""
+        records.append((refnum, offset, length, lineno, crc, titles_length, len(title)))
+        titles.append(title)
+        titles_length += len(title)
+    records.sort()
+
+    # Write the index atomically: a reader never sees a partial index
+    tmp_filename = "{0}.{1}.tmp".format(index_filename, os.getpid())
+    with open(tmp_filename, 'wb') as index_file:
+        index_file.write(mc_index_header.pack(mc_index_magic, stat.st_size,
+                                              stat.st_mtime_ns, len(records), 0))
+        for record in records:
+            index_file.write(mc_index_record.pack(*record))
+        index_file.write(b"".join(titles))
+    os.replace(tmp_filename, index_filename)
+
+class TuneIndex():
+    def __init__(self, index_filename):
+        with open(index_filename, 'rb') as index_file:
+            self.mm = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.abc_size, self.abc_mtime_ns, self.count, foo) = \
+            mc_index_header.unpack_from(self.mm, 0)
+        if magic != mc_index_magic:
+            self.count = 0
+        self.titles_offset = mc_index_header.size + self.count * mc_index_record.size
+
+    def close(self):
+        self.mm.close()
+
+    def is_valid_for(self, abc_filename):
+        stat = os.stat(abc_filename)
+        return (self.abc_size == stat.st_size
+                and self.abc_mtime_ns == stat.st_mtime_ns)
+
+    def get_record(self, k):
+        return mc_index_record.unpack_from(self.mm, mc_index_header.size
+                                           + k * mc_index_record.size)
+
+    def get_title(self, record):
+        start = self.titles_offset + record[5]
+        return self.mm[start:start + record[6]].decode("utf-8", "replace")
+
+    # Return the record of the first tune whose reference number is
+    # refnum (None if there is no such tune)
+    def find(self, refnum):
+        (lo, hi) = (0, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_record(mid)[0] < refnum:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            record = self.get_record(lo)
+            if record[0] == refnum:
+                return record
+        return None
+
+    # Yield (refnum, title, offset, length, lineno) for each indexed tune
+    def entries(self):
+        for k in range(self.count):
+            record = self.get_record(k)
+            yield (record[0], self.get_title(record)) + record[1:4]
+
+# Open the index of an ABC file, (re)building it when it is missing or out
+# of date.
+
+def open_index(abc_filename, rebuild=False):
+    index_filename = get_index_filename(abc_filename)
+    if not rebuild:
+        try:
+            index = TuneIndex(index_filename)
+            if index.is_valid_for(abc_filename):
+                return index
+            index.close()
+        except (IOError, OSError, struct.error, ValueError):
+            pass
+    build_index(abc_filename, index_filename)
+    return TuneIndex(index_filename)
+
+# Read the tunes whose reference numbers are in refnums using the index
+# of the ABC file. Return a list of (refnum, lineno, lines) in file order
+# (like split_tunes()), or None if the index cannot be used (a reference
+# number is not an integer, or the file keeps changing).
+
+def read_indexed_tunes(abc_filename, refnums, rebuild=False):
+    try:
+        int_refnums = [int(refnum) for refnum in refnums]
+    except ValueError:
+        return None
+
+    index = open_index(abc_filename, rebuild)
+    try:
+        tunes = []
+        with open(abc_filename, 'rb') as abc_file:
+            for refnum in int_refnums:
+                record = index.find(refnum)
+                if record == None:
+                    continue
+                (refnum, offset, length, lineno, crc) = record[0:5]
+                abc_file.seek(offset)
+                data = abc_file.read(length)
+                if zlib.crc32(data) != crc:
+                    # The file changed behind the back of the index
+                    if rebuild:
+                        return None
+                    index.close()
+                    return read_indexed_tunes(abc_filename, refnums, rebuild=True)
+                lines = io.TextIOWrapper(io.BytesIO(data)).readlines()
+                tunes.append((offset, " ".join(lines[0][2:].split()), lineno, lines))
+    finally:
+        index.close()
+
+    tunes.sort()
+    return [tune[1:] for tune in tunes]
+
+# ------------------------------------------------------------------------
+#     Tune catalog: the metadata of the tunes of many ABC files, in a
+#     SQLite database
+# ------------------------------------------------------------------------
+
+# The header of a tune is scanned with read_info_line(): the fields are
+# normalized as in a conversion (the time signature by
+# normalize_time_signature(), the key signature by
+# translate_key_signature(), in lilypond format). The notes are not
+# tokenized: the header ends at the first line of notes (as the preamble
+# of the lilypond file, see LilypondSink), and the scan jumps to the next
+# "X:" line.
+
+mc_header_fields = b"XTCRMLK"
+
+# Scan an ABC file in binary mode. Yield (offset, length, lineno, refnum,
+# title, composer, rythm, meter, key_signature, default note length) for
+# each tune (see split_tunes(): a file without any "X:" line is a single
+# tune). An invalid field is left empty.
+
+def scan_tune_headers(abc_filename):
+    def make_entry():
+        return (offset, position - offset, lineno, tc.refnum, tc.title, tc.composer,
+                tc.rythm, tc.meter, tc.key_signature,
+                "1/{0}".format(tc.default_note_duration))
+
+    tc = TuneContext(NullSink()) # the file header, until the first "X:" line
+    tc.filename = abc_filename
+    (offset, lineno, in_header, in_file_header) = (0, 1, True, True)
+    position = 0
+    with open(abc_filename, 'rb') as abc_file:
+        for (n, line) in enumerate(abc_file, 1):
+            if line.startswith(b"X:"):
+                if not in_file_header:
+                    yield make_entry()
+                tc = TuneContext(NullSink())
+                tc.filename = abc_filename
+                (offset, lineno, in_header, in_file_header) = (position, n, True, False)
+            if in_header:
+                if line[1:2] == b":" and line[0:1].isupper():
+                    if line[0:1] in mc_header_fields:
+                        tc.lineno = n
+                        try:
+                            read_info_line(tc, line.decode("utf-8", "replace"))
+                        except (AbcSyntaxError, ValueError, LookupError, ArithmeticError):
+                            pass # see read_line()
+                elif not line.isspace() and not line.lstrip().startswith(b"%"):
+                    in_header = False
+            position += len(line)
+    if not in_file_header or position != 0:
+        yield make_entry()
+
+def get_default_catalog_filename():
+    return os.path.join(get_default_cache_dirname(), "catalog.sqlite")
+
+# The catalog of the tunes: a table of the ABC files (with their size and
+# modification time) and a table of the tunes (the metadata of their
+# header, and their position in their ABC file), indexed on the fields
+# of the queries. The titles, composers and rythms are compared case
+# insensitively.
+#
+# On demand, the catalog is also an inverted index of the melodies: the
+# n-grams of the intervals of each tune (see get_interval_grams()), with
+# the list of the tunes where each n-gram appears (the grams table,
+# clustered by n-gram), to find a tune from a fragment of its melody
+# (see find_fragment()).
+#
+# The catalog is refreshed incrementally: only the ABC files whose size
+# or modification time changed are scanned again (see update()). A
+# catalog of an older version is emptied (it is scanned again).
+
+mc_catalog_version = 2
+
+mc_catalog_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    file TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    melodies INTEGER
+);
+CREATE TABLE IF NOT EXISTS tunes (
+    id INTEGER PRIMARY KEY,
+    file TEXT,
+    offset INTEGER,
+    length INTEGER,
+    lineno INTEGER,
+    refnum TEXT,
+    title TEXT COLLATE NOCASE,
+    composer TEXT COLLATE NOCASE,
+    rhythm TEXT COLLATE NOCASE,
+    meter TEXT,
+    key TEXT,
+    length_unit TEXT,
+    UNIQUE (file, offset)
+);
+CREATE INDEX IF NOT EXISTS tunes_rhythm ON tunes (rhythm, key);
+CREATE INDEX IF NOT EXISTS tunes_key ON tunes (key, meter);
+CREATE INDEX IF NOT EXISTS tunes_meter ON tunes (meter);
+CREATE INDEX IF NOT EXISTS tunes_title ON tunes (title);
+CREATE INDEX IF NOT EXISTS tunes_composer ON tunes (composer);
+CREATE TABLE IF NOT EXISTS grams (
+    gram INTEGER,
+    tune INTEGER,
+    PRIMARY KEY (gram, tune)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS grams_tune ON grams (tune);
+"""
+
+# The fields of the queries: (column, operator)
+mc_catalog_fields = {"title":("title", "LIKE"), "composer":("composer", "LIKE"),
+                     "rhythm":("rhythm", "="), "meter":("meter", "="), "key":("key", "="),
+                     "refnum":("refnum", "=")}
+
+mc_gram_length = 4 # intervals per n-gram (5 notes)
+
+# The intervals of the melody of a tune, in semi-tones, as it is played
+# (see get_midi_notes()): the same in any key and in any octave
+
+def get_melody_intervals(tc):
+    pitches = [midi_pitch for (start, duration, midi_pitch) in get_midi_notes(tc)]
+    return [pitches[k + 1] - pitches[k] for k in range(len(pitches) - 1)]
+
+# The set of the n-grams of a list of intervals, each n-gram packed into
+# an integer (7 bits per interval, up to 5 octaves up or down)
+
+def get_interval_grams(intervals, n=mc_gram_length):
+    grams = set()
+    mask = (1 << 7 * n) - 1
+    gram = 0
+    for (k, interval) in enumerate(intervals, 1):
+        gram = (gram << 7 | (max(-63, min(63, interval)) + 64)) & mask
+        if k >= n:
+            grams.add(gram)
+    return grams
+
+# The n-grams of the intervals of a tune, whose text is data (bytes). The
+# syntax errors are skipped (see read_tune()).
+
+def get_tune_grams(data, abc_filename, lineno):
+    lines = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8", errors="replace").readlines()
+    tc = read_tune(lines, abc_filename, lineno, NullSink(), errors=[])
+    return get_interval_grams(get_melody_intervals(tc))
+
+class TuneCatalog():
+    def __init__(self, catalog_filename=None):
+        if catalog_filename == None:
+            catalog_filename = get_default_catalog_filename()
+        dirname = os.path.dirname(catalog_filename)
+        if dirname != "" and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(catalog_filename)
+        # The catalog can always be scanned again: no need to wait for the
+        # disk at each commit
+        self.db.execute("PRAGMA synchronous = OFF")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != mc_catalog_version:
+            self.db.executescript("BEGIN;"
+                                  "DROP TABLE IF EXISTS files;"
+                                  "DROP TABLE IF EXISTS tunes;"
+                                  "DROP TABLE IF EXISTS grams;"
+                                  + mc_catalog_schema +
+                                  "PRAGMA user_version = {0};"
+                                  "COMMIT;".format(mc_catalog_version))
+
+    def close(self):
+        self.db.close()
+
+    # Scan again the ABC files that changed since the last update, and
+    # forget the ABC files that no longer exist. With melodies, the
+    # melodies of the tunes are indexed too (the tunes are parsed: much
+    # slower than the scan of their headers), and the files scanned
+    # without their melodies are scanned again. Return the number of
+    # scanned files.
+    def update(self, abc_filenames, melodies=False):
+        nscanned = 0
+        with self.db:
+            for abc_filename in abc_filenames:
+                abc_filename = os.path.abspath(abc_filename)
+                row = self.db.execute("SELECT size, mtime_ns, melodies FROM files "
+                                      "WHERE file = ?", (abc_filename,)).fetchone()
+                try:
+                    stat = os.stat(abc_filename)
+                except OSError:
+                    self.remove(abc_filename)
+                    continue
+                if row != None and row[0:2] == (stat.st_size, stat.st_mtime_ns) and \
+                   (row[2] or not melodies):
+                    continue
+                self.remove(abc_filename)
+                self.scan(abc_filename, melodies)
+                self.db.execute("INSERT INTO files VALUES (?, ?, ?, ?)",
+                                (abc_filename, stat.st_size, stat.st_mtime_ns, melodies))
+                nscanned += 1
+        return nscanned
+
+    def scan(self, abc_filename, melodies):
+        if not melodies:
+            self.db.executemany("INSERT INTO tunes VALUES "
+                                "(NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                ((abc_filename,) + entry
+                                 for entry in scan_tune_headers(abc_filename)))
+            return
+
+        with open(abc_filename, 'rb') as abc_file:
+            data = abc_file.read()
+        for entry in scan_tune_headers(abc_filename):
+            tune = self.db.execute("INSERT INTO tunes VALUES "
+                                   "(NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (abc_filename,) + entry).lastrowid
+            (offset, length, lineno) = entry[0:3]
+            # A tune that cannot be parsed (a bug, not a syntax error) has
+            # no melody: the other tunes of the update are indexed
+            try:
+                grams = get_tune_grams(data[offset:offset + length], abc_filename, lineno)
+            except Exception:
+                continue
+            self.db.executemany("INSERT INTO grams VALUES (?, ?)",
+                                ((gram, tune) for gram in grams))
+
+    def remove(self, abc_filename):
+        self.db.execute("DELETE FROM grams WHERE tune IN "
+                        "(SELECT id FROM tunes WHERE file = ?)", (abc_filename,))
+        self.db.execute("DELETE FROM tunes WHERE file = ?", (abc_filename,))
+        self.db.execute("DELETE FROM files WHERE file = ?", (abc_filename,))
+
+    # Find the tunes matching all the criteria, in file order: e.g.
+    # find(rhythm="reel", key="D"). The title and the composer match a
+    # part of the field; the meter and the key are normalized as in the
+    # ABC files ("C" is "4/4", "Dmaj" is "D"). With abc_filenames, only
+    # the tunes of these files are found. Return a list of (file, lineno,
+    # refnum, title, composer, rhythm, meter, key, offset, length).
+    def find(self, abc_filenames=None, **criteria):
+        (conditions, values) = ([], [])
+        if abc_filenames != None:
+            self.select_files(abc_filenames)
+            conditions.append("file IN (SELECT file FROM selected)")
+        for (field, value) in sorted(criteria.items()):
+            if not field in mc_catalog_fields:
+                raise ValueError("Unknown field: {0}".format(field))
+            (column, operator) = mc_catalog_fields[field]
+            if field == "meter":
+                value = normalize_time_signature(value)
+            elif field == "key":
+                value = translate_key_signature(TuneContext(NullSink()), "K:" + value)
+            elif operator == "LIKE":
+                value = "%" + value + "%"
+            conditions.append("{0} {1} ?".format(column, operator))
+            values.append(value)
+        query = "SELECT file, lineno, refnum, title, composer, rhythm, meter, key, offset, " \
+                "length FROM tunes"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return self.db.execute(query + " ORDER BY file, offset", values).fetchall()
+
+    # The files of a query, in a temporary table
+    def select_files(self, abc_filenames):
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS selected (file TEXT PRIMARY KEY)")
+        self.db.execute("DELETE FROM selected")
+        self.db.executemany("INSERT OR IGNORE INTO selected VALUES (?)",
+                            ((os.path.abspath(abc_filename),)
+                             for abc_filename in abc_filenames))
+
+    # Find the tunes whose melody contains a fragment of melody in ABC
+    # format (in the key signature key, e.g. "D": the accidentals of the
+    # key apply), in any key and in any octave. The tunes are ranked by
+    # the n-grams of intervals they share with the fragment, each n-gram
+    # weighted by its rarity (the inverse document frequency). Only the
+    # melodies indexed by update() are searched.
+    #
+    # Return a list of at most limit (score, file, lineno, refnum, title),
+    # the best first, score being between 0 and 1 (1: all the n-grams of
+    # the fragment are found in the tune).
+    def find_fragment(self, fragment, key="C", abc_filenames=None, limit=10):
+        tc = read_tune(["K:" + key + "\n", fragment + "\n"], "fragment", 0, NullSink())
+        grams = get_interval_grams(get_melody_intervals(tc))
+        if len(grams) == 0:
+            raise ValueError("The fragment is too short: at least {0} notes are needed"
+                             .format(mc_gram_length + 1))
+
+        ntunes = self.db.execute("SELECT COUNT(*) FROM tunes WHERE file IN "
+                                 "(SELECT file FROM files WHERE melodies)").fetchone()[0]
+        weights = []
+        for gram in grams:
+            count = self.db.execute("SELECT COUNT(*) FROM grams WHERE gram = ?",
+                                    (gram,)).fetchone()[0]
+            weights.append((gram, math.log((ntunes + 1.0) / (count + 0.5))))
+        total = sum(weight for (gram, weight) in weights)
+
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS fragment "
+                        "(gram INTEGER PRIMARY KEY, weight REAL)")
+        self.db.execute("DELETE FROM fragment")
+        self.db.executemany("INSERT INTO fragment VALUES (?, ?)", weights)
+        condition = ""
+        if abc_filenames != None:
+            self.select_files(abc_filenames)
+            condition = "WHERE tunes.file IN (SELECT file FROM selected) "
+        rows = self.db.execute(
+            # CROSS JOIN: from the n-grams of the fragment to their
+            # postings (not from all the postings)
+            "SELECT file, lineno, refnum, title, SUM(weight) AS score FROM fragment "
+            "CROSS JOIN grams ON grams.gram = fragment.gram "
+            "CROSS JOIN tunes ON tunes.id = grams.tune "
+            + condition +
+            "GROUP BY grams.tune ORDER BY score DESC, file, offset LIMIT ?", (limit,)).fetchall()
+        return [(row[4] / total,) + row[0:4] for row in rows]
+
 # ------------------------------------------------------------------------
 #     Write the lilypond output
 # ------------------------------------------------------------------------
 
-def write_header(tc, ly_file):
-    ly_file.write("\n" r'''\header {''' "\n")
-    ly_file.write('    title = "{0}"\n'.format(tc.title))
+# The header of a tune, indented by indent (e.g. in a \bookpart, see
+# BookPartSink)
+
+def write_header(tc, ly_file, indent=""):
+    ly_file.write(indent + r'''\header {''' "\n")
+    ly_file.write(indent + '    title = "{0}"\n'.format(tc.title))
     if tc.composer != "":
-        ly_file.write('    composer = "{0}"\n'.format(tc.composer))
+        ly_file.write(indent + '    composer = "{0}"\n'.format(tc.composer))
     if tc.rythm != "":
-        ly_file.write('    meter = "{0}"\n'.format(tc.rythm))
-    ly_file.write("}\n")
+        ly_file.write(indent + '    meter = "{0}"\n'.format(tc.rythm))
+    ly_file.write(indent + "}\n")
 
 def normalize_time_signature(meter):
     if meter == "C":
@@ -344,13 +1327,15 @@ def normalize_time_signature(meter):
         if len(meter_tab) != 2 or \
                 not meter_tab[0].isdigit() or \
                 not meter_tab[1].isdigit():
-            raise AbcSyntaxError
+            e = AbcSyntaxError()
+            e.what = "Invalid time signature"
+            raise e
         time_signature = "/".join(meter_tab)
     return time_signature
 
-def write_time_signature(ly_file, meter):
+def write_time_signature(ly_file, meter, indent="    "):
     time_signature = normalize_time_signature(meter)
-    ly_file.write(r'''    \time {0}'''.format(time_signature) + "\n")
+    ly_file.write(indent + r'''\time {0}'''.format(time_signature) + "\n")
 
 # Translate a key signature in ABC format to a key signature in lilypond
 # format. Currently, this function only understands a key signature in
@@ -388,6 +1373,7 @@ def translate_key_signature(tc, abc_key_signature):
         if state == "pitch":
             # The first char should be the pitch
             pitch = ks[0].lower()
+            pitch_colno = e.colno
             if not pitch in "cdefgab":
                 e.what = "Invalid pitch"
                 raise e
@@ -427,7 +1413,12 @@ def translate_key_signature(tc, abc_key_signature):
         e.what = "Empty key signature"
         raise e
 
-    lily_signature = "\key " + pitch + alteration + " " + "\\" + mode
+    lily_signature = "\\key " + pitch + alteration + " " + "\\" + mode
+    if not lily_signature in mc_pitch_dicos:
+        # e.g. Fb major (no such pitch in the chromatic scales)
+        e.colno = pitch_colno
+        e.what = "Unsupported key signature"
+        raise e
     return lily_signature
 
 def get_relative_major_scale(key, mode):
@@ -481,16 +1472,25 @@ def create_pitch_dico(ly_key_signature):
 
     return pitch_dico
 
-def get_leading_digits(string):
-    leading_digits = ""
-    i = 0
-    for char in string:
-        if (i == 0 and char == '/') or char.isdigit():
-            leading_digits += char
-            i += 1
-        else:
-            break
-    return leading_digits
+# The pitch dictionaries of all the key signatures that
+# translate_key_signature() can return (pitch x alteration x mode),
+# computed once. The table and its pitch dictionaries are read-only:
+# they are shared by all the tune contexts.
+
+def create_pitch_dico_table():
+    table = {}
+    for pitch in "cdefgab":
+        for alteration in ["", "is", "es"]:
+            for mode in mc_modes:
+                ly_key_signature = "\\key " + pitch + alteration + " " + "\\" + mode
+                try:
+                    pitch_dico = create_pitch_dico(ly_key_signature)
+                except ValueError:
+                    continue # unsupported key signature (e.g. fes)
+                table[ly_key_signature] = types.MappingProxyType(pitch_dico)
+    return types.MappingProxyType(table)
+
+mc_pitch_dicos = create_pitch_dico_table()
 
 # Given the time signature as a fraction (e.g. "6/8" or "4/4"), compute
 # the default note length in lilypond format
@@ -504,326 +1504,577 @@ def get_default_note_duration(time_signature):
     else:
         return 8
 
-# Given a snippet of ABC music, try to recognize a repeat or bar pattern
+# The ABC tokenizer: one match of this regular expression gives either
+# a bar/repeat pattern or all the parts of a note (each part may be
+# missing). White spaces are allowed between the parts of a note.
 
-def get_bar(abc_snippet):
-    bars = [ ':|2', #'|[1', '|[2',
-             '|1', '|:', ':|', '||', '|]', '::', '[2', #'|2', '[|'
-             '|' ] # longest first, please
-    bar = ""
+mc_token_regex = re.compile(r'''
+    \s*
+    (?: (?P<bar> :\|2 | \|1 | \|: | :\| | \|\| | \|\] | :: | \[2 | \| ) # longest first, please
+    | (?: (?P<quote>") (?P<chord>[^"]*) (?P<chord_end>"?) )? \s*
+      (?P<triplet>\(3)? \s*
+      (?P<accidental>\^\^ | \^ | __ | _ | =)? \s*
+      (?: (?P<rest>z) | (?P<pitch>[a-gA-G]) )? \s*
+      (?P<octaver>[,'])? \s*
+      (?P<broken_rythm>>)? \s*
+      (?P<multiplier>[0-9]+)? \s*
+      (?P<divider>/[0-9]*)? \s*
+      (?P<tie>-)? )
+    ''', re.VERBOSE)
 
-    for b in bars:
-        if len(abc_snippet) >= len(b) and abc_snippet[0:len(b)] == b:
-            bar = b
-            break
+mc_accidentals = {"^":"is", "^^":"isis", "_":"es", "__":"eses", "=":"nat"}
 
-    return bar
+# The bars where the translation resumes after a syntax error
+mc_bar_regex = re.compile(r":\|2|\|1|\|:|:\||\|\||\|\]|::|\[2|\|")
 
 
 # Given a line of ABC music, translate the line to lilypond
+#
+# The line is scanned with an integer cursor (i) over the original
+# string, so that no character is ever copied: the translation time is
+# linear in the length of the line. The column of a syntax error is the
+# position of the cursor.
+#
+# The state handlers consume the parts of the current token (m) found by
+# mc_token_regex: a part is consumed only if it starts at the cursor.
 
 def translate_notes(tc, abc_line, last_line=True):
-    # Prepare an exception (just in case)
-    e = AbcSyntaxError()
-    e.filename = tc.filename
-    e.abc_line = abc_line.rstrip()
-    e.lineno = tc.lineno
-    e.colno = 0
-
-    pitches = "abcdefgABCDEFG"
-
-    al = abc_line.rstrip()
-
-    while len(al) != 0:
-
-        #print("=== abc_line: '{0}'".format(e.abc_line))
-        #print("= al: '{0}'".format(al))
-        #print("= state: '{0}'".format(tc.state))
-
-        len_before = len(al)
-        al = al.lstrip()
-        e.colno += len_before - len(al)
-
-        # Here, we always have at least one non-whitespace character
-
-        if tc.state == "start":
-            tc.state = "bar"
-
-        elif tc.state == "bar":
-            bar = get_bar(al)
-            al = al[len(bar):]
-            e.colno += len(bar)
-
-            if bar == "":
-                tc.state = "chord"
-                continue
+    # The line is not copied: the trailing white spaces are ignored by
+    # stopping at n. The syntax errors are created only when raised.
+    al = abc_line
+    n = len(al)
+    while n > 0 and al[n - 1].isspace():
+        n -= 1
+    i = 0
 
-            flush_bar = True
-            open_repeat = False
-            close_repeat = False
-            begin_alternative = False
-            close_alternative_1 = False
-            begin_alternative_2 = False
-            maybe_end_alternative = False
-
-            if tc.first_bar and tc.prev_note == None:
-                # There is nothing before the first bar: do not attempt
-                # to manage anacrusis
-                tc.first_bar = False
-                flush_bar = False
-
-            if bar == "|:":
-                maybe_end_alternative = True
-                open_repeat = True
-                if tc.ly_line != "":
-                    bar = "|" # Force a bar check when flushing
-                else:
-                    flush_bar = False
-            elif bar == ":|":
-                if tc.alternative == 0:
-                    close_repeat = True
-                close_alternative_1 = True
-            elif bar == "::":
-                close_repeat = True
-                open_repeat = True
-            elif bar == "|1":
-                close_repeat = True
-                begin_alternative = True
-            elif bar == ":|2":
-                # TODO: error if not in alternative
-                close_alternative_1 = True
-                begin_alternative_2 = True
-            elif bar == "[2":
-                flush_bar = False
-                begin_alternative_2 = True
-            else:
-                maybe_end_alternative = True
+    # The line may start in the middle of a note
+    m = mc_token_regex.match(al, 0, n)
 
-            # flush bar
-            if flush_bar:
-                if tc.alternative == 0: # not in alternative
-                    if bar == "|" or bar == "||" or bar == "|]":
-                        tc.flush_line(abc_bar=bar)
-                    else:
-                        tc.flush_line()
-                elif tc.alternative == 1: # in a 1st alternative
-                    tc.alternative_bar_count += 1
-                    if close_alternative_1:
-                        if tc.alternative_bar_count == 1:
-                            tc.flush_line(block=True)
+    # In recovery mode (tc.errors), a syntax error is recorded and the
+    # translation resumes at the next bar, or at the next line
+    while True:
+        try:
+            while i != n:
+
+                #print("=== abc_line: '{0}'".format(al[:n]))
+                #print("= al: '{0}'".format(al[i:]))
+                #print("= state: '{0}'".format(tc.state))
+
+                # al has no trailing white spaces: this loop stops before n
+                while al[i].isspace():
+                    i += 1
+
+                # Here, we always have at least one non-whitespace character
+
+                if tc.state == "start":
+                    tc.state = "bar"
+
+                elif tc.state == "bar":
+                    m = mc_token_regex.match(al, i, n)
+                    bar = m.group("bar")
+                    if bar == None:
+                        tc.state = "chord"
+                        continue
+                    i = m.end()
+
+                    flush_bar = True
+                    open_repeat = False
+                    close_repeat = False
+                    begin_alternative = False
+                    close_alternative_1 = False
+                    begin_alternative_2 = False
+                    maybe_end_alternative = False
+
+                    if tc.first_bar and tc.prev_note.pitch == "":
+                        # There is nothing before the first bar: do not attempt
+                        # to manage anacrusis
+                        tc.first_bar = False
+                        flush_bar = False
+
+                    if bar == "|:":
+                        maybe_end_alternative = True
+                        open_repeat = True
+                        if not tc.first_note:
+                            bar = "|" # Force a bar check when flushing
                         else:
-                            tc.flush_line(block_end=True)
+                            flush_bar = False
+                    elif bar == ":|":
+                        if tc.alternative == 0:
+                            close_repeat = True
+                        close_alternative_1 = True
+                    elif bar == "::":
+                        close_repeat = True
+                        open_repeat = True
+                    elif bar == "|1":
+                        close_repeat = True
+                        begin_alternative = True
+                    elif bar == ":|2":
+                        # TODO: error if not in alternative
+                        close_alternative_1 = True
+                        begin_alternative_2 = True
+                    elif bar == "[2":
+                        flush_bar = False
+                        begin_alternative_2 = True
                     else:
-                        if tc.alternative_bar_count == 1:
-                            tc.flush_line(block_begin=True, abc_bar=bar)
-                        else:
-                            tc.flush_line(in_block=True, abc_bar=bar)
-                elif tc.alternative == 2: # in a 2nd alternative
-                    if 1 == tc.alternative_bar_count:
-                        tc.flush_line(block=True)
+                        maybe_end_alternative = True
+
+                    # flush bar
+                    if flush_bar:
+                        if tc.alternative == 0: # not in alternative
+                            if bar == "|" or bar == "||" or bar == "|]":
+                                tc.flush_line(abc_bar=bar)
+                            else:
+                                tc.flush_line()
+                        elif tc.alternative == 1: # in a 1st alternative
+                            tc.alternative_bar_count += 1
+                            if close_alternative_1:
+                                if tc.alternative_bar_count == 1:
+                                    tc.flush_line(block=True)
+                                else:
+                                    tc.flush_line(block_end=True)
+                            else:
+                                if tc.alternative_bar_count == 1:
+                                    tc.flush_line(block_begin=True, abc_bar=bar)
+                                else:
+                                    tc.flush_line(in_block=True, abc_bar=bar)
+                        elif tc.alternative == 2: # in a 2nd alternative
+                            if 1 == tc.alternative_bar_count:
+                                tc.flush_line(block=True)
+                            else:
+                                if tc.alternative_bar_count == tc.alternative_count_down:
+                                    tc.flush_line(block_begin=True, abc_bar=bar)
+                                elif tc.alternative_count_down == 1:
+                                    tc.flush_line(block_end=True)
+                                else:
+                                    tc.flush_line(in_block=True, abc_bar=bar)
+                            tc.alternative_count_down -= 1
+
+                    # close repeat
+                    if close_repeat:
+                        tc.close_repeat()
+
+                    # begin alternative
+                    if begin_alternative:
+                        tc.begin_alternative_1()
+                        tc.alternative_bar_count = 0
+                        tc.alternative_count_down = 0
+
+                    if begin_alternative_2:
+                        tc.begin_alternative_2()
+                        tc.alternative_count_down = tc.alternative_bar_count
+
+                    # end alternative
+                    if maybe_end_alternative:
+                        if tc.alternative == 2 and tc.alternative_count_down == 0:
+                            tc.end_alternative()
+
+                    # open repeat
+                    if open_repeat:
+                        tc.open_repeat()
+
+                    tc.first_note = True
+
+                elif tc.state == "chord":
+                    if m.start("quote") == i:
+                        if m.group("chord_end") == "":
+                            raise AbcSyntaxError("Missing the guitar chord closing inverted commas",
+                                                 tc.filename, al[:n], tc.lineno, n)
+                        tc.note.chord += m.group("chord")
+                        i = m.end("chord_end")
+                    tc.state = "triplet"
+
+                elif tc.state == "triplet":
+                    # My Own Interpretation: a chord change can occur during a
+                    # triplet. But a chord change on the first note of a triplet
+                    # should be written before the triplet marker.
+                    if m.start("triplet") == i:
+                        i += 2
+                        tc.in_triplet = True
+                        tc.triplet_count = 0
+                    tc.state = "accidental"
+
+                elif tc.state == "accidental":
+                    if m.start("accidental") == i:
+                        tc.note.accidental = mc_accidentals[m.group("accidental")]
+                        i = m.end("accidental")
+                    tc.state = "rest"
+
+                elif tc.state == "rest":
+                    if m.start("rest") == i:
+                        tc.note.pitch = "r"
+                        tc.note.ticks = mc_ticks_per_whole // tc.default_note_duration
+                        i += 1
+                        if tc.in_triplet:
+                            tc.triplet_count += 1
+                        tc.state = "check_ties"
+                    else:
+                        tc.state = "pitch"
+
+                elif tc.state == "pitch":
+                    abc_pitch = al[i]
+                    tc.note.abc_pitch = abc_pitch
+                    if m.start("pitch") != i:
+                        raise AbcSyntaxError("'{0}' is not a pitch".format(abc_pitch),
+                                             tc.filename, al[:n], tc.lineno, i)
+                    i += 1
+                    if tc.note.accidental == "":
+                        tc.note.pitch = tc.pitch_dico[abc_pitch.lower()]
+                    else:
+                        tc.note.pitch = abc_pitch.lower()
+                        if tc.note.accidental != "nat":
+                            tc.note.pitch += tc.note.accidental
+                    tc.note.ticks = mc_ticks_per_whole // tc.default_note_duration
+                    if abc_pitch.lower() == abc_pitch:
+                        tc.note.octaver = "''"
+                    else:
+                        tc.note.octaver = "'"
+                    if tc.in_triplet:
+                        tc.triplet_count += 1
+                    tc.state = "octaver"
+
+                elif tc.state == "octaver":
+                    # Look for "," or "'"
+                    if m.start("octaver") == i:
+                        octaver = al[i]
                     else:
-                        if tc.alternative_bar_count == tc.alternative_count_down:
-                            tc.flush_line(block_begin=True, abc_bar=bar)
-                        elif tc.alternative_count_down == 1:
-                            tc.flush_line(block_end=True)
+                        octaver = ""
+                    if octaver == ",":
+                        if tc.note.octaver == "''":
+                            # "c," etc is an invalid ABC construct
+                            what = "'{0}{1}' is not syntactically correct".format(tc.note.abc_pitch, octaver)
+                            raise AbcSyntaxError(what, tc.filename, al[:n], tc.lineno, i)
+                        tc.note.octaver = ""
+                    elif octaver == "'":
+                        if tc.note.octaver == "'":
+                            # "C'" etc is an invalid ABC construct
+                            what = '"{0}{1}" is not syntactically correct'.format(tc.note.abc_pitch, octaver)
+                            raise AbcSyntaxError(what, tc.filename, al[:n], tc.lineno, i)
+                        tc.note.octaver += "'"
+                    if octaver != "":
+                        i += 1
+                    tc.state = "check_ties"
+
+                elif tc.state == "check_ties":
+                    # Check that two tied notes have the same pitch
+                    if tc.prev_note.tied == True:
+                        if not tc.note.same_pitch(tc.prev_note):
+                            raise AbcSyntaxError("The tied notes do not have the same pitch",
+                                                 tc.filename, al[:n], tc.lineno, i)
+                    tc.state = "duration"
+
+                elif tc.state == "duration":
+                    if m.start("broken_rythm") == i:
+                        tc.note.ticks = tc.note.ticks * 3 // 2
+                        tc.in_broken_rythm = True
+                        i += 1
+                        tc.state = "tie"
+                    elif tc.in_broken_rythm:
+                        tc.note.ticks //= 2
+                        tc.in_broken_rythm = False
+                        tc.state = "tie"
+                    else:
+                        tc.state = "duration_multiplier"
+
+                elif tc.state == "duration_multiplier":
+                    if m.start("multiplier") == i:
+                        lm = m.group("multiplier")
+                        ticks = tc.note.ticks * int(lm)
+                        if not ticks in mc_ly_durations:
+                            # e.g. 5 (no such lilypond duration)
+                            raise AbcSyntaxError("Unhandled duration multiplier",
+                                                 tc.filename, al[:n], tc.lineno, i)
+                        tc.note.ticks = ticks
+                        i += len(lm)
+                    tc.state = "duration_divider"
+
+                elif tc.state == "duration_divider":
+                    if m.start("divider") == i:
+                        lm = m.group("divider")
+                        if len(lm) == 1:
+                            divisor = 2
                         else:
-                            tc.flush_line(in_block=True, abc_bar=bar)
-                    tc.alternative_count_down -= 1
-
-            # close repeat
-            if close_repeat:
-                tc.close_repeat()
-
-            # begin alternative
-            if begin_alternative:
-                tc.begin_alternative_1()
-                tc.alternative_bar_count = 0
-                tc.alternative_count_down = 0
-
-            if begin_alternative_2:
-                tc.begin_alternative_2()
-                tc.alternative_count_down = tc.alternative_bar_count
-
-            # end alternative
-            if maybe_end_alternative:
-                if tc.alternative == 2 and tc.alternative_count_down == 0:
-                    tc.end_alternative()
-
-            # open repeat
-            if open_repeat:
-                tc.open_repeat()
-
-            tc.ly_line = ""
-            tc.first_note = True
-
-        elif tc.state == "chord":
-            if al[0] == '"':
-                al = al[1:]
-                e.colno += 1
-                while len(al) >= 1 and al[0] != '"':
-                    tc.note.chord += al[0]
-                    al = al[1:]
-                    e.colno += 1
-                if len(al) >= 1 and al[0] == '"':
-                    al = al[1:]
-                    e.colno += 1
-                else:
-                    e.what = "Missing the guitar chord closing inverted commas"
-                    raise e
-            tc.state = "triplet"
-
-        elif tc.state == "triplet":
-            # My Own Interpretation: a chord change can occur during a
-            # triplet. But a chord change on the first note of a triplet
-            # should be written before the triplet marker.
-            if len(al) >= 2 and al[0:2] == "(3":
-                al = al[2:]
-                e.colno += 2
-                tc.in_triplet = True
-                tc.triplet_count = 0
-            tc.state = "accidental"
-
-        elif tc.state == "accidental":
-            acc_dico = {"^":"is", "^^":"isis", "_":"es", "__":"eses", "=":"nat"}
-            abc_acc = ""
-            if len(al) >= 2 and al[0:2] in acc_dico.keys():
-                abc_acc = al[0:2]
-            elif al[0] in acc_dico.keys():
-                abc_acc = al[0]
-            if abc_acc != "":
-                tc.note.accidental = acc_dico[abc_acc]
-                al = al[len(abc_acc):]
-                e.colno += len(abc_acc)
-            tc.state = "rest"
-
-        elif tc.state == "rest":
-            if al[0] == "z":
-                tc.note.pitch = "r"
-                tc.note.duration = tc.default_note_duration
-                al = al[1:]
-                e.colno += 1
-                if tc.in_triplet:
-                    tc.triplet_count += 1
-                tc.state = "check_ties"
+                            divisor = int(lm[1:])
+                        # divisor must be a power of 2, and the note not shorter
+                        # than a 512th note
+                        if divisor < 2 or divisor & (divisor - 1) != 0 or \
+                           not tc.note.ticks // divisor in mc_ly_durations or \
+                           tc.note.ticks % divisor != 0:
+                            raise AbcSyntaxError("Invalid note duration divisor", tc.filename,
+                                                 al[:n], tc.lineno, i + 1) # pass the slash
+                        tc.note.ticks //= divisor
+                        i += len(lm)
+                    # Else use default note length
+                    tc.state = "tie"
+
+                elif tc.state == "tie":
+                    if m.start("tie") == i:
+                        i += 1
+                        tc.note.tied = True
+                    tc.state = "done"
+
+                elif tc.state == "done":
+                    tc.dump_note()
+                    tc.state = "start"
+            break
+        except AbcSyntaxError as e:
+            if tc.errors == None:
+                raise
+            tc.errors.append(e)
+            tc.reset_note()
+            m = mc_bar_regex.search(al, i, n)
+            if m == None:
+                i = n
             else:
-                tc.state = "pitch"
+                i = m.start()
 
-        elif tc.state == "pitch":
-            abc_pitch = al[0]
-            if not abc_pitch in pitches:
-                e.what = "'{0}' is not a pitch".format(abc_pitch)
-                raise e
-            al = al[1:]
-            e.colno += 1
-            if tc.note.accidental == "":
-                tc.note.pitch = tc.pitch_dico[abc_pitch.lower()]
-            else:
-                tc.note.pitch = abc_pitch.lower()
-                if tc.note.accidental != "nat":
-                    tc.note.pitch += tc.note.accidental
-            tc.note.duration = tc.default_note_duration
-            if abc_pitch.lower() == abc_pitch:
-                tc.note.octaver = "''"
-            else:
-                tc.note.octaver = "'"
-            if tc.in_triplet:
-                tc.triplet_count += 1
-            tc.state = "octaver"
-
-        elif tc.state == "octaver":
-            # Look for "," or "'"
-            octaver = al[0]
-            if octaver == ",":
-                if tc.note.octaver == "''":
-                    # "c," etc is an invalid ABC construct
-                    e.what = "'{0}{1}' is not syntactically correct".format(abc_pitch, octaver)
-                    raise e
-                tc.note.octaver = ""
-            elif octaver == "'":
-                if tc.note.octaver == "'":
-                    # "C'" etc is an invalid ABC construct
-                    e.what = '"{0}{1}" is not syntactically correct'.format(abc_pitch, octaver)
-                    raise e
-                tc.note.octaver += "'"
-            if octaver == "'" or octaver == ",":
-                al = al[1:]
-                e.colno += 1
-            tc.state = "check_ties"
+    if last_line:
+        tc.dump_note()
+        if not tc.first_note:
+            tc.flush_line()
 
-        elif tc.state == "check_ties":
-            # Check that two tied notes have the same pitch
-            if tc.prev_note != None and tc.prev_note.tied == True:
-                if not tc.note.same_pitch(tc.prev_note):
-                    e.what = "The tied notes do not have the same pitch"
-                    raise e
-            tc.state = "duration"
+    tc.emitter.emit(tc)
 
-        elif tc.state == "duration":
-            if al[0] == '>':
-                tc.note.dotted = True
-                tc.in_broken_rythm = True
-                al = al[1:]
-                e.colno += 1
-                tc.state = "tie"
-            elif tc.in_broken_rythm:
-                tc.note.duration *= 2
-                tc.in_broken_rythm = False
-                tc.state = "tie"
+
+# ------------------------------------------------------------------------
+#     Write the MIDI output
+# ------------------------------------------------------------------------
+
+# A Standard MIDI File (format 0: one track) is written from the events
+# of a tune: the repeats are played twice, with their alternatives, the
+# tied notes are merged and the triplets last 2/3 of their notes. The
+# MIDI ticks are the ticks of the durations (384 per quarter note).
+
+mc_midi_division = mc_ticks_per_whole // 4
+mc_midi_tempo = 500000 # microseconds per quarter note (120 bpm)
+mc_midi_velocity = 80
+
+# The semi-tones of the notes c, d, e, f, g, a, b above c
+mc_midi_semitones = [0, 2, 4, 5, 7, 9, 11]
+
+# The MIDI pitch of a note (see mc_ly_pitches): c' is 60
+
+def get_midi_pitch(pitch, octave):
+    return 48 + 12 * octave + mc_midi_semitones[pitch // 5] + pitch % 5 - 2
+
+# The order in which the notes and rests of a tune are played: a list of
+# event indexes, the repeats and alternatives being unrolled
+
+def get_played_events(events):
+    played = []
+    section = [] # the events played again at the end of the repeat
+    in_ending = False
+    n = len(events)
+    for k in range(n):
+        kind = events.kinds[k]
+        if kind == mc_event_note or kind == mc_event_rest:
+            played.append(k)
+            if not in_ending:
+                section.append(k)
+        elif kind == mc_event_open_repeat:
+            section = []
+        elif kind == mc_event_close_repeat:
+            # With alternatives, the section is played again before the
+            # 2nd ending
+            if k + 1 == n or events.kinds[k + 1] != mc_event_begin_alternative_1:
+                played.extend(section)
+                section = []
+        elif kind == mc_event_begin_alternative_1:
+            in_ending = True
+        elif kind == mc_event_begin_alternative_2:
+            played.extend(section)
+            section = []
+        elif kind == mc_event_end_alternative:
+            in_ending = False
+            section = []
+    return played
+
+# The notes of a tune, as played: a list of (start, duration, MIDI pitch),
+# in ticks
+
+def get_midi_notes(tc):
+    events = tc.events
+
+    # The duration of the notes of the triplets
+    durations = array.array('H', events.ticks)
+    in_triplet = False
+    for k in range(len(events)):
+        if events.flags[k] & mc_flag_triplet_begin:
+            in_triplet = True
+        if in_triplet and (events.kinds[k] == mc_event_note or
+                           events.kinds[k] == mc_event_rest):
+            durations[k] = events.ticks[k] * 2 // 3
+            if events.flags[k] & mc_flag_triplet_end:
+                in_triplet = False
+
+    notes = []
+    time = 0
+    tied = False
+    for k in get_played_events(events):
+        if events.kinds[k] == mc_event_note:
+            midi_pitch = get_midi_pitch(events.pitches[k], events.octaves[k])
+            if tied and notes[-1][2] == midi_pitch:
+                (start, duration, midi_pitch) = notes[-1]
+                notes[-1] = (start, duration + durations[k], midi_pitch)
             else:
-                tc.state = "duration_multiplier"
-
-        elif tc.state == "duration_multiplier":
-            lm = get_leading_digits(al)
-            if lm != "" and lm[0] != '/':
-                abc_duration = int(lm)
-                if abc_duration % 1.5 == 0:
-                    tc.note.duration /= int(abc_duration / 1.5)
-                    tc.note.dotted = True
-                elif abc_duration % 2 == 0:
-                    tc.note.duration /= abc_duration
-                else:
-                    e.what = "Unhandled duration multiplier"
-                    raise e
-                al = al[len(lm):]
-                e.colno += len(lm)
-            tc.state = "duration_divider"
-
-        elif tc.state == "duration_divider":
-            lm = get_leading_digits(al)
-            if lm != "" and lm[0] == '/':
-                if len(lm) == 1:
-                    tc.note.duration *= 2
-                else:
-                    divisor = int(lm[1:])
-                    exponent = math.log(divisor, 2)
-                    if exponent != 0 and int(exponent) == exponent:
-                        # divisor is a power of 2
-                        tc.note.duration *= divisor
-                    else:
-                        e.colno += 1 # pass the slash
-                        e.what = "Invalid note duration divisor"
-                        raise e
-                al = al[len(lm):]
-                e.colno += len(lm)
-            # Else use default note length
-            tc.state = "tie"
-
-        elif tc.state == "tie":
-            if al[0] == '-':
-                al = al[1:]
-                e.colno += 1
-                tc.note.tied = True
-            tc.state = "done"
+                notes.append((time, durations[k], midi_pitch))
+            tied = events.flags[k] & mc_flag_tied != 0
+        else:
+            tied = False
+        time += durations[k]
+    return notes
+
+# A MIDI variable-length quantity
+
+def get_midi_varlen(value):
+    data = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        data.insert(0, 0x80 | (value & 0x7f))
+        value >>= 7
+    return data
+
+def write_midi(tc, midi_file):
+    track = bytearray()
+
+    title = tc.title.encode("utf-8")
+    track += b"\x00\xff\x03" + get_midi_varlen(len(title)) + title
+    track += b"\x00\xff\x51\x03" + struct.pack(">I", mc_midi_tempo)[1:]
+    if tc.meter != "":
+        (meter_num, meter_den) = map(int, tc.meter.split("/"))
+        if meter_den & (meter_den - 1) == 0:
+            track += b"\x00\xff\x58\x04" + bytearray([meter_num, meter_den.bit_length() - 1,
+                                                      24, 8])
+
+    # The note off are sorted before the note on of the same time
+    midi_events = []
+    for (start, duration, midi_pitch) in get_midi_notes(tc):
+        midi_events.append((start, 1, midi_pitch))
+        midi_events.append((start + duration, 0, midi_pitch))
+    midi_events.sort()
+
+    time = 0
+    for (event_time, note_on, midi_pitch) in midi_events:
+        track += get_midi_varlen(event_time - time)
+        if note_on:
+            track += bytearray([0x90, midi_pitch, mc_midi_velocity])
+        else:
+            track += bytearray([0x80, midi_pitch, 0])
+        time = event_time
+    track += b"\x00\xff\x2f\x00"
 
-        elif tc.state == "done":
-            tc.dump_note()
-            tc.state = "start"
+    midi_file.write(b"MThd" + struct.pack(">IHHH", 6, 0, 1, mc_midi_division))
+    midi_file.write(b"MTrk" + struct.pack(">I", len(track)) + bytes(track))
 
-    if last_line:
-        tc.dump_note()
-        if tc.ly_line:
-            tc.flush_line()
 
+# ------------------------------------------------------------------------
+#     Conversion cache
+# ------------------------------------------------------------------------
+
+# An on-disk cache of the lilypond text of the tunes, addressed by the
+# SHA-1 of: the version of abc4ly (and the SHA-1 of its source, so that
+# editing the converter invalidates the cache, but touching it does not)
+# and the ABC text of the tune. No output option changes the lilypond
+# text of a tune (-x and -s only select the tunes and name the files, and
+# the MIDI files are not cached): the options are not part of the key. A
+# tune found in the cache is not parsed at all.
+#
+# The cache is bounded in size: the least recently used entries (the
+# oldest modification times: a hit touches its entry) are evicted when
+# the cache grows over max_size bytes.
+
+mc_converter_sha1 = None
+
+def get_converter_sha1():
+    global mc_converter_sha1
+    if mc_converter_sha1 == None:
+        with open(os.path.abspath(__file__), 'rb') as converter:
+            mc_converter_sha1 = hashlib.sha1(converter.read()).hexdigest()
+    return mc_converter_sha1
+
+def get_default_cache_dirname():
+    dirname = os.environ.get("ABC4LY_CACHE_DIR")
+    if not dirname:
+        cache_home = os.environ.get("XDG_CACHE_HOME") or \
+            os.path.join(os.path.expanduser("~"), ".cache")
+        dirname = os.path.join(cache_home, "abc4ly")
+    return dirname
+
+class ConversionCache():
+    def __init__(self, dirname=None, max_size=100 * 1024 * 1024):
+        if dirname == None:
+            dirname = get_default_cache_dirname()
+        self.dirname = dirname
+        self.max_size = max_size
+        self.size = None # estimated size of the cache, computed on demand
+
+    def get_key(self, abc_lines):
+        sha1 = hashlib.sha1()
+        sha1.update("abc4ly {0} {1}\n".format(__version__,
+                                              get_converter_sha1()).encode("utf-8"))
+        for line in abc_lines:
+            sha1.update(line.encode("utf-8", "surrogateescape"))
+        return sha1.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.dirname, key[0:2], key + ".ly")
+
+    # Return the cached lilypond text, or None
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, encoding="utf-8") as entry:
+                ly_text = entry.read()
+            os.utime(path) # the most recently used entry
+        except (IOError, OSError):
+            return None
+        return ly_text
+
+    def put(self, key, ly_text):
+        path = self.get_path(key)
+        data = ly_text.encode("utf-8")
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+            with open(tmp_path, 'wb') as entry:
+                entry.write(data)
+            os.replace(tmp_path, path)
+        except (IOError, OSError):
+            return # a cache that cannot be written is just not used
+
+        if self.size == None:
+            self.size = sum(size for (mtime, size, path) in self.list_entries())
+        else:
+            self.size += len(data)
+        if self.size > self.max_size:
+            self.evict()
+
+    def list_entries(self):
+        entries = []
+        for (dirpath, dirnames, filenames) in os.walk(self.dirname):
+            for filename in filenames:
+                if filename.endswith(".ly"):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue # evicted by another process
+                    entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return entries
+
+    # Remove the least recently used entries, down to 3/4 of max_size (so
+    # that the cache is not walked again at the next put)
+    def evict(self):
+        entries = sorted(self.list_entries())
+        self.size = sum(size for (mtime, size, path) in entries)
+        for (mtime, size, path) in entries:
+            if self.size <= self.max_size * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
 
 # ------------------------------------------------------------------------
 #     The high-level conversion function
@@ -833,56 +2084,39 @@ def open_abc(abc_filename):
     abc_file = open(abc_filename, 'r')
     return abc_file
 
-def convert(abc_filename, ly_filename):
-    abc_file = open_abc(abc_filename)
-
-    # Setup the context data
-
-    tc = TuneContext()
-    tc.filename = abc_filename
+def check_time_signature(tc):
+    if tc.meter == "":
+        e = AbcSyntaxError()
+        e.filename = tc.filename
+        e.lineno = tc.lineno
+        e.what = "Missing time signature (M: field)"
+        raise e
 
-    # Parse the ABC file
+def write_ly_version(ly_file):
+    ly_file.write(r'''\version "2.12.2"''' "\n\n")
 
-    for line in abc_file.readlines():
-        read_line(tc, line)
-    translate_notes(tc, "", last_line = True) # flush the ly_line remnant
+# The beginning of the lilypond file, up to the melody
 
-    if ly_filename == None or ly_filename == '':
-        ly_file = sys.stdout
-    else:
-        ly_file = open(ly_filename, 'w')
+def write_ly_preamble(tc, ly_file):
+    check_time_signature(tc)
 
-    try:
-        # Warning: with format(), curly braces must be escaped by
-        # doubling them!
-        ly_file.write(r'''\version "2.12.2"''' "\n")
-        write_header(tc, ly_file)
-        ly_file.write(r'''
+    # Warning: with format(), curly braces must be escaped by
+    # doubling them!
+    write_ly_version(ly_file)
+    write_header(tc, ly_file)
+    ly_file.write(r'''
 melody = {
     \clef treble
 ''')
-        ly_file.write("    " + tc.key_signature + "\n")
-        write_time_signature(ly_file, tc.meter)
-
-        ly_file.write("\n")
-        for line in tc.output:
-            # First, we must escape the special caracters (such as "\r")
-            # that can occur in some lilypond commands (such as
-            # "\repeat"). To do this, we use the canonical
-            # representation of the string and we remove:
-            # - the leading and quotes
-            # - the spurious backslashes inserted when we mix chords
-            #    with apostrophe
-            # - the spurious backslash inserted when we use raw strings with "\a"
-            line = repr(line)
-            line = line[1:len(line)-1]
-            line = line.replace("\\\'", "\'")
-            line = line.replace("\\\\", "\\")
-
-            # Then we can write the line safely...
-            ly_file.write("    " + line + "\n")
-
-        ly_file.write(r'''}
+    ly_file.write("    " + tc.key_signature + "\n")
+    write_time_signature(ly_file, tc.meter)
+
+    ly_file.write("\n")
+
+# The end of the lilypond file, after the melody
+
+def write_ly_postamble(ly_file):
+    ly_file.write(r'''}
 
 \score {
     \new Staff \melody
@@ -890,13 +2124,1408 @@ melody = {
     \midi { }
 }
 ''')
+
+# Write the lilypond file of a tune already read (from its events)
+
+def write_ly(tc, ly_file):
+    LilypondEmitter(LilypondSink(ly_file)).close(tc)
+
+# The name of the lilypond file of a tune when a tunebook is split into
+# one lilypond file per tune: "tunebook-REFNUM.ly" (or "tunebook-REFNUM.mid"
+# with the ".mid" extension)
+
+def get_tune_ly_filename(abc_filename, ly_filename, refnum, extension=".ly"):
+    if ly_filename == None or ly_filename == '':
+        ly_filename = os.path.basename(abc_filename)
+    return "{0}-{1}{2}".format(os.path.splitext(ly_filename)[0], refnum, extension)
+
+# Convert the lines of a tune to lilypond, written into ly_file as they
+# are translated. With a cache, the lilypond text is also kept in a
+# buffer to be stored in the cache; a tune found in the cache is not
+# parsed: only the filename and lineno of the returned context are set.
+#
+# With midi, a MIDI file is written instead (into a binary ly_file),
+# without cache: it takes less time than the cache itself.
+
+def convert_tune(lines, abc_filename, lineno, ly_file, cache=None, midi=False):
+    if midi:
+        tc = read_tune(lines, abc_filename, lineno, NullSink())
+        write_midi(tc, ly_file)
+        return tc
+
+    if cache != None:
+        key = cache.get_key(lines)
+        ly_text = cache.get(key)
+        if ly_text != None:
+            ly_file.write(ly_text)
+            tc = TuneContext()
+            tc.filename = abc_filename
+            tc.lineno = lineno
+            return tc
+
+        ly_buffer = io.StringIO()
+        tc = read_tune(lines, abc_filename, lineno, LilypondSink(ly_file, ly_buffer))
+        cache.put(key, ly_buffer.getvalue())
+        return tc
+
+    return read_tune(lines, abc_filename, lineno, LilypondSink(ly_file))
+
+# Convert the lines of a tune into the file tune_ly_filename (or to the
+# standard output if it is None or ''). The file is written in a
+# temporary file, renamed when the tune is converted: a syntax error does
+# not leave a truncated file behind, and a viewer of the file never sees
+# a partial file.
+
+def convert_tune_file(lines, abc_filename, lineno, tune_ly_filename, cache=None,
+                      midi=False):
+    if midi:
+        (mode, stdout) = ('wb', sys.stdout.buffer)
+    else:
+        (mode, stdout) = ('w', sys.stdout)
+
+    if tune_ly_filename == None or tune_ly_filename == '':
+        return convert_tune(lines, abc_filename, lineno, stdout, cache, midi)
+
+    return write_file(tune_ly_filename, mode,
+                      lambda ly_file: convert_tune(lines, abc_filename, lineno, ly_file, cache,
+                                                   midi))
+
+# Write a file with write(file) through a temporary file, renamed once it
+# is written (see convert_tune_file()). Return what write() returns.
+
+def write_file(filename, mode, write):
+    tmp_filename = "{0}.{1}.tmp".format(filename, os.getpid())
+    with open(tmp_filename, mode) as tmp_file:
+        try:
+            result = write(tmp_file)
+        except:
+            tmp_file.close()
+            os.remove(tmp_filename)
+            raise
+    os.replace(tmp_filename, filename)
+    return result
+
+# Duplicate tunes: the same notes under another title (e.g. the copies of
+# a tune in several tunebooks). The lilypond text of a tune after its
+# \header block (its body) only depends on its notes and on its M:, L: and
+# K: fields. A duplicate is not converted again: its file is its own
+# \header followed by the body of the file of the first copy (see
+# write_duplicate_tune_file()).
+
+mc_header_only_fields = "TCR" # the fields written in the \header block
+
+# The key of the body of a tune: the SHA-1 of its notes and of its M:,
+# L: and K: fields. The comments, the empty lines, the white spaces
+# (except in the guitar chords) and the breaks of the note lines do not
+# count: the tokenizer skips the white spaces, and a note can even be
+# split across two lines (see translate_notes()).
+# Return (key, header lines), the header lines being the T:, C: and R:
+# lines of the tune. The key is None if such a line comes after the first
+# note line (it may be written in the \header block, or not: the tune is
+# not deduplicated).
+
+def get_tune_body_key(lines):
+    sha1 = hashlib.sha1()
+    header_lines = []
+    in_header = True
+    for line in lines:
+        if line[0] in string.ascii_uppercase and line[1:2] == ":":
+            if line[0] in mc_header_only_fields:
+                if not in_header:
+                    return (None, header_lines)
+                header_lines.append(line)
+            elif line[0] in "MLK":
+                sha1.update(b"\n" + line.rstrip().encode("utf-8", "surrogateescape") + b"\n")
+        elif not line.isspace() and line.lstrip()[0] != "%":
+            in_header = False
+            parts = line.split('"')
+            for k in range(0, len(parts), 2): # outside the guitar chords
+                parts[k] = "".join(parts[k].split())
+            sha1.update('"'.join(parts).encode("utf-8", "surrogateescape"))
+    return (sha1.hexdigest(), header_lines)
+
+# Write the lilypond file of a duplicate tune, given its header lines (see
+# get_tune_body_key()): its own \header, and the body of the lilypond file
+# of the first copy, original_ly_filename. Return the context of the
+# tune, with only its header fields set.
+
+def write_duplicate_tune_file(header_lines, abc_filename, lineno, tune_ly_filename,
+                              original_ly_filename):
+    tc = TuneContext(NullSink())
+    tc.filename = abc_filename
+    tc.lineno = lineno
+    for line in header_lines:
+        read_info_line(tc, line)
+    with open(original_ly_filename) as original_file:
+        ly_text = original_file.read()
+    body = ly_text[ly_text.index("\n}\n") + 3:] # after the \header block
+
+    def write(ly_file):
+        write_ly_version(ly_file)
+        write_header(tc, ly_file)
+        ly_file.write(body)
+    write_file(tune_ly_filename, 'w', write)
+    return tc
+
+# Convert an ABC file to lilypond.
+#
+# By default, only the first tune of the ABC file is converted. With
+# refnums (a list of reference numbers), the first tune whose reference
+# number is in the list is converted instead. With split, all the tunes
+# (or all the tunes selected by refnums) are converted, each in its own
+# lilypond file (see get_tune_ly_filename()).
+#
+# The tunes selected by refnums are found with the index of the ABC file
+# (see open_index()), unless use_index is False. With a cache (see
+# ConversionCache), the tunes already converted are not parsed again.
+#
+# With midi, MIDI files are written instead of lilypond files (see
+# write_midi()), named "tunebook-REFNUM.mid" with split.
+#
+# With dedupe and split, a tune whose body is the body of a tune already
+# converted is not converted again (see write_duplicate_tune_file()), and
+# (tune_ly_filename, original_ly_filename) is appended to duplicates, if
+# any. The MIDI files are always converted: they take less time than
+# that. The tunes whose line number is in skip are not converted at all
+# (see convert_batch()).
+#
+# Return the context of the last converted tune (None if no tune was
+# selected, see also convert_tune()).
+
+def convert(abc_filename, ly_filename, refnums=None, split=False, use_index=True,
+            cache=None, midi=False, dedupe=False, duplicates=None, skip=None):
+    abc_file = None
+    tunes = None
+    if refnums and use_index:
+        try:
+            tunes = read_indexed_tunes(abc_filename, refnums)
+        except (IOError, OSError):
+            tunes = None # e.g. read-only directory: no index
+    if tunes == None:
+        abc_file = open_abc(abc_filename)
+        tunes = (tune for tune in split_tunes(abc_file)
+                 if not refnums or tune[0] in refnums)
+
+    if midi:
+        extension = ".mid"
+    else:
+        extension = ".ly"
+
+    tc = None
+    originals = {}
+    try:
+        for (n, (refnum, lineno, lines)) in enumerate(tunes, 1):
+            if not split and n > 1:
+                break
+            if split:
+                tune_ly_filename = get_tune_ly_filename(abc_filename, ly_filename,
+                                                        refnum or n, extension)
+            else:
+                tune_ly_filename = ly_filename
+            if skip and lineno in skip:
+                continue
+            key = None
+            if dedupe and split and not midi:
+                (key, header_lines) = get_tune_body_key(lines)
+                if key in originals:
+                    tc = write_duplicate_tune_file(header_lines, abc_filename, lineno,
+                                                   tune_ly_filename, originals[key])
+                    if duplicates != None:
+                        duplicates.append((tune_ly_filename, originals[key]))
+                    continue
+            tc = convert_tune_file(lines, abc_filename, lineno, tune_ly_filename, cache, midi)
+            if key != None:
+                originals[key] = tune_ly_filename
     finally:
-        if ly_file != sys.stdout:
-            ly_file.close()
-        abc_file.close()
+        if abc_file != None:
+            abc_file.close()
 
     return tc
 
+# ------------------------------------------------------------------------
+#     Lilypond books: many tunes in one lilypond file, engraved by one
+#     lilypond process
+# ------------------------------------------------------------------------
+
+# The name of the lilypond file of a book when the tunes are split into
+# several books: "tunebook-bookK.ly" (K from 1)
+
+def get_book_ly_filename(abc_filename, ly_filename, k):
+    if ly_filename == None or ly_filename == '':
+        ly_filename = os.path.basename(abc_filename)
+    return "{0}-book{1}.ly".format(os.path.splitext(ly_filename)[0], k)
+
+# Split the tunes (refnum, lineno, lines, abc_filename) into at most
+# nbooks books of consecutive tunes, with about the same number of ABC
+# lines each: the books take about the same time to engrave.
+
+def split_books(tunes, nbooks):
+    nbooks = max(1, min(nbooks, len(tunes)))
+    total = sum(len(tune[2]) for tune in tunes)
+    books = []
+    size = 0
+    for (i, tune) in enumerate(tunes):
+        # A new book when the current one has its share of the lines, or
+        # when each of the remaining tunes must start a book
+        if len(books) == 0 or (len(books) < nbooks and
+                               (size * nbooks >= total * len(books) or
+                                len(tunes) - i <= nbooks - len(books))):
+            books.append([])
+        books[-1].append(tune)
+        size += len(tune[2])
+    return books
+
+# Write a lilypond book: the version once, then a \bookpart per tune
+# (see BookPartSink)
+
+def write_book(tunes, ly_file):
+    write_ly_version(ly_file)
+    ly_file.write(r'''\book {''' "\n")
+    for (n, (refnum, lineno, lines, abc_filename)) in enumerate(tunes):
+        if n > 0:
+            ly_file.write("\n")
+        read_tune(lines, abc_filename, lineno, BookPartSink(ly_file))
+    ly_file.write("}\n")
+
+# Write a lilypond book into book_ly_filename (or to the standard output
+# if it is None or ''), through a temporary file as convert_tune_file()
+
+def write_book_file(tunes, book_ly_filename):
+    if book_ly_filename == None or book_ly_filename == '':
+        write_book(tunes, sys.stdout)
+        return
+
+    write_file(book_ly_filename, 'w', lambda ly_file: write_book(tunes, ly_file))
+
+# Convert all the tunes of ABC files (or all the tunes selected by
+# refnums) into one lilypond book ly_filename: a 300-tune tunebook is
+# engraved by one lilypond process instead of 300. With nbooks, the tunes
+# are split into nbooks books instead (see split_books()), to be
+# engraved in parallel, written to "FILE-bookK.ly" (see
+# get_book_ly_filename()).
+#
+# A syntax error in a tune stops the conversion (no book is left
+# half-written). Return the list of the written lilypond files (empty if
+# no tune was selected).
+
+def convert_book(abc_filenames, ly_filename, refnums=None, nbooks=1):
+    tunes = []
+    for abc_filename in abc_filenames:
+        with open_abc(abc_filename) as abc_file:
+            tunes.extend((refnum, lineno, lines, abc_filename)
+                         for (refnum, lineno, lines) in split_tunes(abc_file)
+                         if not refnums or refnum in refnums)
+    if len(tunes) == 0:
+        return []
+
+    books = split_books(tunes, nbooks)
+    if nbooks <= 1:
+        book_ly_filenames = [ly_filename]
+    else:
+        book_ly_filenames = [get_book_ly_filename(abc_filenames[0], ly_filename, k)
+                             for k in range(1, len(books) + 1)]
+    for (book, book_ly_filename) in zip(books, book_ly_filenames):
+        write_book_file(book, book_ly_filename)
+    return book_ly_filenames
+
+
+# ------------------------------------------------------------------------
+#     Syntax check: the tunes are parsed, nothing is written
+# ------------------------------------------------------------------------
+
+def check_tune(lines, abc_filename, lineno, errors=None):
+    tc = read_tune(lines, abc_filename, lineno, NullSink(), errors)
+    try:
+        check_time_signature(tc)
+    except AbcSyntaxError as e:
+        if errors == None:
+            raise
+        errors.append(e)
+    return tc
+
+# Check the syntax of the tunes of an ABC file (or of the tunes whose
+# reference number is in refnums), much faster than convert(): the tunes
+# are translated into events, which are neither formatted nor written.
+# A syntax error only stops the check of its tune; with recover, the
+# check resumes at the next bar (or line), and all the syntax errors of
+# the tunes are reported in one pass.
+#
+# Return the number of checked tunes and the list of the syntax errors
+# (AbcSyntaxError).
+
+def check(abc_filename, refnums=None, recover=False):
+    ntunes = 0
+    errors = []
+    with open_abc(abc_filename) as abc_file:
+        for (refnum, lineno, lines) in split_tunes(abc_file):
+            if refnums and not refnum in refnums:
+                continue
+            ntunes += 1
+            try:
+                if recover:
+                    check_tune(lines, abc_filename, lineno, errors)
+                else:
+                    check_tune(lines, abc_filename, lineno)
+            except AbcSyntaxError as e:
+                errors.append(e)
+    for e in errors:
+        if e.filename == "":
+            e.filename = abc_filename
+    return (ntunes, errors)
+
+# Check one ABC file in a worker process: job is (abc_filename, refnums,
+# recover). Return (abc_filename, number of tunes, error messages,
+# elapsed time).
+
+def check_batch_file(job):
+    (abc_filename, refnums, recover) = job
+    start = time.time()
+    try:
+        (ntunes, errors) = check(abc_filename, refnums, recover)
+        errors = [e.__str__() for e in errors]
+    except Exception as e:
+        (ntunes, errors) = (0, ['"{0}": {1}: {2}'.format(abc_filename, type(e).__name__, e)])
+    return (abc_filename, ntunes, errors, time.time() - start)
+
+# Check a list of ABC files with a pool of jobs worker processes
+# (default: one per CPU), like convert_batch(). Yield the results of
+# check_batch_file(), in the order of completion.
+
+def check_batch(abc_filenames, jobs=None, refnums=None, recover=False):
+    batch = [(abc_filename, refnums, recover) for abc_filename in abc_filenames]
+
+    if jobs == 1 or len(batch) <= 1:
+        for job in batch:
+            yield check_batch_file(job)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(check_batch_file, job) for job in batch]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+# ------------------------------------------------------------------------
+#     Fingerprints: the same tune under other titles, in other keys
+# ------------------------------------------------------------------------
+
+# The normalized form of a tune is made from its events: the pitches of
+# the notes relative to the tonic of the key (in semi-tones, from the
+# lowest octave of the tune), their durations in ticks, the bars, the
+# repeats and the alternatives. The fields of the header, the guitar
+# chords, the line breaks and the white spaces of the ABC text do not
+# count: the copies of a tune in several tunebooks, possibly transposed,
+# have the same normalized form, and the same fingerprint (its SHA-1).
+#
+# The near-duplicates (a few notes changed, a part added) are found by
+# the MinHash signatures of the shingles of the normalized forms (see
+# find_duplicates()).
+
+mc_tune_tokens = {mc_event_open_repeat:"|:", mc_event_close_repeat:":|",
+                  mc_event_begin_alternative_1:"[1", mc_event_begin_alternative_2:"[2",
+                  mc_event_end_alternative:"]"}
+mc_bar_flags = mc_flag_bar | mc_flag_double_bar | mc_flag_final_bar
+
+mc_shingle_length = 8 # tokens per shingle (about two bars)
+mc_minhash_size = 64 # values per signature
+mc_lsh_bands = 16 # bands of the signatures (of 4 values)
+
+# The hash functions of the signatures: a hash of the shingle, XOR a mask
+mc_minhash_masks = [int.from_bytes(hashlib.sha1("abc4ly minhash {0}".format(i)
+                                                .encode("utf-8")).digest()[0:8], "little")
+                    for i in range(mc_minhash_size)]
+
+# The normalized form of a tune: a list of tokens, such as "14:192" (a
+# note: relative pitch and ticks), "z:384" (a rest) or "|" (a bar), with
+# "-" after a tied note and "(" and ")" around a triplet. The list is
+# empty if the tune has no note.
+
+def get_tune_tokens(tc):
+    events = tc.events
+    tonic = 0
+    if tc.key_signature != "":
+        tonic = get_midi_pitch(mc_ly_pitch_ids[tc.key_signature.split()[1]], 0)
+    pitches = [get_midi_pitch(events.pitches[k], events.octaves[k]) - tonic
+               if events.kinds[k] == mc_event_note else None
+               for k in range(len(events))]
+    notes = [pitch for pitch in pitches if pitch != None]
+    if len(notes) == 0:
+        return []
+    lowest = min(notes) // 12 * 12
+
+    tokens = []
+    for k in range(len(events)):
+        kind = events.kinds[k]
+        flags = events.flags[k]
+        if kind == mc_event_note or kind == mc_event_rest:
+            if kind == mc_event_note:
+                token = "{0}:{1}".format(pitches[k] - lowest, events.ticks[k])
+            else:
+                token = "z:{0}".format(events.ticks[k])
+            if flags & mc_flag_triplet_begin:
+                token = "(" + token
+            if flags & mc_flag_tied:
+                token += "-"
+            if flags & mc_flag_triplet_end:
+                token += ")"
+        elif kind == mc_event_line:
+            if not flags & mc_bar_flags:
+                continue # the end of a tune without a final bar
+            token = "|"
+        else:
+            token = mc_tune_tokens[kind]
+        tokens.append(token)
+    return tokens
+
+def get_fingerprint(tokens):
+    return hashlib.sha1(" ".join(tokens).encode("utf-8")).hexdigest()
+
+# The fingerprint of a tune (None if it has no note)
+
+def get_tune_fingerprint(tc):
+    tokens = get_tune_tokens(tc)
+    if len(tokens) == 0:
+        return None
+    return get_fingerprint(tokens)
+
+# The MinHash signature of a normalized form: for each hash function, the
+# smallest hash of its shingles (the sequences of mc_shingle_length
+# tokens). The proportion of equal values of two signatures estimates the
+# similarity of the two sets of shingles (Jaccard index).
+
+def get_minhash_signature(tokens):
+    hashes = set(int.from_bytes(hashlib.blake2b(" ".join(tokens[k:k + mc_shingle_length])
+                                                .encode("utf-8"), digest_size=8).digest(),
+                                "little")
+                 for k in range(max(1, len(tokens) - mc_shingle_length + 1)))
+    return tuple(min(value ^ mask for value in hashes) for mask in mc_minhash_masks)
+
+def get_similarity(signature1, signature2):
+    return sum(1 for (value1, value2) in zip(signature1, signature2)
+               if value1 == value2) / float(mc_minhash_size)
+
+# Fingerprint the tunes of one ABC file in a worker process (a syntax
+# error only stops the parsing of its tune, see read_tune(); any other
+# failure skips its tune). Return
+# (abc_filename, tunes, errors, elapsed time), tunes being a list of
+# (lineno, refnum, title, fingerprint, signature) for the tunes with
+# notes.
+
+def fingerprint_batch_file(abc_filename):
+    start = time.time()
+    (tunes, errors) = ([], [])
+    try:
+        with open_abc(abc_filename) as abc_file:
+            for (refnum, lineno, lines) in split_tunes(abc_file):
+                try:
+                    tc = read_tune(lines, abc_filename, lineno, NullSink(), errors=[])
+                    tokens = get_tune_tokens(tc)
+                except Exception as e:
+                    errors.append('"{0}", line {1}: {2}: {3}'.format(abc_filename, lineno,
+                                                                    type(e).__name__, e))
+                    continue
+                if len(tokens) != 0:
+                    tunes.append((lineno, refnum, tc.title, get_fingerprint(tokens),
+                                  get_minhash_signature(tokens)))
+    except Exception as e:
+        errors.append('"{0}": {1}: {2}'.format(abc_filename, type(e).__name__, e))
+    return (abc_filename, tunes, errors, time.time() - start)
+
+# Fingerprint a list of ABC files with a pool of jobs worker processes
+# (default: one per CPU), like check_batch(). Yield the results of
+# fingerprint_batch_file(), in the order of completion.
+
+def fingerprint_batch(abc_filenames, jobs=None):
+    if jobs == 1 or len(abc_filenames) <= 1:
+        for abc_filename in abc_filenames:
+            yield fingerprint_batch_file(abc_filename)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(fingerprint_batch_file, abc_filename)
+                   for abc_filename in abc_filenames]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+# Find the clusters of duplicate and near-duplicate tunes of ABC files:
+# the tunes whose similarity (see get_similarity()) is at least
+# similarity, and the tunes similar to them. The tunes with the same
+# fingerprint are one cluster, without comparison: only the first one
+# (its representative) is compared with the other tunes. With the
+# locality-sensitive hashing of the signatures, a representative is only
+# compared with the first representative of each bucket where it falls
+# (the representatives with an identical band of their signatures,
+# likely above 0.5 of similarity): the search takes a linear time, even
+# for large clusters.
+#
+# Return (clusters, errors), clusters being a list of lists of
+# (abc_filename, lineno, refnum, title, fingerprint, similarity), in file
+# order, the similarity being the one of each tune with the first tune
+# of its cluster.
+
+def find_duplicates(abc_filenames, jobs=None, similarity=0.8):
+    (tunes, errors) = ([], [])
+    for (abc_filename, file_tunes, file_errors, elapsed) in fingerprint_batch(abc_filenames,
+                                                                               jobs):
+        tunes.extend((abc_filename,) + tune for tune in file_tunes)
+        errors.extend(file_errors)
+    tunes.sort()
+
+    # Union-find of the similar tunes
+    parents = list(range(len(tunes)))
+    def find_root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def union(i, j):
+        (root_i, root_j) = (find_root(i), find_root(j))
+        parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    representatives = {} # fingerprint: first tune
+    for (i, tune) in enumerate(tunes):
+        if tune[4] in representatives:
+            union(i, representatives[tune[4]])
+        else:
+            representatives[tune[4]] = i
+
+    representatives = sorted(representatives.values())
+    rows = mc_minhash_size // mc_lsh_bands
+    for band in range(mc_lsh_bands):
+        buckets = {} # band: first representative
+        for i in representatives:
+            signature = tunes[i][5]
+            j = buckets.setdefault(signature[band * rows:(band + 1) * rows], i)
+            if j != i and find_root(i) != find_root(j) and \
+               get_similarity(signature, tunes[j][5]) >= similarity:
+                union(i, j)
+
+    clusters = {}
+    for i in range(len(tunes)):
+        clusters.setdefault(find_root(i), []).append(i)
+    return ([[tunes[i][0:5] + (get_similarity(tunes[cluster[0]][5], tunes[i][5]),)
+              for i in cluster]
+             for (root, cluster) in sorted(clusters.items()) if len(cluster) > 1], errors)
+
+
+# ------------------------------------------------------------------------
+#     Incremental parsing: a tune edited line by line (e.g. in an editor)
+# ------------------------------------------------------------------------
+
+# The parser state at a line boundary: the fields of the tune context
+# that carry across the ABC lines, and the two notes of the context. The
+# fields only written to the \header block (X:, T:, C:, R:) do not change
+# the parsing of the next lines: an edit of them is not parsed further.
+mc_checkpoint_fields = [field for field in TuneContext.__slots__
+                        if not field in ("filename", "lineno", "note", "prev_note",
+                                         "events", "emitter", "errors",
+                                         "refnum", "title", "composer", "rythm")]
+
+def get_checkpoint(tc):
+    return (tuple(getattr(tc, field) for field in mc_checkpoint_fields),
+            tuple(getattr(tc.note, field) for field in Note.__slots__),
+            tuple(getattr(tc.prev_note, field) for field in Note.__slots__))
+
+def restore_checkpoint(tc, checkpoint):
+    (values, note, prev_note) = checkpoint
+    for (field, value) in zip(mc_checkpoint_fields, values):
+        setattr(tc, field, value)
+    for (field, value) in zip(Note.__slots__, note):
+        setattr(tc.note, field, value)
+    for (field, value) in zip(Note.__slots__, prev_note):
+        setattr(tc.prev_note, field, value)
+
+# An IncrementalParser keeps, for each line of a tune, the checkpoint of
+# the parser state before the line, and the events and syntax errors
+# (recovery mode) of the line. An edit re-parses the edited lines from
+# the checkpoint of the first one, and the next lines only until the
+# state after a line is the same as before the edit: the events and
+# errors of the remaining lines are kept.
+
+class IncrementalParser():
+    def __init__(self, lines, filename="", lineno=1):
+        self.filename = filename
+        self.lineno = lineno # of the first line
+        self.lines = []
+        self.checkpoints = [get_checkpoint(TuneContext(NullSink()))]
+        self.line_events = []
+        self.line_errors = []
+        self.edit(0, 0, lines)
+
+    # Parse line k from the checkpoint before it, return the checkpoint
+    # after it, the events and the errors of the line. A line being typed
+    # is often invalid: a syntax error is a diagnostic of the line (which
+    # is then ignored), never an exception.
+    def parse_line(self, k, line):
+        tc = TuneContext(NullSink())
+        restore_checkpoint(tc, self.checkpoints[k])
+        tc.filename = self.filename
+        tc.lineno = self.lineno + k
+        tc.errors = []
+        try:
+            read_line(tc, line)
+        except AbcSyntaxError as e:
+            return (self.checkpoints[k], TuneEvents(), [e])
+        return (get_checkpoint(tc), tc.events, tc.errors)
+
+    # Replace the lines [first, last) with new_lines, return the number
+    # of lines parsed again
+    def edit(self, first, last, new_lines):
+        new_lines = list(new_lines)
+        delta = len(new_lines) - (last - first)
+        old_checkpoints = self.checkpoints
+        self.lines[first:last] = new_lines
+        self.checkpoints = old_checkpoints[:first + 1]
+        del self.line_events[first:last]
+        del self.line_errors[first:last]
+        self.line_events[first:first] = [None] * len(new_lines)
+        self.line_errors[first:first] = [None] * len(new_lines)
+
+        k = first
+        while k < len(self.lines):
+            (checkpoint, events, errors) = self.parse_line(k, self.lines[k])
+            self.checkpoints.append(checkpoint)
+            self.line_events[k] = events
+            self.line_errors[k] = errors
+            k += 1
+            # Past the edited lines, stop when the state converges
+            if k >= first + len(new_lines) and checkpoint == old_checkpoints[k - delta]:
+                self.checkpoints.extend(old_checkpoints[k - delta + 1:])
+                break
+        return k - first
+
+    # The end of the tune: the last note and line, and the time signature
+    def finish(self):
+        tc = TuneContext(NullSink())
+        restore_checkpoint(tc, self.checkpoints[-1])
+        tc.filename = self.filename
+        tc.lineno = self.lineno + len(self.lines)
+        tc.errors = []
+        translate_notes(tc, "", last_line=True)
+        try:
+            check_time_signature(tc)
+        except AbcSyntaxError as e:
+            tc.errors.append(e)
+        return tc
+
+    # The events of the tune, as read by read_tune()
+    def get_events(self):
+        events = TuneEvents()
+        for line_events in self.line_events:
+            events.extend(line_events)
+        events.extend(self.finish().events)
+        return events
+
+    # The syntax errors of the tune (see check())
+    def get_errors(self):
+        errors = []
+        for (k, line_errors) in enumerate(self.line_errors):
+            for e in line_errors:
+                # The line may have moved since it was parsed
+                errors.append(AbcSyntaxError(e.what, e.filename, e.abc_line,
+                                             self.lineno + k, e.colno))
+        errors.extend(self.finish().errors)
+        return errors
+
+
+# ------------------------------------------------------------------------
+#     Batch conversion: many ABC files converted in one process pool
+# ------------------------------------------------------------------------
+
+# Expand the directories of a list of paths into the ABC files they
+# contain (like the "*.abc" wildcard of iot/Makefile)
+
+def list_abc_files(paths):
+    abc_filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(".abc"):
+                    abc_filenames.append(os.path.join(path, name))
+        else:
+            abc_filenames.append(path)
+    return abc_filenames
+
+def get_batch_ly_filename(abc_filename, ly_dirname, extension=".ly"):
+    basename = os.path.splitext(os.path.basename(abc_filename))[0]
+    return os.path.join(ly_dirname, basename + extension)
+
+# Convert one file of a batch (in a worker process). Return
+# (abc_filename, error, elapsed time), error being None on success or the
+# text of the error, with as much context as possible.
+
+def convert_batch_file(job):
+    (abc_filename, ly_filename, refnums, split, cache, midi, skip) = job
+    start = time.time()
+    error = None
+    try:
+        if convert(abc_filename, ly_filename, refnums, split, cache=cache,
+                   midi=midi, skip=skip) == None and not skip:
+            error = '"{0}": no tune found'.format(abc_filename)
+    except AbcSyntaxError as e:
+        if e.filename == "":
+            e.filename = abc_filename
+        error = e.__str__()
+    except Exception as e:
+        # Do not let a broken file abort the batch
+        error = '"{0}": {1}: {2}'.format(abc_filename, type(e).__name__, e)
+    return (abc_filename, error, time.time() - start)
+
+# Plan the deduplication of a batch (see convert_batch()): the first copy
+# of each tune body (see get_tune_body_key()), in the order of
+# abc_filenames, is converted; the other copies are written from its
+# file once the batch is converted. Only the text of the tunes is read.
+#
+# Return (skips, duplicates): skips maps an ABC file to the line numbers
+# of its duplicate tunes, duplicates is a list of (abc_filename, lineno,
+# header lines, tune_ly_filename, original_ly_filename, original
+# abc_filename).
+
+def plan_batch_duplicates(abc_filenames, ly_dirname, refnums=None):
+    (originals, skips, duplicates) = ({}, {}, [])
+    for abc_filename in dict.fromkeys(abc_filenames):
+        ly_filename = get_batch_ly_filename(abc_filename, ly_dirname)
+        try:
+            with open_abc(abc_filename) as abc_file:
+                tunes = (tune for tune in split_tunes(abc_file)
+                         if not refnums or tune[0] in refnums)
+                for (n, (refnum, lineno, lines)) in enumerate(tunes, 1):
+                    (key, header_lines) = get_tune_body_key(lines)
+                    if key == None:
+                        continue
+                    tune_ly_filename = get_tune_ly_filename(abc_filename, ly_filename,
+                                                            refnum or n)
+                    if key in originals:
+                        skips.setdefault(abc_filename, set()).add(lineno)
+                        duplicates.append((abc_filename, lineno, header_lines,
+                                           tune_ly_filename) + originals[key])
+                    else:
+                        originals[key] = (tune_ly_filename, abc_filename)
+        except Exception:
+            continue # reported by convert_batch_file()
+    return (skips, duplicates)
+
+# Convert a list of ABC files to the lilypond files
+# ly_dirname/BASENAME.ly (or to the MIDI files ly_dirname/BASENAME.mid
+# with midi) with a pool of jobs worker processes (default: one per CPU),
+# using the conversion cache if any. The largest files are
+# scheduled first, so that no big file is left alone at the end of the
+# batch.
+#
+# With dedupe and split, a tune whose body is the body of a tune of the
+# batch (in any of its ABC files) is converted once: its duplicates are
+# written from it once all the files are converted (see
+# plan_batch_duplicates()), and (tune_ly_filename, original_ly_filename)
+# is appended to duplicates, if any. A duplicate of a tune whose ABC
+# file failed is a failure of its own ABC file. The MIDI files are
+# always converted (see convert()).
+#
+# Yield (abc_filename, error, elapsed time) for each file, in the order
+# of completion (see convert_batch_file()); with duplicates to write, once
+# they are written. A failure does not stop the batch. An ABC file with
+# the name of a previous ABC file (in another directory) is a failure: it
+# would overwrite its output file.
+
+def convert_batch(abc_filenames, ly_dirname, jobs=None, refnums=None, split=False,
+                  cache=None, midi=False, dedupe=False, duplicates=None):
+    if not os.path.isdir(ly_dirname):
+        os.makedirs(ly_dirname)
+
+    if midi:
+        extension = ".mid"
+    else:
+        extension = ".ly"
+
+    # The ABC files of two directories with the same name would write the
+    # same output file: only the first one is converted, the others fail
+    (owners, collisions) = ({}, set())
+    for abc_filename in abc_filenames:
+        ly_filename = get_batch_ly_filename(abc_filename, ly_dirname, extension)
+        owner = owners.setdefault(ly_filename, abc_filename)
+        if os.path.realpath(owner) != os.path.realpath(abc_filename):
+            collisions.add(abc_filename)
+            yield (abc_filename, '"{0}": same output file {1} as "{2}"'.format(
+                abc_filename, ly_filename, owner), 0.0)
+    if len(collisions) != 0:
+        abc_filenames = [abc_filename for abc_filename in abc_filenames
+                         if not abc_filename in collisions]
+
+    sizes = {}
+    for abc_filename in abc_filenames:
+        try:
+            sizes[abc_filename] = os.path.getsize(abc_filename)
+        except OSError:
+            sizes[abc_filename] = 0 # reported by convert_batch_file()
+    (skips, batch_duplicates) = ({}, [])
+    if dedupe and split and not midi:
+        (skips, batch_duplicates) = plan_batch_duplicates(abc_filenames, ly_dirname, refnums)
+    batch = [(abc_filename, get_batch_ly_filename(abc_filename, ly_dirname, extension),
+              refnums, split, cache, midi, skips.get(abc_filename))
+             for abc_filename in sorted(abc_filenames, key=sizes.get, reverse=True)]
+
+    if len(batch_duplicates) == 0:
+        for result in convert_batch_jobs(batch, jobs):
+            yield result
+        return
+
+    results = list(convert_batch_jobs(batch, jobs))
+    errors = dict((abc_filename, error) for (abc_filename, error, elapsed) in results)
+    for (abc_filename, lineno, header_lines, tune_ly_filename, original_ly_filename,
+         original_abc_filename) in batch_duplicates:
+        error = None
+        if errors[original_abc_filename] != None:
+            error = '"{0}", line {1}: duplicate of {2}, not converted'.format(
+                abc_filename, lineno, original_ly_filename)
+        else:
+            try:
+                write_duplicate_tune_file(header_lines, abc_filename, lineno,
+                                          tune_ly_filename, original_ly_filename)
+            except Exception as e:
+                error = '"{0}", line {1}: {2}: {3}'.format(abc_filename, lineno,
+                                                            type(e).__name__, e)
+        if error == None:
+            if duplicates != None:
+                duplicates.append((tune_ly_filename, original_ly_filename))
+        elif errors[abc_filename] == None:
+            errors[abc_filename] = error
+    for (abc_filename, error, elapsed) in results:
+        yield (abc_filename, errors[abc_filename], elapsed)
+
+# Run the jobs of convert_batch(): yield the results of
+# convert_batch_file(), in the order of completion
+
+def convert_batch_jobs(batch, jobs=None):
+    if jobs == 1 or len(batch) <= 1:
+        for job in batch:
+            yield convert_batch_file(job)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(convert_batch_file, job) for job in batch]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+# ------------------------------------------------------------------------
+#     Engraving: the lilypond files compiled by a pool of lilypond
+#     processes
+# ------------------------------------------------------------------------
+
+mc_artifact_extensions = (".pdf", ".midi", ".mid")
+mc_lilypond_output_lines = 20 # lines of the output of a failed lilypond kept
+
+def get_default_lilypond():
+    return os.environ.get("ABC4LY_LILYPOND") or "lilypond"
+
+# An on-disk cache of the artifacts of lilypond (the PDF and MIDI files),
+# addressed by the SHA-1 of the lilypond command and of the lilypond
+# text: a lilypond file whose text did not change is not engraved again,
+# even if it was written again (e.g. after its ABC file was touched).
+#
+# An entry is a directory of the artifacts, named as lilypond names them
+# after "out" (out.pdf, out.midi, out-1.midi in a book...). As in
+# ConversionCache, the least recently used entries are evicted when the
+# cache grows over max_size bytes.
+
+class ArtifactCache():
+    def __init__(self, dirname=None, max_size=500 * 1024 * 1024):
+        if dirname == None:
+            dirname = os.path.join(get_default_cache_dirname(), "artifacts")
+        self.dirname = dirname
+        self.max_size = max_size
+        self.size = None # estimated size of the cache, computed on demand
+
+    def get_key(self, ly_data, lilypond):
+        sha1 = hashlib.sha1()
+        sha1.update("{0}\n".format(lilypond).encode("utf-8"))
+        sha1.update(ly_data)
+        return sha1.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.dirname, key[0:2], key)
+
+    # Return the paths of the cached artifacts, or None
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            artifacts = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+            os.utime(path) # the most recently used entry
+        except (IOError, OSError):
+            return None
+        return artifacts
+
+    def put(self, key, artifacts):
+        path = self.get_path(key)
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        size = 0
+        try:
+            os.makedirs(tmp_path)
+            for artifact in artifacts:
+                shutil.copyfile(artifact, os.path.join(tmp_path, os.path.basename(artifact)))
+                size += os.path.getsize(artifact)
+            os.replace(tmp_path, path)
+        except (IOError, OSError):
+            # A cache that cannot be written is just not used (or the
+            # entry was put by another process)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+
+        if self.size == None:
+            self.size = sum(size for (mtime, size, path) in self.list_entries())
+        else:
+            self.size += size
+        if self.size > self.max_size:
+            self.evict()
+
+    def list_entries(self):
+        entries = []
+        try:
+            prefixes = os.listdir(self.dirname)
+        except OSError:
+            return entries
+        for prefix in prefixes:
+            try:
+                keys = os.listdir(os.path.join(self.dirname, prefix))
+            except OSError:
+                continue
+            for key in keys:
+                path = os.path.join(self.dirname, prefix, key)
+                if path.endswith(".tmp"):
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(path, name))
+                               for name in os.listdir(path))
+                    entries.append((os.stat(path).st_mtime_ns, size, path))
+                except OSError:
+                    continue # evicted by another process
+        return entries
+
+    # Remove the least recently used entries, down to 3/4 of max_size
+    def evict(self):
+        entries = sorted(self.list_entries())
+        self.size = sum(size for (mtime, size, path) in entries)
+        for (mtime, size, path) in entries:
+            if self.size <= self.max_size * 3 // 4:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            self.size -= size
+
+# The artifacts of an engraving, moved (or copied from the cache) next to
+# the lilypond file: "out.pdf" is "tune.pdf" for "tune.ly"
+
+def install_artifacts(artifacts, ly_filename, copy=False):
+    root = os.path.splitext(ly_filename)[0]
+    for artifact in artifacts:
+        target = root + os.path.basename(artifact)[len("out"):]
+        if copy:
+            tmp_target = "{0}.{1}.tmp".format(target, os.getpid())
+            shutil.copyfile(artifact, tmp_target)
+            os.replace(tmp_target, target)
+        else:
+            os.replace(artifact, target)
+
+# The lilypond files written by convert() with split (see
+# get_tune_ly_filename())
+
+def get_split_ly_filenames(abc_filename, ly_filename, refnums=None):
+    with open_abc(abc_filename) as abc_file:
+        tunes = [tune for tune in split_tunes(abc_file) if not refnums or tune[0] in refnums]
+    return [get_tune_ly_filename(abc_filename, ly_filename, refnum or n)
+            for (n, (refnum, lineno, lines)) in enumerate(tunes, 1)]
+
+# Engrave one lilypond file (in a worker thread): lilypond runs in a
+# temporary directory next to the lilypond file, so that a failure does
+# not leave partial artifacts behind. Return (ly_filename, error, elapsed
+# time, cached), error being None on success or the text of the error
+# (with the end of the output of lilypond), and cached True if the
+# artifacts were found in the cache.
+
+def engrave_file(job):
+    (ly_filename, lilypond, cache) = job
+    start = time.time()
+    (error, cached) = (None, False)
+    try:
+        with open(ly_filename, 'rb') as ly_file:
+            ly_data = ly_file.read()
+        artifacts = None
+        if cache != None:
+            key = cache.get_key(ly_data, lilypond)
+            artifacts = cache.get(key)
+        if artifacts != None:
+            install_artifacts(artifacts, ly_filename, copy=True)
+            cached = True
+        else:
+            tmp_dirname = tempfile.mkdtemp(prefix=".engrave-",
+                                           dir=os.path.dirname(ly_filename) or ".")
+            try:
+                process = subprocess.run([lilypond, "-o", os.path.join(tmp_dirname, "out"),
+                                          ly_filename],
+                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                if process.returncode != 0:
+                    output = process.stdout.decode("utf-8", "replace").splitlines()
+                    error = '"{0}": {1} failed with exit code {2}'.format(
+                        ly_filename, lilypond, process.returncode)
+                    error = "\n".join([error] + output[-mc_lilypond_output_lines:])
+                else:
+                    artifacts = [os.path.join(tmp_dirname, name)
+                                 for name in sorted(os.listdir(tmp_dirname))
+                                 if name.endswith(mc_artifact_extensions)]
+                    if cache != None:
+                        cache.put(key, artifacts)
+                    install_artifacts(artifacts, ly_filename)
+            finally:
+                shutil.rmtree(tmp_dirname, ignore_errors=True)
+    except (IOError, OSError) as e:
+        error = '"{0}": {1}'.format(ly_filename, e)
+    return (ly_filename, error, time.time() - start, cached)
+
+# Engrave lilypond files with a pool of jobs lilypond processes (default:
+# one per CPU), using the artifact cache if any (see ArtifactCache). The
+# largest files are scheduled first, as in convert_batch(). The lilypond
+# processes do the work: the pool is a pool of threads waiting for them.
+#
+# Yield (ly_filename, error, elapsed time, cached, queued) for each file,
+# in the order of completion (see engrave_file()), queued being the
+# number of files still waiting for a lilypond process.
+
+def engrave_batch(ly_filenames, jobs=None, lilypond=None, cache=None):
+    if lilypond == None:
+        lilypond = get_default_lilypond()
+    if jobs == None:
+        jobs = os.cpu_count() or 1
+
+    sizes = {}
+    for ly_filename in ly_filenames:
+        try:
+            sizes[ly_filename] = os.path.getsize(ly_filename)
+        except OSError:
+            sizes[ly_filename] = 0 # reported by engrave_file()
+    batch = [(ly_filename, lilypond, cache)
+             for ly_filename in sorted(ly_filenames, key=sizes.get, reverse=True)]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(engrave_file, job) for job in batch]
+        for (n, future) in enumerate(concurrent.futures.as_completed(futures), 1):
+            yield future.result() + (max(0, len(batch) - n - jobs),)
+
+
+# ------------------------------------------------------------------------
+#     Watch mode: the ABC files are converted again when they change
+# ------------------------------------------------------------------------
+
+# A Watcher polls the ABC files of paths (files or directories, see
+# list_abc_files()) and converts them into ly_dirname, like the batch
+# conversion, when they change. There is no portable file notification
+# in the standard library: the files are polled (os.stat()), which costs
+# little for a tunebook directory.
+#
+# A changed file is converted once it has not changed for debounce
+# seconds: a burst of saves gives one conversion. Only the tunes whose
+# text changed are converted again (the SHA-1 of the lines of each tune
+# is kept), and the files are written atomically (see
+# convert_tune_file()).
+
+class Watcher():
+    def __init__(self, paths, ly_dirname, split=False, cache=None, midi=False,
+                 debounce=0.3):
+        self.paths = paths
+        self.ly_dirname = ly_dirname
+        self.split = split
+        self.cache = cache
+        self.midi = midi
+        self.debounce = debounce
+        self.stats = {} # abc_filename: (mtime, size) when last seen
+        self.changes = {} # abc_filename: time of the last change seen
+        self.tune_sha1s = {} # tune_ly_filename: SHA-1 of the converted lines
+
+    # Find the files that changed since the last scan
+    def scan(self, now):
+        stats = {}
+        for abc_filename in list_abc_files(self.paths):
+            try:
+                stat = os.stat(abc_filename)
+            except OSError:
+                continue # removed
+            stats[abc_filename] = (stat.st_mtime_ns, stat.st_size)
+            if self.stats.get(abc_filename) != stats[abc_filename]:
+                self.changes[abc_filename] = now
+        for abc_filename in list(self.changes):
+            if not abc_filename in stats:
+                del self.changes[abc_filename]
+        self.stats = stats
+
+    # Scan the files and convert the files that did not change for
+    # debounce seconds. Return a list of (tune_ly_filename, error) for
+    # the converted tunes.
+    def poll(self, now=None):
+        if now == None:
+            now = time.time()
+        self.scan(now)
+        results = []
+        for (abc_filename, changed) in sorted(self.changes.items()):
+            if now - changed >= self.debounce:
+                del self.changes[abc_filename]
+                results.extend(self.convert_file(abc_filename))
+        return results
+
+    def convert_file(self, abc_filename):
+        if self.midi:
+            extension = ".mid"
+        else:
+            extension = ".ly"
+        ly_filename = get_batch_ly_filename(abc_filename, self.ly_dirname, extension)
+        results = []
+        try:
+            with open_abc(abc_filename) as abc_file:
+                tunes = list(split_tunes(abc_file))
+        except Exception as e:
+            # e.g. removed, or not UTF-8: the watcher goes on
+            return [(ly_filename, '"{0}": {1}: {2}'.format(abc_filename, type(e).__name__,
+                                                            e))]
+        if not self.split:
+            tunes = tunes[:1]
+
+        for (n, (refnum, lineno, lines)) in enumerate(tunes, 1):
+            if self.split:
+                tune_ly_filename = get_tune_ly_filename(abc_filename, ly_filename,
+                                                        refnum or n, extension)
+            else:
+                tune_ly_filename = ly_filename
+
+            sha1 = hashlib.sha1("".join(lines).encode("utf-8", "surrogateescape"))
+            if self.tune_sha1s.get(tune_ly_filename) == sha1.hexdigest():
+                continue # this tune did not change
+
+            error = None
+            try:
+                convert_tune_file(lines, abc_filename, lineno, tune_ly_filename,
+                                  self.cache, self.midi)
+                self.tune_sha1s[tune_ly_filename] = sha1.hexdigest()
+            except AbcSyntaxError as e:
+                if e.filename == "":
+                    e.filename = abc_filename
+                error = e.__str__()
+                self.tune_sha1s.pop(tune_ly_filename, None)
+            except Exception as e:
+                # Do not let a broken tune (or a failed write) stop the
+                # watcher, like convert_batch_file()
+                error = '"{0}", line {1}: {2}: {3}'.format(abc_filename, lineno,
+                                                            type(e).__name__, e)
+                self.tune_sha1s.pop(tune_ly_filename, None)
+            results.append((tune_ly_filename, error))
+        return results
+
+    # Convert the files as they change, until interrupted
+    def run(self, interval=0.2, file=sys.stderr):
+        if not os.path.isdir(self.ly_dirname):
+            os.makedirs(self.ly_dirname)
+        while True:
+            for (tune_ly_filename, error) in self.poll():
+                if error == None:
+                    print("{0}: {1} written".format(time.strftime("%H:%M:%S"),
+                                                     tune_ly_filename), file=file)
+                else:
+                    print(error, file=file)
+            time.sleep(interval)
+
+
+# ------------------------------------------------------------------------
+#     Profiling: where the time of the translation goes
+# ------------------------------------------------------------------------
+
+# A TuneProfiler counts the transitions into each state of
+# translate_notes() (tc.state) and accumulates the time spent in each
+# state, in the tokenizer (mc_token_regex.match), in the helpers of
+# mc_profiled_helpers and in each tune read by read_tune():
+#
+#     with TuneProfiler() as profiler:
+#         convert(abc_filename, ly_filename)
+#     profiler.print_report()
+#
+# The module is instrumented only while a profiler is active: tc.state
+# (a slot of TuneContext) is replaced with a counting property and the
+# helpers with timed wrappers, restored by stop(). Without profiler,
+# nothing is measured and nothing is slowed down. The helpers are the
+# ones called while converting: the translation of the notes, the
+# emitter and the information fields (the pitch dictionaries, for
+# instance, are computed once, when the module is imported).
+#
+# The time of a state is the time from the transition into the state to
+# the next transition (within translate_notes()): it includes the time
+# of the helpers called by the state handler.
+
+mc_profiled_helpers = [("TuneContext", "dump_note"),
+                       ("TuneContext", "flush_line"),
+                       ("LilypondEmitter", "emit"),
+                       ("LilypondEmitter", "emit_line"),
+                       ("LilypondEmitter", "close"),
+                       (None, "read_info_line"),
+                       (None, "normalize_time_signature"),
+                       (None, "get_default_note_duration"),
+                       (None, "translate_key_signature")]
+
+mc_active_profiler = None
+
+class TuneProfiler():
+    def __init__(self):
+        self.state_counts = {}
+        self.state_times = {}
+        self.helper_counts = {}
+        self.helper_times = {}
+        self.tunes = [] # (filename, refnum, lineno, seconds, events) per tune
+        self.state_start = None # while in translate_notes()
+        self.patches = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        global mc_active_profiler
+        if mc_active_profiler != None:
+            raise RuntimeError("A TuneProfiler is already active")
+        mc_active_profiler = self
+
+        module = sys.modules[__name__]
+        slot = TuneContext.__dict__["state"]
+        self.patch(TuneContext, "state", property(slot.__get__, self.get_state_setter(slot)))
+        self.patch(module, "translate_notes", self.get_translate_notes(slot))
+        self.patch(module, "read_tune", self.get_read_tune())
+        # A compiled regular expression cannot be patched: the tokenizer
+        # is replaced with an object whose match() is timed
+        self.patch(module, "mc_token_regex",
+                   types.SimpleNamespace(match=self.get_helper("mc_token_regex.match",
+                                                               mc_token_regex.match)))
+        for (class_name, name) in mc_profiled_helpers:
+            if class_name == None:
+                owner = module
+            else:
+                owner = getattr(module, class_name)
+            self.patch(owner, name, self.get_helper(name, getattr(owner, name)))
+
+    def stop(self):
+        global mc_active_profiler
+        for (owner, name, value) in reversed(self.patches):
+            setattr(owner, name, value)
+        self.patches = []
+        mc_active_profiler = None
+
+    def patch(self, owner, name, value):
+        # The class attribute itself (e.g. the slot descriptor), not the
+        # value it gives
+        if isinstance(owner, type):
+            original = owner.__dict__[name]
+        else:
+            original = getattr(owner, name)
+        self.patches.append((owner, name, original))
+        setattr(owner, name, value)
+
+    def add_state_time(self, state, seconds):
+        self.state_times[state] = self.state_times.get(state, 0.0) + seconds
+
+    def get_state_setter(self, slot):
+        def set_state(tc, state):
+            if self.state_start != None:
+                now = time.perf_counter()
+                self.add_state_time(slot.__get__(tc), now - self.state_start)
+                self.state_counts[state] = self.state_counts.get(state, 0) + 1
+                self.state_start = now
+            slot.__set__(tc, state)
+        return set_state
+
+    def get_translate_notes(self, slot):
+        translate_notes = self.get_helper("translate_notes",
+                                          sys.modules[__name__].translate_notes)
+        def profiled_translate_notes(tc, abc_line, last_line=True):
+            self.state_start = time.perf_counter()
+            try:
+                translate_notes(tc, abc_line, last_line)
+            finally:
+                self.add_state_time(slot.__get__(tc), time.perf_counter() - self.state_start)
+                self.state_start = None
+        return profiled_translate_notes
+
+    def get_read_tune(self):
+        read_tune = sys.modules[__name__].read_tune
+        def profiled_read_tune(lines, filename="", lineno=1, sink=None, errors=None):
+            start = time.perf_counter()
+            tc = read_tune(lines, filename, lineno, sink, errors)
+            self.tunes.append((filename, tc.refnum, lineno, time.perf_counter() - start,
+                               len(tc.events)))
+            return tc
+        return profiled_read_tune
+
+    def get_helper(self, name, function):
+        def profiled_helper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.helper_times[name] = self.helper_times.get(name, 0.0) + \
+                                          time.perf_counter() - start
+                self.helper_counts[name] = self.helper_counts.get(name, 0) + 1
+        return profiled_helper
+
+    def get_report(self):
+        return {"states":dict((state, {"count":self.state_counts.get(state, 0),
+                                       "seconds":self.state_times[state]})
+                              for state in self.state_times),
+                "helpers":dict((name, {"count":self.helper_counts[name],
+                                       "seconds":self.helper_times[name]})
+                               for name in self.helper_counts),
+                "tunes":[{"filename":filename, "refnum":refnum, "lineno":lineno,
+                          "seconds":seconds, "events":events}
+                         for (filename, refnum, lineno, seconds, events) in self.tunes]}
+
+    def dump_json(self, filename):
+        with open(filename, "w") as json_file:
+            json.dump(self.get_report(), json_file, indent=2, sort_keys=True)
+
+    # The statistics in the format of the profile module (see pstats):
+    # {(filename, lineno, name): (calls, calls, time, cumulative time,
+    # callers)}. The states are "state:NAME" functions.
+
+    def get_stats(self):
+        filename = os.path.basename(__file__)
+        stats = {}
+        for (state, seconds) in self.state_times.items():
+            count = self.state_counts.get(state, 0)
+            stats[(filename, 0, "state:" + state)] = (count, count, seconds, seconds, {})
+        for (name, seconds) in self.helper_times.items():
+            count = self.helper_counts[name]
+            stats[(filename, 0, name)] = (count, count, seconds, seconds, {})
+        return stats
+
+    def dump_stats(self, filename):
+        with open(filename, "wb") as stats_file:
+            marshal.dump(self.get_stats(), stats_file)
+
+    def print_report(self, file=sys.stderr, ntunes=10):
+        total = sum(self.state_times.values()) or 1.0
+        print("{0:24} {1:>10} {2:>10} {3:>6}".format("State", "Count", "Time (s)", "%"),
+              file=file)
+        for state in sorted(self.state_times, key=self.state_times.get, reverse=True):
+            print("{0:24} {1:10} {2:10.4f} {3:6.1f}".format(
+                state, self.state_counts.get(state, 0), self.state_times[state],
+                100 * self.state_times[state] / total), file=file)
+        print("", file=file)
+        print("{0:24} {1:>10} {2:>10}".format("Helper", "Calls", "Time (s)"), file=file)
+        for name in sorted(self.helper_times, key=self.helper_times.get, reverse=True):
+            print("{0:24} {1:10} {2:10.4f}".format(name, self.helper_counts[name],
+                                                  self.helper_times[name]), file=file)
+        print("", file=file)
+        print("{0} tunes, {1:.4f} s; the slowest:".format(
+            len(self.tunes), sum(tune[3] for tune in self.tunes)), file=file)
+        for (filename, refnum, lineno, seconds, events) in \
+            sorted(self.tunes, key=lambda tune: tune[3], reverse=True)[:ntunes]:
+            print("    {0}:{1} (X:{2}): {3:.4f} s, {4} events".format(
+                filename, lineno, refnum, seconds, events), file=file)
+
 
 # ------------------------------------------------------------------------
 #     The main program
@@ -906,8 +3535,292 @@ melody = {
 # ------------------------------------------------------------------------
 
 if __name__ == '__main__':
-    parser = optparse.OptionParser()
+    parser = optparse.OptionParser(version="%prog " + __version__, usage="%prog [options] ABC_FILE\n"
+                                   "       %prog [options] -d DIR ABC_FILE|ABC_DIR...\n"
+                                   "       %prog [options] --book [-o FILE] ABC_FILE|ABC_DIR...\n"
+                                   "       %prog [options] --duplicates ABC_FILE|ABC_DIR...")
     parser.add_option("-o", "--output", dest="filename",
                       help="write output to FILE (default: standard output)", metavar="FILE")
+    parser.add_option("-x", "--refnum", dest="refnums", action="append",
+                      help="convert the tune whose reference number (X:) is REFNUM "
+                      "(default: the first tune); can be repeated with --split",
+                      metavar="REFNUM")
+    parser.add_option("-s", "--split", dest="split", action="store_true", default=False,
+                      help="convert every tune to its own file: FILE-REFNUM.ly")
+    parser.add_option("-m", "--midi", dest="midi", action="store_true", default=False,
+                      help="write MIDI files (.mid) instead of lilypond files")
+    parser.add_option("-b", "--book", dest="book", action="store_true", default=False,
+                      help="write all the tunes of the ABC files (and of the ABC files "
+                      "of the directories), or the tunes selected with -x, into one "
+                      "lilypond book, engraved by one lilypond process")
+    parser.add_option("--books", dest="nbooks", type="int", default=1,
+                      help="with --book, split the tunes into N books FILE-bookK.ly, to "
+                      "be engraved in parallel", metavar="N")
+    parser.add_option("--dedupe", dest="dedupe", action="store_true", default=False,
+                      help="with --split, convert once the tunes with the same notes "
+                      "(and the same M:, L: and K: fields) in all the ABC files: the "
+                      "file of a duplicate is its own header followed by the melody of "
+                      "the first copy")
+    parser.add_option("--duplicates", dest="duplicates", action="store_true", default=False,
+                      help="list the duplicate and near-duplicate tunes of the ABC files "
+                      "(and of the ABC files of the directories), in any key, whatever "
+                      "their titles: nothing is written")
+    parser.add_option("--similarity", dest="similarity", type="float", default=0.8,
+                      help="with --duplicates, the minimum similarity of the "
+                      "near-duplicates, from 0 to 1 (default: 0.8)", metavar="RATIO")
+    parser.add_option("-l", "--list", dest="list", action="store_true", default=False,
+                      help="list the tunes of the ABC files (and of the ABC files of the "
+                      "directories) from the catalog of their headers, refreshed for the "
+                      "files that changed; without ABC file, all the tunes of the catalog")
+    parser.add_option("-q", "--query", dest="queries", action="append",
+                      help="list the tunes (see --list) whose FIELD (title, composer, "
+                      "rhythm, meter, key or refnum) is VALUE (a part of it for the title "
+                      "and the composer); can be repeated", metavar="FIELD=VALUE")
+    parser.add_option("-f", "--fragment", dest="fragment",
+                      help="list the tunes (see --list) whose melody contains FRAGMENT, a "
+                      "few bars in ABC format, in any key and any octave: the best "
+                      "matches first", metavar="FRAGMENT")
+    parser.add_option("--fragment-key", dest="fragment_key", default="C",
+                      help="the key signature of the fragment (default: C)", metavar="KEY")
+    parser.add_option("--catalog", dest="catalog_filename",
+                      help="catalog of the tunes (default: catalog.sqlite in the cache "
+                      "directory)", metavar="FILE")
+    parser.add_option("-c", "--check", dest="check", action="store_true", default=False,
+                      help="only check the syntax of the ABC files (or of the tunes "
+                      "selected with -x): nothing is written")
+    parser.add_option("-k", "--keep-going", dest="recover", action="store_true",
+                      default=False, help="with --check, resume after a syntax error "
+                      "at the next bar: report all the syntax errors")
+    parser.add_option("--no-index", dest="use_index", action="store_false", default=True,
+                      help="do not use (nor create) the FILE.idx index to find the tunes")
+    parser.add_option("-d", "--output-dir", dest="dirname",
+                      help="batch mode: convert all the ABC files (and the ABC files of "
+                      "the directories) given on the command line to DIR/NAME.ly",
+                      metavar="DIR")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="batch mode: number of worker processes "
+                      "(default: number of CPUs)", metavar="N")
+    parser.add_option("-w", "--watch", dest="watch", action="store_true", default=False,
+                      help="watch mode: convert the ABC files (and the ABC files of the "
+                      "directories) to DIR/NAME.ly (see -d) again when they change, "
+                      "until interrupted")
+    parser.add_option("--debounce", dest="debounce", type="float", default=0.3,
+                      help="watch mode: convert a file once it did not change for "
+                      "SECONDS (default: 0.3)", metavar="SECONDS")
+    parser.add_option("-e", "--engrave", dest="engrave", action="store_true", default=False,
+                      help="engrave the written lilypond files to PDF with a pool of "
+                      "lilypond processes (see -j); a lilypond file whose text did not "
+                      "change is not engraved again")
+    parser.add_option("--lilypond", dest="lilypond",
+                      help="lilypond command (default: $ABC4LY_LILYPOND or lilypond)",
+                      metavar="COMMAND")
+    parser.add_option("--no-cache", dest="use_cache", action="store_false", default=True,
+                      help="do not use the conversion and engraving caches")
+    parser.add_option("--cache-dir", dest="cache_dirname",
+                      help="conversion cache directory (default: $ABC4LY_CACHE_DIR or "
+                      "~/.cache/abc4ly), the engraving cache being DIR/artifacts",
+                      metavar="DIR")
+    parser.add_option("--profile", dest="profile", action="store_true", default=False,
+                      help="print the time spent in the states of the parser, in its "
+                      "helpers and in each tune (without cache, in one process)")
+    parser.add_option("--profile-output", dest="profile_filename",
+                      help="profile (see --profile) and save the profile into FILE: as "
+                      "JSON if FILE ends with .json, for pstats otherwise", metavar="FILE")
     (options, args) = parser.parse_args()
-    convert(args[0], options.filename)
+    if options.queries or options.fragment:
+        options.list = True
+    if len(args) == 0 and not options.list:
+        parser.error("no ABC file")
+
+    cache = None
+    if options.profile_filename != None:
+        options.profile = True
+    if options.use_cache and not options.profile:
+        cache = ConversionCache(options.cache_dirname)
+    if options.engrave and (options.watch or options.check or options.midi):
+        parser.error("--engrave cannot be used with --watch, --check or --midi")
+    if options.dedupe and not options.split:
+        parser.error("--dedupe needs --split")
+
+    # The tunes are profiled in this process
+    profiler = None
+    if options.profile:
+        options.jobs = 1
+        profiler = TuneProfiler()
+        profiler.start()
+
+    ly_filenames = [] # the lilypond files to engrave
+    failed = False
+    try:
+        if options.watch:
+            if options.filename:
+                parser.error("-o cannot be used with --watch: use -d")
+            watcher = Watcher(args, options.dirname or ".", options.split, cache,
+                              options.midi, options.debounce)
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                pass
+        elif options.list:
+            criteria = {}
+            for query in options.queries or []:
+                (field, sep, value) = query.partition("=")
+                if sep == "" or not field in mc_catalog_fields:
+                    parser.error("invalid query: {0}".format(query))
+                criteria[field] = value
+            catalog = TuneCatalog(options.catalog_filename or
+                                  os.path.join(options.cache_dirname or
+                                               get_default_cache_dirname(),
+                                               "catalog.sqlite"))
+            try:
+                abc_filenames = None
+                if len(args) != 0:
+                    abc_filenames = list_abc_files(args)
+                    catalog.update(abc_filenames, melodies=options.fragment != None)
+                if options.fragment != None:
+                    matches = catalog.find_fragment(options.fragment, options.fragment_key,
+                                                    abc_filenames)
+                else:
+                    tunes = catalog.find(abc_filenames, **criteria)
+            except AbcSyntaxError as e:
+                parser.error("invalid query: {0}".format(e.what))
+            except ValueError as e:
+                parser.error(e)
+            finally:
+                catalog.close()
+            if options.fragment != None:
+                for (score, filename, lineno, refnum, title) in matches:
+                    print("{0:4.0%} {1}:{2}: X:{3} {4}".format(
+                        score, os.path.relpath(filename), lineno, refnum, title))
+            else:
+                for (filename, lineno, refnum, title, composer, rhythm, meter, key, offset,
+                     length) in tunes:
+                    print("{0}:{1}: X:{2} {3} ({4})".format(
+                        os.path.relpath(filename), lineno, refnum, title,
+                        ", ".join(field for field in [composer, rhythm, meter, key]
+                                  if field)))
+        elif options.duplicates:
+            (clusters, errors) = find_duplicates(list_abc_files(args), options.jobs,
+                                                 options.similarity)
+            for error in errors:
+                print(error, file=sys.stderr)
+            for cluster in clusters:
+                for (abc_filename, lineno, refnum, title, fingerprint, similarity) in cluster:
+                    if fingerprint == cluster[0][4]:
+                        same = "same"
+                    else:
+                        same = "{0:.0%}".format(similarity)
+                    print("{0:>4} {1}:{2}: X:{3} {4}".format(
+                        same, os.path.relpath(abc_filename), lineno, refnum, title))
+                print()
+            print("{0} clusters of duplicate tunes".format(len(clusters)), file=sys.stderr)
+        elif options.check:
+            (ntunes, n_errors) = (0, 0)
+            abc_filenames = list_abc_files(args)
+            for (abc_filename, n, errors, elapsed) in check_batch(abc_filenames,
+                                                                  options.jobs,
+                                                                  options.refnums,
+                                                                  options.recover):
+                ntunes += n
+                for error in errors:
+                    print(error, file=sys.stderr)
+                n_errors += len(errors)
+            print("{0} tunes checked in {1} ABC files, {2} errors".format(
+                ntunes, len(abc_filenames), n_errors), file=sys.stderr)
+            if n_errors != 0:
+                sys.exit(1)
+        elif options.book or options.nbooks > 1:
+            if options.midi:
+                parser.error("--midi cannot be used with --book")
+            if options.nbooks > 1 and not options.filename:
+                parser.error("--books needs -o")
+            if options.engrave and not options.filename:
+                parser.error("--engrave needs -o")
+            ly_filenames = convert_book(list_abc_files(args), options.filename,
+                                        options.refnums, options.nbooks)
+            if len(ly_filenames) == 0:
+                print("no tune found", file=sys.stderr)
+                sys.exit(1)
+        elif options.dirname == None and len(args) == 1 and not os.path.isdir(args[0]):
+            if options.engrave and not options.filename:
+                parser.error("--engrave needs -o")
+            duplicates = []
+            if convert(args[0], options.filename, options.refnums, options.split,
+                       options.use_index, cache, options.midi, options.dedupe,
+                       duplicates) == None:
+                print("{0}: no tune found".format(args[0]), file=sys.stderr)
+                sys.exit(1)
+            for (tune_ly_filename, original_ly_filename) in duplicates:
+                print("{0}: duplicate of {1}".format(tune_ly_filename, original_ly_filename),
+                      file=sys.stderr)
+            if options.split:
+                ly_filenames = get_split_ly_filenames(args[0], options.filename,
+                                                      options.refnums)
+            else:
+                ly_filenames = [options.filename]
+        else:
+            if options.filename:
+                parser.error("-o cannot be used with several ABC files: use -d")
+            n_errors = 0
+            duplicates = []
+            abc_filenames = list_abc_files(args)
+            for (abc_filename, error, elapsed) in convert_batch(abc_filenames,
+                                                                options.dirname or ".",
+                                                                options.jobs,
+                                                                options.refnums,
+                                                                options.split,
+                                                                cache,
+                                                                options.midi,
+                                                                options.dedupe,
+                                                                duplicates):
+                if error != None:
+                    print(error, file=sys.stderr)
+                    n_errors += 1
+                elif options.split:
+                    ly_filenames.extend(get_split_ly_filenames(abc_filename,
+                                                               get_batch_ly_filename(
+                                                                   abc_filename,
+                                                                   options.dirname or "."),
+                                                               options.refnums))
+                else:
+                    ly_filenames.append(get_batch_ly_filename(abc_filename,
+                                                              options.dirname or "."))
+            for (tune_ly_filename, original_ly_filename) in duplicates:
+                print("{0}: duplicate of {1}".format(tune_ly_filename, original_ly_filename),
+                      file=sys.stderr)
+            print("{0} ABC files converted, {1} failed".format(len(abc_filenames) - n_errors,
+                                                              n_errors), file=sys.stderr)
+            failed = n_errors != 0
+
+        if options.engrave:
+            artifact_cache = None
+            if options.use_cache:
+                artifact_cache = ArtifactCache(os.path.join(options.cache_dirname or
+                                                            get_default_cache_dirname(),
+                                                            "artifacts"))
+            (n_cached, n_errors) = (0, 0)
+            for (ly_filename, error, elapsed, cached, queued) in engrave_batch(
+                    ly_filenames, options.jobs, options.lilypond, artifact_cache):
+                if error != None:
+                    print(error, file=sys.stderr)
+                    n_errors += 1
+                    continue
+                if cached:
+                    n_cached += 1
+                print("[LILYPOND] {0}: {1:.2f} s{2}, {3} queued".format(
+                    ly_filename, elapsed, " (cached)" if cached else "", queued),
+                      file=sys.stderr)
+            print("{0} lilypond files engraved ({1} from the cache), {2} failed".format(
+                len(ly_filenames) - n_errors, n_cached, n_errors), file=sys.stderr)
+            failed = failed or n_errors != 0
+        if failed:
+            sys.exit(1)
+    finally:
+        if profiler != None:
+            profiler.stop()
+            profiler.print_report()
+            if options.profile_filename != None:
+                if options.profile_filename.endswith(".json"):
+                    profiler.dump_json(options.profile_filename)
+                else:
+                    profiler.dump_stats(options.profile_filename)
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# Benchmarks of abc4ly
+#
+# Usage: ./benchabc4ly.py [OPTIONS]
+#
+# The conversion is timed on a synthetic tunebook (see generate_tunebook()),
+# the results can be saved as JSON (-o) and compared with the results of
+# another commit (-c).
+
+from __future__ import print_function
+import sys
+import os
+import time
+import random
+import json
+import shutil
+import tempfile
+import platform
+import subprocess
+import optparse
+import tracemalloc
+
+import abc4ly
+
+# ------------------------------------------------------------------------
+#     Translation of the notes: time and memory
+# ------------------------------------------------------------------------
+
+mc_bench_line = '"Am" A2 B>c d/e/f/g/ (3abc d2 e2 |: f^g_a=b c\'2 d\'2 :|\n'
+mc_bench_notes_per_line = 20
+
+# The lines are dropped (NullSink): only the translation is measured
+
+def create_bench_context():
+    tc = abc4ly.TuneContext(abc4ly.NullSink())
+    abc4ly.read_info_line(tc, "M:4/4")
+    abc4ly.read_info_line(tc, "K:D")
+    return tc
+
+# Time per note, in microseconds
+
+def bench_note_time(nlines=5000):
+    tc = create_bench_context()
+    start = time.perf_counter()
+    for lineno in range(nlines):
+        abc4ly.translate_notes(tc, mc_bench_line, False)
+    elapsed = time.perf_counter() - start
+    return elapsed * 1e6 / (nlines * mc_bench_notes_per_line)
+
+# Memory allocated to translate a bar of 4 notes, in bytes: the peak of
+# the memory traced by tracemalloc during translate_notes() (the objects
+# allocated, and not yet freed, by the translation)
+
+def bench_bar_memory(ncalls=1000):
+    tc = create_bench_context()
+    abc_line = "c2 d2 e2 f2 |\n"
+    abc4ly.translate_notes(tc, abc_line, False) # warm-up
+    peak = 0
+    tracemalloc.start()
+    try:
+        for call in range(ncalls):
+            tracemalloc.reset_peak()
+            (before, unused) = tracemalloc.get_traced_memory()
+            abc4ly.translate_notes(tc, abc_line, False)
+            (after, call_peak) = tracemalloc.get_traced_memory()
+            peak = max(peak, call_peak - before)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+# Memory of a Note and of a TuneContext, in bytes
+
+def bench_object_memory(nobjects=1000):
+    sizes = []
+    for create in [abc4ly.Note, abc4ly.TuneContext]:
+        tracemalloc.start()
+        try:
+            (before, unused) = tracemalloc.get_traced_memory()
+            objects = [create() for k in range(nobjects)]
+            (after, unused) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del objects
+        sizes.append((after - before) / float(nobjects))
+    return sizes
+
+# Memory of a translated tune of nlines lines, in bytes: its events, and
+# the lilypond lines of its melody
+
+def bench_tune_memory(nlines=1000):
+    tc = abc4ly.TuneContext()
+    abc4ly.read_info_line(tc, "M:4/4")
+    abc4ly.read_info_line(tc, "K:D")
+    for lineno in range(nlines):
+        abc4ly.translate_notes(tc, mc_bench_line, False)
+    lines_size = sys.getsizeof(tc.output) + sum(sys.getsizeof(line) for line in tc.output)
+    return (tc.events.get_size(), lines_size)
+
+# ------------------------------------------------------------------------
+#     Synthetic tunebooks: reproducible ABC corpora
+# ------------------------------------------------------------------------
+
+# The parameters of a synthetic tunebook: the tunes are in 4/4 (L:1/8),
+# made of parts of two lines; the densities are probabilities (per part
+# for the repeats and key changes, per bar for the chords, per beat for
+# the triplets)
+
+mc_corpus_defaults = {"tunes":100, "lines":8, "bars":4, "repeats":0.5,
+                      "chords":0.3, "triplets":0.1, "keys":0.1, "seed":0}
+
+mc_corpus_keys = ["C", "G", "D", "A", "E", "F", "Bb", "Eb", "Am", "Em", "Bm",
+                  "Dm", "Gm", "Dmix", "Ador", "Edor", "Gmix"]
+mc_corpus_chords = ["C", "G", "D", "Am", "Em", "Bm", "F", "D7", "G7"]
+mc_corpus_notes = ["A,", "B,", "C", "D", "E", "F", "G", "A", "B",
+                   "c", "d", "e", "f", "g", "a", "b", "c'", "d'"]
+mc_corpus_accidentals = ["", "", "", "", "", "", "^", "_", "="]
+
+def get_corpus_note(rand):
+    return rand.choice(mc_corpus_accidentals) + rand.choice(mc_corpus_notes)
+
+# A bar of 8 eighth notes: beats of 2 eighth notes ("cd", "c2", "c>d",
+# "(3cde")
+
+def generate_bar(rand, params):
+    beats = []
+    if rand.random() < params["chords"]:
+        beats.append('"{0}"'.format(rand.choice(mc_corpus_chords)))
+    for beat in range(4):
+        draw = rand.random()
+        if draw < params["triplets"]:
+            beats.append("(3" + "".join(get_corpus_note(rand) for k in range(3)))
+        elif draw < 0.5:
+            beats.append(get_corpus_note(rand) + get_corpus_note(rand))
+        elif draw < 0.7:
+            beats.append(get_corpus_note(rand) + ">" + get_corpus_note(rand))
+        elif draw < 0.9:
+            beats.append(get_corpus_note(rand) + "2")
+        else:
+            beats.append("z" + get_corpus_note(rand))
+    return " ".join(beats)
+
+def generate_line(rand, params):
+    return " | ".join(generate_bar(rand, params) for k in range(params["bars"]))
+
+# The lines of a part, repeated or not, with alternatives or not
+
+def generate_part(rand, params, nlines):
+    lines = [generate_line(rand, params) for k in range(nlines)]
+    if rand.random() < params["repeats"]:
+        lines[0] = "|: " + lines[0]
+        if rand.random() < 0.5:
+            lines[-1] += " |1 " + generate_bar(rand, params) + " :|2 " + \
+                         generate_bar(rand, params) + " |]"
+        else:
+            lines[-1] += " :|"
+    else:
+        lines[-1] += " ||"
+    return [line + "\n" if line.endswith("|") or line.endswith("|]") else line + " |\n"
+            for line in lines]
+
+def generate_tune(rand, params, refnum):
+    lines = ["X:{0}\n".format(refnum),
+             "T:Synthetic tune {0}\n".format(refnum),
+             "R:Reel\n",
+             "M:4/4\n",
+             "L:1/8\n",
+             "K:{0}\n".format(rand.choice(mc_corpus_keys))]
+    nlines = params["lines"]
+    while nlines > 0:
+        if len(lines) > 6 and rand.random() < params["keys"]:
+            lines.append("K:{0}\n".format(rand.choice(mc_corpus_keys)))
+        lines.extend(generate_part(rand, params, min(nlines, 2)))
+        nlines -= 2
+    return lines
+
+# The text of a synthetic tunebook: the same parameters (see
+# mc_corpus_defaults) always generate the same tunebook
+
+def generate_tunebook(**params):
+    params = dict(mc_corpus_defaults, **params)
+    rand = random.Random(params["seed"])
+    text = ["% Synthetic tunebook: {0}\n".format(
+        " ".join("{0}={1}".format(name, params[name]) for name in sorted(params)))]
+    for refnum in range(1, params["tunes"] + 1):
+        text.append("\n")
+        text.extend(generate_tune(rand, params, refnum))
+    return "".join(text)
+
+# ------------------------------------------------------------------------
+#     Conversion of a synthetic tunebook: notes/s and bytes/s
+# ------------------------------------------------------------------------
+
+# The tunes of a tunebook (see abc4ly.split_tunes()), and its number of
+# notes and rests
+
+def read_corpus(text):
+    tunes = [lines for (refnum, lineno, lines)
+             in abc4ly.split_tunes(text.splitlines(True))]
+    nnotes = 0
+    for lines in tunes:
+        events = abc4ly.read_tune(lines, sink=abc4ly.NullSink()).events
+        nnotes += sum(1 for kind in events.kinds
+                      if kind == abc4ly.mc_event_note or kind == abc4ly.mc_event_rest)
+    return (tunes, nnotes)
+
+def is_info_line(line):
+    return line[0] in abc4ly.string.ascii_uppercase and line[1] == ":"
+
+# The best time of repeat runs of function(), which returns its elapsed
+# time in seconds
+
+def get_best_time(function, repeat):
+    return min(function() for k in range(repeat))
+
+# Only the translate_notes() calls are timed: the information fields are
+# read outside of the measure
+
+def bench_translate_notes(tunes, repeat):
+    def run():
+        elapsed = 0.0
+        for lines in tunes:
+            tc = abc4ly.TuneContext(abc4ly.NullSink())
+            for line in lines:
+                if is_info_line(line):
+                    abc4ly.read_info_line(tc, line)
+                elif not line.isspace() and line.lstrip()[0] != "%":
+                    start = time.perf_counter()
+                    abc4ly.translate_notes(tc, line, last_line=False)
+                    elapsed += time.perf_counter() - start
+        return elapsed
+    return get_best_time(run, repeat)
+
+def bench_read_line(tunes, repeat):
+    def run():
+        start = time.perf_counter()
+        for lines in tunes:
+            tc = abc4ly.TuneContext(abc4ly.NullSink())
+            for line in lines:
+                abc4ly.read_line(tc, line)
+        return time.perf_counter() - start
+    return get_best_time(run, repeat)
+
+# The formatting of the events of the tunes (already read) into lilypond
+# lines, dropped. The fragment table is emptied first: its hits and
+# misses are the ones of the benchmark.
+
+def bench_emit(tunes, repeat):
+    contexts = [abc4ly.read_tune(lines, sink=abc4ly.NullSink()) for lines in tunes]
+    abc4ly.mc_ly_fragments.clear()
+    def run():
+        start = time.perf_counter()
+        for tc in contexts:
+            abc4ly.LilypondEmitter(abc4ly.NullSink()).close(tc)
+        return time.perf_counter() - start
+    return get_best_time(run, repeat)
+
+# The time of create_pitch_dico() for all the key signatures, and their
+# number (they are computed once, in abc4ly.mc_pitch_dicos)
+
+def bench_create_pitch_dico(repeat, nrounds=100):
+    keys = sorted(abc4ly.mc_pitch_dicos)
+    def run():
+        start = time.perf_counter()
+        for k in range(nrounds):
+            for key in keys:
+                abc4ly.create_pitch_dico(key)
+        return time.perf_counter() - start
+    return (get_best_time(run, repeat), nrounds * len(keys))
+
+# Every tune is converted to its own lilypond file (split)
+
+def bench_convert(abc_filename, ly_filename, repeat):
+    def run():
+        start = time.perf_counter()
+        abc4ly.convert(abc_filename, ly_filename, split=True)
+        return time.perf_counter() - start
+    return get_best_time(run, repeat)
+
+def bench_batch(abc_filenames, ly_dirname, jobs, repeat):
+    def run():
+        start = time.perf_counter()
+        for (abc_filename, error, elapsed) in abc4ly.convert_batch(abc_filenames, ly_dirname,
+                                                                   jobs, split=True):
+            if error != None:
+                raise RuntimeError(error)
+        return time.perf_counter() - start
+    return get_best_time(run, repeat)
+
+# Write the tunes of a tunebook into ABC files of tunes_per_file tunes
+
+def write_corpus_files(tunes, dirname, tunes_per_file):
+    abc_filenames = []
+    for first in range(0, len(tunes), tunes_per_file):
+        abc_filename = os.path.join(dirname, "tunes-{0:05}.abc".format(first + 1))
+        with open(abc_filename, "w") as abc_file:
+            for lines in tunes[first:first + tunes_per_file]:
+                abc_file.writelines(lines)
+                abc_file.write("\n")
+        abc_filenames.append(abc_filename)
+    return abc_filenames
+
+def get_rates(seconds, nnotes, nbytes):
+    return {"seconds":seconds, "notes_per_sec":nnotes / seconds,
+            "bytes_per_sec":nbytes / seconds}
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Run all the benchmarks on the tunebook generated with params, return
+# the results (saved as JSON)
+
+def run_benchmarks(params, jobs=None, repeat=3, micro=True):
+    params = dict(mc_corpus_defaults, **params)
+    text = generate_tunebook(**params)
+    (tunes, nnotes) = read_corpus(text)
+    nbytes = len(text.encode("utf-8"))
+    nnote_bytes = sum(len(line.encode("utf-8")) for lines in tunes for line in lines
+                      if not is_info_line(line))
+
+    results = {}
+    results["translate_notes"] = get_rates(bench_translate_notes(tunes, repeat),
+                                           nnotes, nnote_bytes)
+    results["read_line"] = get_rates(bench_read_line(tunes, repeat), nnotes, nbytes)
+    results["emit"] = get_rates(bench_emit(tunes, repeat), nnotes, nbytes)
+    results["emit"]["fragment_hits"] = abc4ly.mc_ly_fragments.hits
+    results["emit"]["fragment_misses"] = abc4ly.mc_ly_fragments.misses
+    (seconds, ncalls) = bench_create_pitch_dico(repeat)
+    results["create_pitch_dico"] = {"seconds":seconds, "calls_per_sec":ncalls / seconds}
+
+    dirname = tempfile.mkdtemp(prefix="benchabc4ly-")
+    try:
+        abc_filename = os.path.join(dirname, "tunebook.abc")
+        with open(abc_filename, "w") as abc_file:
+            abc_file.write(text)
+        results["convert"] = get_rates(bench_convert(abc_filename,
+                                                     os.path.join(dirname, "tunebook.ly"),
+                                                     repeat),
+                                       nnotes, nbytes)
+        abc_filenames = write_corpus_files(tunes, dirname, 10)
+        results["convert_batch"] = get_rates(bench_batch(abc_filenames,
+                                                         os.path.join(dirname, "batch"),
+                                                         jobs, repeat),
+                                             nnotes, nbytes)
+    finally:
+        shutil.rmtree(dirname, ignore_errors=True)
+
+    if micro:
+        results["micro"] = {"translate_notes_us_per_note":bench_note_time(),
+                            "bytes_allocated_per_bar":bench_bar_memory()}
+
+    return {"commit":get_commit(),
+            "date":time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python":platform.python_version(),
+            "corpus":params,
+            "corpus_bytes":nbytes,
+            "corpus_notes":nnotes,
+            "results":results}
+
+def print_results(report, reference=None):
+    print("Corpus: {0} tunes, {1} notes, {2} bytes (commit {3})".format(
+        report["corpus"]["tunes"], report["corpus_notes"], report["corpus_bytes"],
+        report["commit"]))
+    for (name, result) in sorted(report["results"].items()):
+        if name == "micro":
+            continue
+        if "notes_per_sec" in result:
+            line = "{0:20} {1:8.3f} s {2:12.0f} notes/s {3:10.2f} MB/s".format(
+                name, result["seconds"], result["notes_per_sec"],
+                result["bytes_per_sec"] / 1e6)
+            rate = "notes_per_sec"
+        else:
+            line = "{0:20} {1:8.3f} s {2:12.0f} calls/s".format(
+                name, result["seconds"], result["calls_per_sec"])
+            rate = "calls_per_sec"
+        if reference != None and name in reference["results"]:
+            # Higher is faster
+            line += "  x{0:.2f} vs {1}".format(
+                result[rate] / reference["results"][name][rate], reference["commit"])
+        print(line)
+    if "micro" in report["results"]:
+        micro = report["results"]["micro"]
+        print("translate_notes(): {0:.2f} us/note, {1} bytes allocated per bar".format(
+            micro["translate_notes_us_per_note"], micro["bytes_allocated_per_bar"]))
+
+# ------------------------------------------------------------------------
+#     Main program
+# ------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    usage = "usage: %prog [OPTIONS]"
+    parser = optparse.OptionParser(usage=usage)
+    d = mc_corpus_defaults
+    parser.add_option("-n", "--tunes", dest="tunes", type="int", default=d["tunes"],
+                      help="number of tunes of the synthetic tunebook")
+    parser.add_option("-l", "--lines", dest="lines", type="int", default=d["lines"],
+                      help="number of lines per tune")
+    parser.add_option("-b", "--bars", dest="bars", type="int", default=d["bars"],
+                      help="number of bars per line")
+    parser.add_option("-r", "--repeats", dest="repeats", type="float",
+                      default=d["repeats"], help="density of the repeats (per part)")
+    parser.add_option("--chords", dest="chords", type="float", default=d["chords"],
+                      help="density of the guitar chords (per bar)")
+    parser.add_option("--triplets", dest="triplets", type="float", default=d["triplets"],
+                      help="density of the triplets (per beat)")
+    parser.add_option("--keys", dest="keys", type="float", default=d["keys"],
+                      help="density of the key changes (per part)")
+    parser.add_option("--seed", dest="seed", type="int", default=d["seed"],
+                      help="seed of the synthetic tunebook")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=None,
+                      help="number of worker processes of the batch conversion")
+    parser.add_option("--repeat", dest="repeat", type="int", default=3,
+                      help="number of runs of each benchmark (the best is kept)")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="save the results in the JSON file OUTPUT", metavar="OUTPUT")
+    parser.add_option("-c", "--compare", dest="compare", default=None,
+                      help="compare with the results of the JSON file REFERENCE",
+                      metavar="REFERENCE")
+    parser.add_option("-w", "--write-corpus", dest="corpus", default=None,
+                      help="only write the synthetic tunebook into CORPUS", metavar="CORPUS")
+    (options, args) = parser.parse_args()
+
+    params = dict((name, getattr(options, name)) for name in mc_corpus_defaults)
+    if options.corpus != None:
+        with open(options.corpus, "w") as abc_file:
+            abc_file.write(generate_tunebook(**params))
+        sys.exit(0)
+
+    reference = None
+    if options.compare != None:
+        with open(options.compare) as json_file:
+            reference = json.load(json_file)
+
+    report = run_benchmarks(params, options.jobs, options.repeat)
+    print_results(report, reference)
+
+    (note_size, tc_size) = bench_object_memory()
+    print("Note: {0:.0f} bytes, TuneContext: {1:.0f} bytes".format(note_size, tc_size))
+    (events_size, lines_size) = bench_tune_memory()
+    print("Tune: {0} bytes of events, {1} bytes of lilypond lines".format(events_size,
+                                                                      lines_size))
+
+    if options.output != None:
+        with open(options.output, "w") as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# Golden-file regression tests of abc4ly
+#
+# Usage: ./regressabc4ly.py [OPTIONS] [NAME...]
+#
+# Every regression/NAME.abc that has a reference regression-ref/NAME.ly
+# is converted (in parallel) to regression-out/NAME.ly and compared with
+# its reference. The conversion time of each case is kept in a short
+# history (regression-out/timings.json): a case much slower than its
+# history is flagged.
+#
+# Exit codes: 0 if all the outputs match their references, 1 if an
+# output differs or a conversion fails, 2 on a usage error, 3 if the
+# outputs match but some cases are slower.
+
+from __future__ import print_function
+import sys
+import os
+import glob
+import json
+import difflib
+import optparse
+
+import abc4ly
+
+mc_exit_ok = 0
+mc_exit_failed = 1
+mc_exit_usage = 2
+mc_exit_slower = 3
+
+mc_history_length = 10 # conversion times kept per case
+mc_diff_lines = 20 # lines of unified diff kept per failure
+
+# ------------------------------------------------------------------------
+#     The regression cases
+# ------------------------------------------------------------------------
+
+# The names of the cases: the ABC files of abc_dirname with a reference
+# in ref_dirname (all of them, or only the ones in names)
+
+def list_cases(abc_dirname, ref_dirname, names=None):
+    cases = []
+    for abc_filename in sorted(glob.glob(os.path.join(abc_dirname, "*.abc"))):
+        name = os.path.splitext(os.path.basename(abc_filename))[0]
+        if names and not name in names:
+            continue
+        if os.path.exists(os.path.join(ref_dirname, name + ".ly")):
+            cases.append(name)
+    return cases
+
+# A short unified diff of the reference and output files ("" if they
+# are the same)
+
+def get_diff(ref_filename, out_filename, nlines=mc_diff_lines):
+    with open(ref_filename) as ref_file:
+        ref_lines = ref_file.readlines()
+    with open(out_filename) as out_file:
+        out_lines = out_file.readlines()
+    diff = list(difflib.unified_diff(ref_lines, out_lines, ref_filename, out_filename))
+    if len(diff) > nlines:
+        diff = diff[:nlines] + ["... ({0} more lines)\n".format(len(diff) - nlines)]
+    return "".join(diff)
+
+# Convert the cases in parallel (see abc4ly.convert_batch()) and compare
+# them with their references. Return a dictionary NAME: (error, diff,
+# elapsed), with error the conversion error (or None) and diff the short
+# diff of the output ("" if it matches its reference).
+
+def run_cases(cases, abc_dirname, ref_dirname, out_dirname, jobs=None):
+    abc_filenames = [os.path.join(abc_dirname, name + ".abc") for name in cases]
+    results = {}
+    for (abc_filename, error, elapsed) in abc4ly.convert_batch(abc_filenames, out_dirname,
+                                                               jobs):
+        name = os.path.splitext(os.path.basename(abc_filename))[0]
+        diff = ""
+        if error == None:
+            diff = get_diff(os.path.join(ref_dirname, name + ".ly"),
+                            os.path.join(out_dirname, name + ".ly"))
+        results[name] = (error, diff, elapsed)
+    return results
+
+# ------------------------------------------------------------------------
+#     Timing history
+# ------------------------------------------------------------------------
+
+def load_history(history_filename):
+    try:
+        with open(history_filename) as history_file:
+            return json.load(history_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def save_history(history_filename, history):
+    tmp_filename = "{0}.{1}.tmp".format(history_filename, os.getpid())
+    with open(tmp_filename, "w") as history_file:
+        json.dump(history, history_file, indent=2, sort_keys=True)
+    os.replace(tmp_filename, history_filename)
+
+# The median of the previous times of a case (None without history)
+
+def get_median(times):
+    if len(times) == 0:
+        return None
+    times = sorted(times)
+    middle = len(times) // 2
+    if len(times) % 2 == 1:
+        return times[middle]
+    return (times[middle - 1] + times[middle]) / 2.0
+
+# A case is slower if it takes more than factor times its median time,
+# and at least min_delta seconds more (the times of the small cases are
+# mostly noise)
+
+def is_slower(elapsed, times, factor, min_delta):
+    median = get_median(times)
+    return median != None and elapsed > factor * median and elapsed - median > min_delta
+
+# Add the times of the converted cases to the history
+
+def update_history(history, results):
+    for (name, (error, diff, elapsed)) in results.items():
+        if error == None:
+            times = history.get(name, []) + [elapsed]
+            history[name] = times[-mc_history_length:]
+    return history
+
+# ------------------------------------------------------------------------
+#     Main program
+# ------------------------------------------------------------------------
+
+# Print the report of the results, return the exit code
+
+def report(results, history, factor, min_delta, verbose=False, file=sys.stdout):
+    (nfailed, nslower) = (0, 0)
+    for name in sorted(results):
+        (error, diff, elapsed) = results[name]
+        times = history.get(name, [])
+        if error != None:
+            print("FAIL {0}: conversion error".format(name), file=file)
+            print(error, file=file)
+            nfailed += 1
+        elif diff != "":
+            print("FAIL {0}: output differs from the reference".format(name), file=file)
+            print(diff, end="", file=file)
+            nfailed += 1
+        elif is_slower(elapsed, times, factor, min_delta):
+            print("SLOW {0}: {1:.2f} ms (median {2:.2f} ms)".format(
+                name, elapsed * 1e3, get_median(times) * 1e3), file=file)
+            nslower += 1
+        elif verbose:
+            print("ok   {0}: {1:.2f} ms".format(name, elapsed * 1e3), file=file)
+    print("{0} cases, {1} failed, {2} slower".format(len(results), nfailed, nslower),
+          file=file)
+    if nfailed != 0:
+        return mc_exit_failed
+    if nslower != 0:
+        return mc_exit_slower
+    return mc_exit_ok
+
+if __name__ == '__main__':
+    usage = "usage: %prog [OPTIONS] [NAME...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="number of worker processes (default: number of CPUs)",
+                      metavar="N")
+    parser.add_option("--abc-dir", dest="abc_dirname", default="regression",
+                      help="directory of the ABC files (default: regression)", metavar="DIR")
+    parser.add_option("--ref-dir", dest="ref_dirname", default="regression-ref",
+                      help="directory of the references (default: regression-ref)",
+                      metavar="DIR")
+    parser.add_option("--out-dir", dest="out_dirname", default="regression-out",
+                      help="directory of the outputs (default: regression-out)", metavar="DIR")
+    parser.add_option("--history", dest="history_filename",
+                      help="timing history (default: OUT_DIR/timings.json)", metavar="FILE")
+    parser.add_option("--no-history", dest="record", action="store_false", default=True,
+                      help="do not record the times of this run in the history")
+    parser.add_option("--factor", dest="factor", type="float", default=2.0,
+                      help="a case is slower above FACTOR times its median time "
+                      "(default: 2)")
+    parser.add_option("--min-delta", dest="min_delta", type="float", default=5.0,
+                      help="... and at least MS milliseconds more (default: 5)", metavar="MS")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,
+                      help="also print the cases that pass, with their times")
+    (options, args) = parser.parse_args()
+
+    cases = list_cases(options.abc_dirname, options.ref_dirname, args)
+    if len(cases) == 0:
+        parser.error("no regression case")
+    if not options.history_filename:
+        options.history_filename = os.path.join(options.out_dirname, "timings.json")
+
+    results = run_cases(cases, options.abc_dirname, options.ref_dirname,
+                        options.out_dirname, options.jobs)
+    history = load_history(options.history_filename)
+    ret = report(results, history, options.factor, options.min_delta / 1e3,
+                 options.verbose)
+    if options.record:
+        save_history(options.history_filename, update_history(history, results))
+    sys.exit(ret)
@@ -2,12 +2,23 @@
 # -*- coding:utf-8 -*-
 
 import unittest
+import sys
 import filecmp
 import os
+import io
+import time
+import shutil
+import struct
+import json
+import pstats
+import types
 
 import abc4ly
 from abc4ly import *
 
+# The command line tests must not fill the conversion cache of the user
+os.environ["ABC4LY_CACHE_DIR"] = "regression-out/cache"
+
 # unittest reminder:
 # assert functions: assertEqual(), assertRaises(), assertTrue()
 
@@ -75,14 +86,6 @@ class TestMisc(unittest.TestCase):
             for line in tmp.readlines():
                 read_line(tc, line)
 
-    def test_get_leading_digits(self):
-        self.assertEqual(get_leading_digits("123"), "123")
-        self.assertEqual(get_leading_digits("8"), "8")
-        self.assertEqual(get_leading_digits("54abc"), "54")
-        self.assertEqual(get_leading_digits("ab123"), "")
-        self.assertEqual(get_leading_digits(""), "")
-        self.assertEqual(get_leading_digits("   123"), "")
-
 
 class TestTimeSignature(unittest.TestCase):
 
@@ -194,6 +197,41 @@ K:cio
    ^
    Invalid mode""")
 
+    def test_error_unsupported_key_signature(self):
+        self.translate_and_check_exception(self.tc, "K: Fb",
+                                           """In "", line 1, column 3:
+K: Fb
+   ^
+   Unsupported key signature""")
+
+    def test_pitch_dico_table(self):
+        # Every key signature: one shared, read-only pitch dictionary
+        for pitch in "CDEFGAB":
+            for alteration in ["", "#", "b"]:
+                for mode in mc_modes:
+                    abc_signature = "K:{0}{1} {2}".format(pitch, alteration, mode)
+                    try:
+                        ly_signature = translate_key_signature(self.tc, abc_signature)
+                    except AbcSyntaxError as e:
+                        self.assertEqual(e.what, "Unsupported key signature")
+                        self.assertRaises(ValueError, create_pitch_dico,
+                                          "\\key {0}{1} \\{2}".format(
+                                              pitch.lower(),
+                                              {"#":"is", "b":"es"}[alteration],
+                                              mode))
+                        continue
+                    pitch_dico = mc_pitch_dicos[ly_signature]
+                    self.assertEqual(dict(pitch_dico), create_pitch_dico(ly_signature))
+                    self.assertTrue(pitch_dico is mc_pitch_dicos[ly_signature])
+        self.assertEqual(len(mc_pitch_dicos), 7 * 3 * 9 - 4 * 9)
+        pitch_dico = mc_pitch_dicos[r"\key c \major"]
+        try:
+            pitch_dico["f"] = "fis"
+        except TypeError:
+            pass
+        else:
+            self.fail("mc_pitch_dicos is not read-only")
+
 
 class TestNoteDuration(unittest.TestCase):
 
@@ -202,6 +240,50 @@ class TestNoteDuration(unittest.TestCase):
         self.assertEqual(get_default_note_duration("4/4"), 8)
         self.assertEqual(get_default_note_duration("2/4"), 16)
 
+    def test_ly_durations(self):
+        self.assertEqual(mc_ly_durations[mc_ticks_per_whole], "1")
+        self.assertEqual(mc_ly_durations[mc_ticks_per_whole * 3 // 8], "4.")
+        self.assertEqual(mc_ly_durations[mc_ticks_per_whole // 512], "512")
+        self.assertFalse(mc_ticks_per_whole * 5 // 8 in mc_ly_durations)
+
+    def test_get_simple_ticks(self):
+        self.assertEqual(get_simple_ticks(mc_ticks_per_whole // 4),
+                         mc_ticks_per_whole // 4)
+        self.assertEqual(get_simple_ticks(mc_ticks_per_whole * 3 // 8),
+                         mc_ticks_per_whole // 8)
+
+    def test_invalid_default_note_length(self):
+        tc = TuneContext()
+        self.assertRaises(AbcSyntaxError, read_info_line, tc, "L:1/3")
+        self.assertRaises(AbcSyntaxError, read_info_line, tc, "L:1/1024")
+        read_info_line(tc, "L:1/16")
+        self.assertEqual(tc.default_note_duration, 16)
+
+    def test_malformed_default_note_length(self):
+        tc = TuneContext()
+        tc.lineno = 3
+        for line in ["L:1/", "L:1/x", "L:1", "L:", "L:1/8/2"]:
+            try:
+                read_info_line(tc, line + "\n")
+            except AbcSyntaxError as e:
+                self.assertEqual((e.what, e.abc_line, e.lineno, e.colno),
+                                 ("Invalid default note length", line, 3, 2))
+            else:
+                self.fail(line)
+        self.assertEqual(tc.default_note_duration, 8)
+
+    def test_malformed_time_signature(self):
+        tc = TuneContext()
+        for line in ["M:4/0", "M:4/", "M:"]:
+            try:
+                read_info_line(tc, line + "\n")
+            except AbcSyntaxError as e:
+                self.assertEqual((e.what, e.colno), ("Invalid time signature", 2))
+            else:
+                self.fail(line)
+        # An invalid field does not change the context
+        self.assertEqual((tc.meter, tc.default_note_duration), ("", 8))
+
 
 class TestMusicComputer(unittest.TestCase):
 
@@ -258,6 +340,60 @@ class TestMusicComputer(unittest.TestCase):
 #        self.assert_(self.dico == create_pitch_dico("\key ces \major"))
 
 
+class TestTokenizer(unittest.TestCase):
+
+    def get_parts(self, abc, pos=0):
+        m = mc_token_regex.match(abc, pos)
+        return (m.end(), dict((name, part) for (name, part) in m.groupdict().items()
+                              if part != None))
+
+    def test_bars(self):
+        # The longest bar first
+        for bar in ["|", "||", "|]", "|:", ":|", "::", "|1", ":|2", "[2"]:
+            self.assertEqual(self.get_parts(bar + "abc"), (len(bar), {"bar":bar}))
+        self.assertEqual(self.get_parts("  :| |"), (4, {"bar":":|"}))
+        self.assertEqual(self.get_parts("a|b", 1), (2, {"bar":"|"}))
+
+    def test_note(self):
+        self.assertEqual(self.get_parts("^^c'3/2-d"),
+                         (8, {"accidental":"^^", "pitch":"c", "octaver":"'",
+                              "multiplier":"3", "divider":"/2", "tie":"-"}))
+        # The white spaces after a note are part of its token
+        self.assertEqual(self.get_parts("_B,/ c"), (5, {"accidental":"_", "pitch":"B",
+                                                        "octaver":",", "divider":"/"}))
+        self.assertEqual(self.get_parts("(3 A > B"), (7, {"triplet":"(3", "pitch":"A",
+                                                          "broken_rythm":">"}))
+        self.assertEqual(self.get_parts("z2|"), (2, {"rest":"z", "multiplier":"2"}))
+
+    def test_bar_is_not_a_note(self):
+        # A bar right after a note is the next token
+        self.assertEqual(self.get_parts("c|"), (1, {"pitch":"c"}))
+        self.assertEqual(self.get_parts("c2[2"), (2, {"pitch":"c", "multiplier":"2"}))
+
+    def test_chord(self):
+        self.assertEqual(self.get_parts('"Am7" A'),
+                         (7, {"quote":'"', "chord":"Am7", "chord_end":'"', "pitch":"A"}))
+        self.assertEqual(self.get_parts('"G|D"|'),
+                         (5, {"quote":'"', "chord":"G|D", "chord_end":'"'}))
+        # A chord without its closing inverted commas takes the line
+        self.assertEqual(self.get_parts('"Am A B'),
+                         (7, {"quote":'"', "chord":"Am A B", "chord_end":""}))
+
+    def test_empty_match(self):
+        # Not a token: the match is empty, the parser raises the error
+        self.assertEqual(self.get_parts("X"), (0, {}))
+        self.assertEqual(self.get_parts("c X", 1), (2, {}))
+        self.assertEqual(self.get_parts(""), (0, {}))
+        tc = TuneContext()
+        tc.default_note_duration = 8
+        try:
+            translate_notes(tc, "ab X")
+        except AbcSyntaxError as e:
+            self.assertEqual((e.what, e.colno), ("'X' is not a pitch", 3))
+        else:
+            self.assertTrue(False)
+
+
 # Base class to test the  translate_notes() function
 
 class TestTranslateNotes(unittest.TestCase):
@@ -366,7 +502,7 @@ class TestTranslateNotesStructure(TestTranslateNotes):
 
     def test_line_break4(self):
         abc_notes = ["|: C2 D2 E2 F2 :|", "G2 A2 B2 c2 |"]
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c'4 d'4 e'4 f'4",
                            "}",
                            "g'4 a'4 b'4 c''4 |"]
@@ -374,14 +510,14 @@ class TestTranslateNotesStructure(TestTranslateNotes):
 
     def test_one_bar_repeat(self):
         abc_notes =  "|: cdef gabc' :|"
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c''8 d''8 e''8 f''8 g''8 a''8 b''8 c'''8",
                            "}"]
         self.translate_and_test(abc_notes, expected_output)
 
     def test_two_bars_repeat(self):
         abc_notes =  "|: cdef gabc' | cedf gbac' :|"
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c''8 d''8 e''8 f''8 g''8 a''8 b''8 c'''8 |",
                            "    c''8 e''8 d''8 f''8 g''8 b''8 a''8 c'''8",
                            "}"]
@@ -391,7 +527,7 @@ class TestTranslateNotesStructure(TestTranslateNotes):
         read_info_line(self.tc, "M:4/4")
         abc_notes = "C2 D2 E2 F2 |: G2 A2 B2 c2 :|"
         expected_output = ["c'4 d'4 e'4 f'4 |",
-                           "\repeat volta 2 {",
+                           "\\repeat volta 2 {",
                            "    g'4 a'4 b'4 c''4",
                            "}"]
         self.tc.first_bar = True
@@ -399,26 +535,26 @@ class TestTranslateNotesStructure(TestTranslateNotes):
 
     def test_chained_repeats(self):
         abc_notes =  "|: CDEF GABc :: cBAG FEDC :|"
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c'8 d'8 e'8 f'8 g'8 a'8 b'8 c''8",
                            "}",
-                           "\repeat volta 2 {",
+                           "\\repeat volta 2 {",
                            "    c''8 b'8 a'8 g'8 f'8 e'8 d'8 c'8",
                            "}"]
         self.translate_and_test(abc_notes, expected_output)
 
     def test_chained_repeats2(self):
         abc_notes =  "|: CDEF GABc :||: cBAG FEDC :|"
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c'8 d'8 e'8 f'8 g'8 a'8 b'8 c''8",
                            "}",
-                           "\repeat volta 2 {",
+                           "\\repeat volta 2 {",
                            "    c''8 b'8 a'8 g'8 f'8 e'8 d'8 c'8",
                            "}"]
         self.translate_and_test(abc_notes, expected_output)
     def test_alternative(self):
         abc_notes = "|: C2 D2 E2 F2 |1 G2 A2 B2 c2 :|2 G2 E2 D2 C2 |"
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c'4 d'4 e'4 f'4",
                            "}",
                            r"\alternative {",
@@ -429,7 +565,7 @@ class TestTranslateNotesStructure(TestTranslateNotes):
 
     def test_alternatives_with_continuation(self):
         abc_notes = "|: C2 D2 E2 F2 |1 G2 A2 B2 c2 :|2 G2 E2 D2 C2 | C2 D2 E2 F2 |"
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c'4 d'4 e'4 f'4",
                            "}",
                            r"\alternative {",
@@ -442,14 +578,14 @@ class TestTranslateNotesStructure(TestTranslateNotes):
     def test_chained_repeats_with_alternative(self):
         abc_notes = ["|: C2 D2 E2 F2 |1 G2 A2 B2 c2 :|2 G2 E2 D2 C2",
                      "|: C2 D2 E2 F2 :|"]
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c'4 d'4 e'4 f'4",
                            "}",
                            r"\alternative {",
                            "    { g'4 a'4 b'4 c''4 }",
                            "    { g'4 e'4 d'4 c'4 }",
                            "}",
-                           "\repeat volta 2 {",
+                           "\\repeat volta 2 {",
                            "    c'4 d'4 e'4 f'4",
                            "}"]
         self.translate_and_test2(abc_notes, expected_output)
@@ -457,7 +593,7 @@ class TestTranslateNotesStructure(TestTranslateNotes):
     def test_alternatives_with_line_break(self):
         abc_notes = ["|: C2 D2 E2 F2 |1 G2 A2 B2 c2 :|2 G2 E2 D2 C2",
                      "|"]
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c'4 d'4 e'4 f'4",
                            "}",
                            r"\alternative {",
@@ -470,7 +606,7 @@ class TestTranslateNotesStructure(TestTranslateNotes):
         abc_notes = ["|: C2 D2 E2 F2 |1 G2 A2 B2 c2 | d2 e2 f2 g2 :|2",
                      "G2 E2 D2 C2 | C2 D2 E2 F2",
                      "|: G2 A2 B2 c2 :|"]
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c'4 d'4 e'4 f'4",
                            "}",
                            r"\alternative {",
@@ -479,14 +615,14 @@ class TestTranslateNotesStructure(TestTranslateNotes):
                            "    { g'4 e'4 d'4 c'4 |",
                            "      c'4 d'4 e'4 f'4 }",
                            "}",
-                           "\repeat volta 2 {",
+                           "\\repeat volta 2 {",
                            "    g'4 a'4 b'4 c''4",
                            "}"]
         self.translate_and_test2(abc_notes, expected_output)
 
     def test_two_bar_alternative(self):
         abc_notes = "|: C2 D2 E2 F2 |1 G2 A2 B2 c2 | d2 e2 f2 g2 :|2 G2 E2 D2 C2 | C2 D2 E2 F2 |"
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c'4 d'4 e'4 f'4",
                            "}",
                            r"\alternative {",
@@ -501,7 +637,7 @@ class TestTranslateNotesStructure(TestTranslateNotes):
         abc_notes = ["|: C2 D2 E2 F2",
                      "|1 G2 A2 B2 c2 | d2 e2 f2 g2 | a2 b2 c'2 d'2 :|",
                      "[2 c'2 b2 a2 g2 | G2 E2 D2 C2 | C2 D2 E2 F2 |"]
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c'4 d'4 e'4 f'4",
                            "}",
                            r"\alternative {",
@@ -516,7 +652,7 @@ class TestTranslateNotesStructure(TestTranslateNotes):
 
     def test_alternatives_long_form(self):
         abc_notes = "|: C2 D2 E2 F2 |1 G2 A2 B2 c2 :| [2 G2 E2 D2 C2 |"
-        expected_output = ["\repeat volta 2 {",
+        expected_output = ["\\repeat volta 2 {",
                            "    c'4 d'4 e'4 f'4",
                            "}",
                            r"\alternative {",
@@ -653,6 +789,19 @@ class TestTranslateNotesLongerDuration(TestTranslateNotes):
         abc_notes = "C5 D3"
         self.translate_and_check_exception(abc_notes, """In "", line 1, column 1:
 C5 D3
+ ^
+ Unhandled duration multiplier""")
+
+    def test_long_multipliers(self):
+        read_info_line(self.tc, "L:1/8")
+        abc_notes = "C8 D12 E6"
+        expected_output = ["c'1 d'1. e'2."]
+        self.translate_and_test(abc_notes, expected_output)
+
+    def test_unhandled_long_multiplier(self):
+        read_info_line(self.tc, "L:1/8")
+        self.translate_and_check_exception("C16", """In "", line 1, column 1:
+C16
  ^
  Unhandled duration multiplier""")
 
@@ -681,6 +830,15 @@ C/3
   ^
   Invalid note duration divisor""")
 
+    def test_divisor_too_short(self):
+        # No lilypond duration shorter than a 512th note
+        read_info_line(self.tc, "L:1/256")
+        self.translate_and_test("C/", ["c'512"])
+        self.translate_and_check_exception("C/4", """In "", line 1, column 2:
+C/4
+  ^
+  Invalid note duration divisor""")
+
 
 class TestDefaultNoteLengthInformationField(TestTranslateNotes):
 
@@ -762,7 +920,21 @@ class TestAnacrusis(TestTranslateNotes):
     def test_anacrusis_with_triplets(self):
         read_info_line(self.tc, "M:4/4")
         abc_notes = "(3DEF |"
-        expected_output = ["\partial 4 \times 2/3 { d'8 e'8 f'8 } |"]
+        expected_output = ["\partial 4 \\times 2/3 { d'8 e'8 f'8 } |"]
+        self.tc.first_bar = True
+        self.translate_and_test(abc_notes, expected_output)
+
+    def test_anacrusis_with_irregular_triplets(self):
+        read_info_line(self.tc, "M:4/4")
+        abc_notes = "(3D2EF |"
+        expected_output = ["\\partial 1*1/3 \\times 2/3 { d'4 e'8 f'8 } |"]
+        self.tc.first_bar = True
+        self.translate_and_test(abc_notes, expected_output)
+
+    def test_anacrusis_with_triplets_and_dotted_notes(self):
+        read_info_line(self.tc, "M:6/8")
+        abc_notes = "(3D2EF G>A |"
+        expected_output = ["\\partial 4*7/3 \\times 2/3 { d'4 e'8 f'8 } g'8. a'16 |"]
         self.tc.first_bar = True
         self.translate_and_test(abc_notes, expected_output)
 
@@ -797,7 +969,7 @@ class TestAnacrusis(TestTranslateNotes):
     def test_no_anacrusis_5(self):
         read_info_line(self.tc, "M:4/4")
         abc_notes = "(3 CDE F2 G2 A2 |"
-        expected_output = ["\times 2/3 { c'8 d'8 e'8 } f'4 g'4 a'4 |"]
+        expected_output = ["\\times 2/3 { c'8 d'8 e'8 } f'4 g'4 a'4 |"]
         self.tc.first_bar = True
         self.translate_and_test(abc_notes, expected_output)
 
@@ -859,13 +1031,13 @@ class TestTranslateNotesTuplets(TestTranslateNotes):
     def test_triplets(self):
         read_info_line(self.tc, "M:4/4")
         abc_notes = "(3 CDE F2 G2 A2"
-        expected_output = ["\times 2/3 { c'8 d'8 e'8 } f'4 g'4 a'4"]
+        expected_output = ["\\times 2/3 { c'8 d'8 e'8 } f'4 g'4 a'4"]
         self.translate_and_test(abc_notes, expected_output)
 
     def test_triplets_with_a_rest(self):
         read_info_line(self.tc, "M:4/4")
         abc_notes = "(3 CzE F2 G2 A2"
-        expected_output = ["\times 2/3 { c'8 r8 e'8 } f'4 g'4 a'4"]
+        expected_output = ["\\times 2/3 { c'8 r8 e'8 } f'4 g'4 a'4"]
         self.translate_and_test(abc_notes, expected_output)
 
 
@@ -900,6 +1072,192 @@ cdef XYZK
         'X' is not a pitch""")
 
 
+class TestErrorRecovery(TestTranslateNotes):
+
+    def setUp(self):
+        TestTranslateNotes.setUp(self)
+        self.tc.errors = []
+
+    def test_resume_at_next_bar(self):
+        # The notes up to the error, and from the next bar, are kept
+        self.translate_and_test("cd X e | C,, D | C' D | E F |",
+                                ["c''8 d''8 |", "c8 |", " |", "e'8 f'8 |"])
+        self.assertEqual([(e.colno, e.what) for e in self.tc.errors],
+                         [(3, "'X' is not a pitch"), (11, "',' is not a pitch"),
+                          (18, '"C\'" is not syntactically correct')])
+
+    def test_resume_at_next_line(self):
+        translate_notes(self.tc, 'cd "Am e f', last_line=False)
+        self.tc.lineno += 1
+        translate_notes(self.tc, "(3a%b c2 |")
+        self.assertEqual([(e.lineno, e.colno) for e in self.tc.errors], [(1, 10), (2, 3)])
+        # The triplet goes on after the error
+        self.assertEqual(self.tc.output, ["c''8 d''8 \\times 2/3 { a''8 |"])
+        translate_notes(self.tc, "b c |")
+        self.assertEqual(self.tc.output[1], "b''8 c''8 } |")
+
+    def test_octaver_on_next_line(self):
+        # The octave marks of the last note of a line are on the next line
+        translate_notes(self.tc, "c", last_line=False)
+        self.tc.lineno += 1
+        translate_notes(self.tc, ",d | e |")
+        self.assertEqual([(e.lineno, e.colno, e.what) for e in self.tc.errors],
+                         [(2, 0, "'c,' is not syntactically correct")])
+        abc_filename = "regression-out/check.abc"
+        with open(abc_filename, "w") as abc_file:
+            abc_file.write("X:1\nM:C\nK:C\nc\n,d | e |\n")
+        (ntunes, errors) = check(abc_filename, recover=True)
+        self.assertEqual([(e.lineno, e.colno, e.what) for e in errors],
+                         [(5, 0, "'c,' is not syntactically correct")])
+
+    def test_ties(self):
+        # The tie of the previous note is forgotten
+        self.translate_and_test("C- D E | F |", ["c'8 ~ |", "f'8 |"])
+        self.assertEqual(len(self.tc.errors), 1)
+
+    def test_raise(self):
+        self.tc.errors = None
+        self.assertRaises(AbcSyntaxError, translate_notes, self.tc, "cd X e |")
+
+    def test_tune(self):
+        # The errors of the information fields are collected too
+        errors = []
+        tc = read_tune(["X:1\n", "M:C\n", "L:1/3\n", "K:H\n", "C5 d | e |\n"],
+                       "foo.abc", 1, NullSink(), errors)
+        self.assertEqual([(e.filename, e.lineno, e.colno, e.what) for e in errors],
+                         [("foo.abc", 3, 2, "Invalid default note length"),
+                          ("foo.abc", 4, 2, "Invalid pitch"),
+                          ("foo.abc", 5, 1, "Unhandled duration multiplier")])
+        self.assertEqual(list(tc.events.kinds).count(mc_event_note), 1)
+
+    def test_check(self):
+        abc_filename = "regression-out/check.abc"
+        with open(abc_filename, "w") as abc_file:
+            abc_file.write("X:1\nM:C\nK:C\nab% | C,, |\n\n"
+                           "X:2\nK:C\ncde |\n")
+        (ntunes, errors) = check(abc_filename, recover=True)
+        self.assertEqual(ntunes, 2)
+        self.assertEqual([(e.filename, e.lineno, e.colno) for e in errors],
+                         [(abc_filename, 4, 2), (abc_filename, 4, 8), (abc_filename, 9, 0)])
+        self.assertEqual(len(check(abc_filename)[1]), 2)
+        self.assertEqual(errors[0].__str__(), """In "regression-out/check.abc", line 4, column 2:
+ab% | C,, |
+  ^
+  '%' is not a pitch""")
+
+    def test_check_malformed_fields(self):
+        # A malformed L: or M: field is one more diagnostic: the check of
+        # the file goes on
+        abc_filename = "regression-out/check.abc"
+        with open(abc_filename, "w") as abc_file:
+            abc_file.write("X:1\nM:4/0\nL:1/\nK:C\nab% | c |\n\n"
+                           "X:2\nM:C\nL:1/x\nK:C\ncde X |\n")
+        (ntunes, errors) = check(abc_filename, recover=True)
+        self.assertEqual(ntunes, 2)
+        self.assertEqual([(e.lineno, e.colno, e.what) for e in errors],
+                         [(2, 2, "Invalid time signature"),
+                          (3, 2, "Invalid default note length"),
+                          (5, 2, "'%' is not a pitch"),
+                          (7, 0, "Missing time signature (M: field)"),
+                          (9, 2, "Invalid default note length"),
+                          (11, 4, "'X' is not a pitch")])
+
+    def test_field_failure(self):
+        # Any failure to parse a field is collected as a syntax error
+        def read_info_line(tc, line):
+            raise ValueError("bad field")
+        read_info_line_ = abc4ly.read_info_line
+        abc4ly.read_info_line = read_info_line
+        try:
+            errors = []
+            tc = read_tune(["X:1\n", "abc|\n"], "foo.abc", 1, NullSink(), errors)
+            self.assertRaises(AbcSyntaxError, read_tune, ["X:1\n"])
+        finally:
+            abc4ly.read_info_line = read_info_line_
+        self.assertEqual([(e.filename, e.lineno, e.colno, e.what) for e in errors],
+                         [("foo.abc", 1, 2, "Invalid field (bad field)")])
+        self.assertEqual(list(tc.events.kinds).count(mc_event_note), 3)
+
+    def test_command_line(self):
+        with open("regression-out/check.abc", "w") as abc_file:
+            abc_file.write("X:1\nM:C\nK:C\nab% | C,, |\n")
+        ret = os.system("./abc4ly.py -c -k regression-out/check.abc "
+                        "2>regression-out/check.txt")
+        self.assertNotEqual(0, ret)
+        with open("regression-out/check.txt") as out:
+            self.assertEqual(out.read().count("is not a pitch"), 2)
+
+
+class TestTranslateNotesLongLines(TestTranslateNotes):
+
+    # 40 characters, 2 bars
+    abc_bars = "|: CDEF G2A2 | (3ABc d>e f/g/ \"Am\" a2 :|"
+
+    def translate_long_line(self, n_repeats):
+        tc = TuneContext()
+        tc.default_note_duration = get_default_note_duration("4/4")
+        tc.first_bar = False
+        abc_line = self.abc_bars * n_repeats
+        start = time.time()
+        translate_notes(tc, abc_line)
+        return (tc, time.time() - start)
+
+    def test_long_line(self):
+        (tc, elapsed) = self.translate_long_line(2500) # 100k characters
+        self.assertEqual(len(tc.output), 2500 * 4)
+        self.assertEqual(tc.output[-2],
+                         "    \\times 2/3 { a'8 b'8 c''8 } d''8. e''16 f''16 g''16 a''4" ' ^"Am"')
+
+    def test_error_column_in_long_line(self):
+        abc_line = self.abc_bars * 2500 + " X"
+        try:
+            translate_notes(self.tc, abc_line)
+        except AbcSyntaxError as e:
+            self.assertEqual(e.colno, len(abc_line) - 1)
+        else:
+            self.assertTrue(False)
+
+    def count_copied_characters(self, n_repeats):
+        # The characters copied out of the line by translate_notes(): a
+        # parser that copies the rest of the line (al[i:]) at each token
+        # copies a quadratic number of characters
+        counts = [0]
+        class CountingLine(str):
+            def __getitem__(self, key):
+                part = str.__getitem__(self, key)
+                counts[0] += len(part)
+                return part
+        tc = TuneContext()
+        tc.default_note_duration = get_default_note_duration("4/4")
+        tc.first_bar = False
+        translate_notes(tc, CountingLine(self.abc_bars * n_repeats))
+        self.assertEqual(len(tc.output), n_repeats * 4)
+        return counts[0]
+
+    def test_linear_scaling(self):
+        # 8 times more characters should copy about 8 times more
+        # characters (and not 64 times more, as a quadratic parser): unlike
+        # a time, the count does not depend on the load of the machine
+        ncopied1 = self.count_copied_characters(250)
+        ncopied8 = self.count_copied_characters(2000)
+        self.assertTrue(ncopied8 <= 10 * ncopied1, (ncopied1, ncopied8))
+        self.assertTrue(ncopied1 <= 8 * len(self.abc_bars) * 250, ncopied1)
+
+    def test_linear_scaling_detects_copies(self):
+        # The count does catch a copy of the rest of the line per token
+        def match(string, pos, endpos):
+            string[pos:endpos]
+            return token_regex.match(string, pos, endpos)
+        token_regex = abc4ly.mc_token_regex
+        abc4ly.mc_token_regex = types.SimpleNamespace(match=match)
+        try:
+            ncopied1 = self.count_copied_characters(250)
+            ncopied8 = self.count_copied_characters(2000)
+        finally:
+            abc4ly.mc_token_regex = token_regex
+        self.assertTrue(ncopied8 > 30 * ncopied1, (ncopied1, ncopied8))
+
+
 class TestOutputFramework(unittest.TestCase):
 
     def check_output(self, basename):
@@ -963,6 +1321,1436 @@ class TestOutput(TestOutputFramework):
         self.check_output("yellow_tinker")
 
 
+class TestTuneEvents(TestTranslateNotes):
+
+    def test_notes(self):
+        read_info_line(self.tc, "M:4/4")
+        translate_notes(self.tc, '"Am" ^c/ z/ (3B,CD- D ||')
+        events = self.tc.events
+        self.assertEqual(list(events.kinds),
+                         [mc_event_note, mc_event_rest, mc_event_note, mc_event_note,
+                          mc_event_note, mc_event_note, mc_event_line])
+        self.assertEqual([mc_ly_pitches[events.pitches[k]] for k in [0, 2, 3, 4, 5]],
+                         ["cis", "b", "c", "d", "d"])
+        self.assertEqual(list(events.octaves[0:6]), [2, 0, 0, 1, 1, 1])
+        eighth = mc_ticks_per_whole // 8
+        self.assertEqual(list(events.ticks[0:6]),
+                         [eighth // 2, eighth // 2, eighth, eighth, eighth, eighth])
+        self.assertEqual(list(events.flags),
+                         [0, 0, mc_flag_triplet_begin, 0,
+                          mc_flag_tied | mc_flag_triplet_end, 0,
+                          mc_flag_double_bar])
+        self.assertEqual(list(events.chords[0:6]), [1, 0, 0, 0, 0, 0])
+        self.assertEqual(events.chord_names, ["Am"])
+
+    def test_structure(self):
+        translate_notes(self.tc, "|: C4 |1 D4 :|2 E4 |]")
+        self.assertEqual(list(self.tc.events.kinds),
+                         [mc_event_open_repeat, mc_event_note, mc_event_line,
+                          mc_event_close_repeat, mc_event_begin_alternative_1,
+                          mc_event_note, mc_event_line, mc_event_begin_alternative_2,
+                          mc_event_note, mc_event_line, mc_event_end_alternative])
+
+    def test_reuse(self):
+        # The events of a tune can be written several times, without
+        # translating the tune again
+        with open("regression/yellow_tinker.abc") as abc_file:
+            tc = read_tune(abc_file)
+        for k in range(2):
+            ly_file = io.StringIO()
+            write_ly(tc, ly_file)
+            with open("regression-ref/yellow_tinker.ly") as ref:
+                self.assertEqual(ly_file.getvalue(), ref.read())
+
+    def test_size(self):
+        with open("regression/brid_harper_s.abc") as abc_file:
+            tc = read_tune(abc_file)
+        self.assertEqual(tc.events.get_size(), 8 * len(tc.events))
+        self.assertTrue(tc.events.get_size() < sum(sys.getsizeof(line) for line in tc.output))
+
+
+class TestFragmentTable(unittest.TestCase):
+
+    def setUp(self):
+        mc_ly_fragments.clear()
+
+    def test_hits(self):
+        with open("regression/yellow_tinker.abc") as abc_file:
+            tc = read_tune(abc_file)
+        nnotes = sum(1 for kind in tc.events.kinds
+                     if kind == mc_event_note or kind == mc_event_rest)
+        self.assertEqual(mc_ly_fragments.hits + mc_ly_fragments.misses, nnotes)
+        self.assertEqual(mc_ly_fragments.misses, len(mc_ly_fragments.fragments))
+        self.assertTrue(mc_ly_fragments.hits > mc_ly_fragments.misses)
+
+        # The same output again, from the table only
+        misses = mc_ly_fragments.misses
+        ly_file = io.StringIO()
+        write_ly(tc, ly_file)
+        self.assertEqual(mc_ly_fragments.misses, misses)
+        with open("regression-ref/yellow_tinker.ly") as ref:
+            self.assertEqual(ly_file.getvalue(), ref.read())
+
+    def test_fragments(self):
+        tc = TuneContext()
+        tc.default_note_duration = 8
+        tc.first_bar = False
+        translate_notes(tc, '"Am" ^c/ z/ (3B,C-C d2 "G" d2 |')
+        self.assertEqual(tc.output,
+                         ["cis''16 ^\"Am\" r16 \\times 2/3 { b8 c'8 ~ c'8 } d''4 d''4 ^\"G\" |"])
+        self.assertEqual((mc_ly_fragments.hits, mc_ly_fragments.misses), (0, 7))
+
+    def test_bounded(self):
+        table = FragmentTable(max_size=4)
+        for key in range(10):
+            table.add(key, "c'{0}".format(key))
+        self.assertTrue(len(table.fragments) <= 4)
+        self.assertEqual(table.misses, 10)
+        self.assertTrue(table.add(10, "c''" + "4") is sys.intern("c''4"))
+
+
+class TestSinks(unittest.TestCase):
+
+    def test_lilypond_sink(self):
+        # The melody is written as soon as it is translated, after the
+        # beginning of the lilypond file
+        ly_file = io.StringIO()
+        tc = TuneContext(LilypondSink(ly_file))
+        for line in ["T:Hello, world!\n", "M:C\n", "L:1/4\n", "K:C\n"]:
+            read_line(tc, line)
+        self.assertEqual(ly_file.getvalue(), "")
+        read_line(tc, "|: cdef :|\n")
+        self.assertTrue(ly_file.getvalue().endswith("    \\time 4/4\n\n"
+                                                    "    \\repeat volta 2 {\n"
+                                                    "        c''4 d''4 e''4 f''4\n"
+                                                    "    }\n"))
+        translate_notes(tc, "", last_line = True)
+        tc.emitter.close(tc)
+        self.assertTrue(ly_file.getvalue().endswith("    }\n}\n\n\\score {\n"
+                                                    "    \\new Staff \\melody\n"
+                                                    "    \\layout { }\n    \\midi { }\n}\n"))
+
+    def test_write_ly(self):
+        # A tune read with a ListSink is written afterwards
+        with open("regression/hello_repeated_with_alternative.abc") as abc_file:
+            tc = read_tune(abc_file)
+        self.assertEqual(tc.output[0], "\\repeat volta 2 {")
+        self.assertEqual(tc.output[2], "}")
+        self.assertEqual(tc.output[3], "\\alternative {")
+        ly_file = io.StringIO()
+        write_ly(tc, ly_file)
+        with open("regression-ref/hello_repeated_with_alternative.ly") as ref:
+            self.assertEqual(ly_file.getvalue(), ref.read())
+
+    def test_no_output_on_error(self):
+        out = "regression-out/missing_time_signature.ly"
+        self.assertRaises(AbcSyntaxError, convert,
+                          "regression/missing_time_signature.abc", out)
+        self.assertFalse(os.path.exists(out))
+        self.assertEqual([filename for filename in os.listdir("regression-out")
+                          if filename.endswith(".tmp")], [])
+
+
+class TestTunebook(TestOutputFramework):
+
+    def test_split_tunes(self):
+        with open("regression/tunebook.abc") as tmp:
+            tunes = [(refnum, lineno) for (refnum, lineno, lines) in split_tunes(tmp)]
+        self.assertEqual(tunes, [("1", 3), ("2", 11), ("3", 18)])
+
+    def test_split_tunes_without_refnum(self):
+        with open("regression/hello_world.abc") as tmp:
+            tunes = list(split_tunes(tmp))
+        self.assertEqual(len(tunes), 1)
+        self.assertEqual(tunes[0][0:2], ("", 1))
+
+    def test_read_tunes(self):
+        with open("regression/tunebook.abc") as tmp:
+            tunes = [(tc.refnum, tc.title, tc.key_signature)
+                     for tc in read_tunes(tmp, "regression/tunebook.abc")]
+        self.assertEqual(tunes, [("1", "Hello, world!", "\\key c \\major"),
+                                 ("2", "C Major", "\\key c \\major"),
+                                 ("3", "Yellow Tinker", "\\key a \\mixolydian")])
+
+    def test_read_selected_tunes(self):
+        with open("regression/tunebook.abc") as tmp:
+            titles = [tc.title for tc in read_tunes(tmp, refnums=["3", "2"])]
+        self.assertEqual(titles, ["C Major", "Yellow Tinker"])
+
+    def test_fresh_context(self):
+        abc_lines = ["X:1\n", "M:6/8\n", "K:D\n", "F>G|\n",
+                     "X:2\n", "M:4/4\n", "K:C\n", "F2|\n"]
+        tunes = list(read_tunes(abc_lines))
+        self.assertEqual(tunes[0].output, ["\\partial 8*2 fis'8. g'16 |"])
+        self.assertEqual(tunes[1].output, ["\\partial 4 f'4 |"])
+
+    def test_error_line_number(self):
+        abc_lines = ["X:1\n", "M:4/4\n", "K:C\n", "CDEF|\n",
+                     "\n", "X:2\n", "M:4/4\n", "K:C\n", "CDXF|\n"]
+        try:
+            for tc in read_tunes(abc_lines, "book.abc"):
+                pass
+        except AbcSyntaxError as e:
+            self.assertEqual(e.__str__(), """In "book.abc", line 9, column 2:
+CDXF|
+  ^
+  'X' is not a pitch""")
+        else:
+            self.assertTrue(False)
+
+    def test_convert_first_tune(self):
+        out = "regression-out/tunebook.ly"
+        convert("regression/tunebook.abc", out)
+        self.assertTrue(filecmp.cmp("regression-ref/hello_world.ly", out))
+
+    def test_convert_selected_tune(self):
+        out = "regression-out/tunebook.ly"
+        tc = convert("regression/tunebook.abc", out, refnums=["2"], use_index=False)
+        self.assertEqual(tc.refnum, "2")
+        self.assertTrue(filecmp.cmp("regression-ref/c_major.ly", out))
+
+    def test_convert_missing_tune(self):
+        self.assertEqual(None, convert("regression/tunebook.abc",
+                                       "regression-out/tunebook.ly", refnums=["4"],
+                                       use_index=False))
+
+    def test_convert_split(self):
+        convert("regression/tunebook.abc", "regression-out/tunebook.ly", split=True)
+        for (refnum, basename) in [("1", "hello_world"), ("2", "c_major"),
+                                   ("3", "yellow_tinker")]:
+            out = "regression-out/tunebook-" + refnum + ".ly"
+            ref = "regression-ref/" + basename + ".ly"
+            self.assertTrue(filecmp.cmp(ref, out),
+                            "Files " + ref + " and " + out + " differ")
+
+
+class TestBook(unittest.TestCase):
+
+    # The melody of a reference file, as it is indented in a book
+    def get_melody(self, basename):
+        with open("regression-ref/" + basename + ".ly") as ref_file:
+            text = ref_file.read()
+        melody = text[text.index("\\clef"):text.index("}\n\n\\score")]
+        return "".join("            " + line + "\n" if line != "" else "\n"
+                       for line in melody.rstrip().split("\n"))
+
+    def read(self, ly_filename):
+        with open(ly_filename) as ly_file:
+            return ly_file.read()
+
+    def test_book(self):
+        out = "regression-out/tunebook.ly"
+        self.assertEqual(convert_book(["regression/tunebook.abc"], out), [out])
+        text = self.read(out)
+        self.assertEqual(text.count("\\version"), 1)
+        self.assertEqual(text.count("\\bookpart"), 3)
+        self.assertTrue(text.startswith('\\version "2.12.2"\n\n\\book {\n    \\bookpart {\n'
+                                        '        \\header {\n'
+                                        '            title = "Hello, world!"\n'))
+        for basename in ["hello_world", "c_major", "yellow_tinker"]:
+            self.assertTrue(self.get_melody(basename) in text, basename)
+        self.assertTrue(text.endswith("            \\layout { }\n        }\n    }\n}\n"))
+
+    def test_selected_tunes(self):
+        out = "regression-out/tunebook.ly"
+        convert_book(["regression/tunebook.abc", "regression/hello_partial.abc"], out,
+                     refnums=["3", "1"])
+        text = self.read(out)
+        self.assertEqual(text.count("\\bookpart"), 2)
+        self.assertTrue(text.index("Hello, world!") < text.index("Yellow Tinker"))
+        self.assertFalse("Hello, partial!" in text)
+        self.assertEqual(convert_book(["regression/tunebook.abc"], out, refnums=["4"]), [])
+
+    def test_split_books(self):
+        tunes = [(str(n), 1, ["\n"] * size, "book.abc")
+                 for (n, size) in enumerate([10, 10, 30, 10, 20, 20], 1)]
+        self.assertEqual([[tune[0] for tune in book] for book in split_books(tunes, 2)],
+                         [["1", "2", "3"], ["4", "5", "6"]])
+        self.assertEqual([len(book) for book in split_books(tunes, 1)], [6])
+        self.assertEqual([len(book) for book in split_books(tunes, 10)], [1] * 6)
+
+    def test_books(self):
+        out = "regression-out/tunebook.ly"
+        self.assertEqual(convert_book(["regression/tunebook.abc"], out, nbooks=2),
+                         ["regression-out/tunebook-book1.ly",
+                          "regression-out/tunebook-book2.ly"])
+        texts = [self.read("regression-out/tunebook-book{0}.ly".format(k)) for k in [1, 2]]
+        self.assertEqual([text.count("\\bookpart") for text in texts], [2, 1])
+        self.assertTrue(self.get_melody("yellow_tinker") in texts[1])
+
+    def test_syntax_error(self):
+        out = "regression-out/book-error.ly"
+        with open("regression-out/book-error.abc", "w") as abc_file:
+            abc_file.write("X:1\nT:A\nM:C\nK:C\nCDEF|\n\nX:2\nT:B\nM:C\nK:C\nCDXF|\n")
+        try:
+            convert_book(["regression-out/book-error.abc"], out)
+        except AbcSyntaxError as e:
+            self.assertEqual(e.lineno, 11)
+        else:
+            self.assertTrue(False)
+        self.assertFalse(os.path.exists(out))
+        self.assertEqual([filename for filename in os.listdir("regression-out")
+                          if filename.endswith(".tmp")], [])
+
+
+class TestTunebookIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.abc_filename = "regression-out/tunebook.abc"
+        shutil.copyfile("regression/tunebook.abc", self.abc_filename)
+        try:
+            os.remove(get_index_filename(self.abc_filename))
+        except:
+            pass
+
+    def test_entries(self):
+        index = open_index(self.abc_filename)
+        entries = [(refnum, title, lineno)
+                   for (refnum, title, offset, length, lineno) in index.entries()]
+        index.close()
+        self.assertEqual(entries, [(1, "Hello, world!", 3), (2, "C Major", 11),
+                                   (3, "Yellow Tinker", 18)])
+
+    def test_find(self):
+        index = open_index(self.abc_filename)
+        self.assertEqual(index.find(4), None)
+        (refnum, offset, length, lineno) = index.find(2)[0:4]
+        index.close()
+        with open(self.abc_filename, 'rb') as tmp:
+            tmp.seek(offset)
+            self.assertTrue(tmp.read(length).startswith(b"X:2\nT:C Major\n"))
+
+    def test_read_indexed_tunes(self):
+        with open(self.abc_filename) as tmp:
+            tunes = list(split_tunes(tmp))
+        self.assertEqual(read_indexed_tunes(self.abc_filename, ["3", "1"]),
+                         [tunes[0], tunes[2]])
+        self.assertEqual(read_indexed_tunes(self.abc_filename, ["4"]), [])
+        self.assertEqual(read_indexed_tunes(self.abc_filename, ["foo"]), None)
+
+    def test_out_of_date_index(self):
+        read_indexed_tunes(self.abc_filename, ["1"])
+        with open(self.abc_filename, 'a') as tmp:
+            tmp.write("\nX:4\nT:Hello again\nM:C\nK:C\nCDEF|\n")
+        ((refnum, lineno, lines),) = read_indexed_tunes(self.abc_filename, ["4"])
+        self.assertEqual(lines[1], "T:Hello again\n")
+
+    def test_same_size_same_mtime(self):
+        # The file is changed without changing its size nor its
+        # modification time: the CRC of the tune does not match
+        read_indexed_tunes(self.abc_filename, ["1"])
+        stat = os.stat(self.abc_filename)
+        with open(self.abc_filename) as tmp:
+            text = tmp.read()
+        with open(self.abc_filename, 'w') as tmp:
+            tmp.write(text.replace("X:1\n", "X:9\n").replace("X:2\n", "X:1\n"))
+        os.utime(self.abc_filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        ((refnum, lineno, lines),) = read_indexed_tunes(self.abc_filename, ["1"])
+        self.assertEqual((lineno, lines[1]), (11, "T:C Major\n"))
+
+    def test_convert(self):
+        out = "regression-out/tunebook.ly"
+        tc = convert(self.abc_filename, out, refnums=["3"])
+        self.assertTrue(os.path.exists(get_index_filename(self.abc_filename)))
+        self.assertEqual(tc.lineno, 18 + 12)
+        self.assertTrue(filecmp.cmp("regression-ref/yellow_tinker.ly", out))
+
+
+class TestTuneCatalog(unittest.TestCase):
+
+    dirname = "regression-out/catalog"
+
+    def setUp(self):
+        shutil.rmtree(self.dirname, ignore_errors=True)
+        os.makedirs(self.dirname)
+        self.catalog = TuneCatalog(self.dirname + "/catalog.sqlite")
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.dirname, ignore_errors=True)
+
+    def get_titles(self, tunes):
+        return [(os.path.basename(tune[0]), tune[1], tune[3]) for tune in tunes]
+
+    def test_scan_tune_headers(self):
+        headers = list(scan_tune_headers("regression/tunebook.abc"))
+        self.assertEqual([header[0:3] for header in headers],
+                         [(offset, length, lineno) for (refnum, offset, length, lineno, crc,
+                                                        title)
+                          in scan_tune_offsets("regression/tunebook.abc")])
+        self.assertEqual(headers[2][3:], ("3", "Yellow Tinker", "", "Reel", "2/2",
+                                          "\\key a \\mixolydian", "1/8"))
+
+    def test_scan_header_fields(self):
+        # A field after K:, before the notes
+        ((offset, length, lineno, refnum, title, composer, rythm, meter, key_signature,
+          unit),) = scan_tune_headers("regression/brid_harper_s.abc")
+        self.assertEqual((meter, key_signature, unit), ("6/8", "\\key e \\minor", "1/8"))
+        # Without "X:" line, with a comment
+        ((offset, length, lineno, refnum, title, composer, rythm, meter, key_signature,
+          unit),) = scan_tune_headers("regression/header_with_comments.abc")
+        self.assertEqual((offset, lineno, refnum, title, rythm), (0, 1, "", "Hello, world!",
+                                                                  "reel"))
+
+    def test_scan_invalid_field(self):
+        with open(self.dirname + "/invalid.abc", "w") as abc_file:
+            abc_file.write("X:1\nT:A\nM:foo\nK:H\nCDEF|\nM:2/4\nX:2\nT:B\nM:2/4\nK:D\n")
+        self.assertEqual([header[3:] for header in scan_tune_headers(abc_file.name)],
+                         [("1", "A", "", "", "", "", "1/8"),
+                          ("2", "B", "", "", "2/4", "\\key d \\major", "1/16")])
+        self.assertEqual(list(scan_tune_headers("regression/empty.abc")), [])
+
+    def test_scan_malformed_fields(self):
+        # A malformed L: or M: field does not stop the scan, nor the update
+        # of the catalog (melodies included)
+        with open(self.dirname + "/malformed.abc", "w") as abc_file:
+            abc_file.write("X:1\nT:A\nM:4/0\nL:1/\nK:G\nCDEF|\n\n"
+                           "X:2\nT:B\nL:1/x\nL:1\nK:D\nDEFG|\n\nX:3\nT:C\nK:C\nc|\n")
+        self.assertEqual([header[3:] for header in scan_tune_headers(abc_file.name)],
+                         [("1", "A", "", "", "", "\\key g \\major", "1/8"),
+                          ("2", "B", "", "", "", "\\key d \\major", "1/8"),
+                          ("3", "C", "", "", "", "\\key c \\major", "1/8")])
+        self.assertEqual(self.catalog.update([abc_file.name], melodies=True), 1)
+        self.assertEqual(self.get_titles(self.catalog.find(key="D")),
+                         [("malformed.abc", 8, "B")])
+
+    def test_find(self):
+        self.assertEqual(self.catalog.update(list_abc_files(["regression"])),
+                         len(list_abc_files(["regression"])))
+        self.assertEqual(self.get_titles(self.catalog.find(rhythm="REEL", key="Amix")),
+                         [("tunebook.abc", 18, "Yellow Tinker"),
+                          ("yellow_tinker.abc", 1, "Yellow Tinker")])
+        self.assertEqual(self.get_titles(self.catalog.find(title="partial")),
+                         [("hello_partial.abc", 1, "Hello, partial!")])
+        self.assertEqual(len(self.catalog.find(meter="C", key="C", composer="foo")), 12)
+        self.assertEqual(self.get_titles(self.catalog.find(["regression/tunebook.abc"],
+                                                           meter="4/4")),
+                         [("tunebook.abc", 3, "Hello, world!"),
+                          ("tunebook.abc", 11, "C Major")])
+        self.assertEqual(len(self.catalog.find()), 20)
+        self.assertRaises(ValueError, self.catalog.find, tempo="120")
+        self.assertRaises(AbcSyntaxError, self.catalog.find, key="H")
+
+    def test_update(self):
+        abc_filename = self.dirname + "/tunebook.abc"
+        shutil.copy("regression/tunebook.abc", abc_filename)
+        self.assertEqual(self.catalog.update([abc_filename]), 1)
+        self.assertEqual(self.catalog.update([abc_filename]), 0)
+        self.assertEqual(len(self.catalog.find()), 3)
+
+        with open(abc_filename, "a") as abc_file:
+            abc_file.write("\nX:4\nT:Dunmore Lasses\nR:Reel\nM:C|\nK:Edor\nB2|\n")
+        self.assertEqual(self.catalog.update([abc_filename]), 1)
+        self.assertEqual(self.get_titles(self.catalog.find(rhythm="reel", meter="2/2")),
+                         [("tunebook.abc", 18, "Yellow Tinker"),
+                          ("tunebook.abc", 31, "Dunmore Lasses")])
+
+        os.remove(abc_filename)
+        self.assertEqual(self.catalog.update([abc_filename]), 0)
+        self.assertEqual(self.catalog.find(), [])
+
+    def test_melody_intervals(self):
+        # F sharp in D, the repeat played twice, the tied notes merged
+        tc = read_tune(["K:D\n", "|: DEF-F G :| A,2\n"], sink=NullSink())
+        self.assertEqual(get_melody_intervals(tc), [2, 2, 1, -5, 2, 2, 1, -10])
+
+    def test_interval_grams(self):
+        self.assertEqual(get_interval_grams([2, 2, 1]), set())
+        self.assertEqual(len(get_interval_grams([2, 2, 1, 2, 2, 2, 1])), 4)
+        self.assertEqual(get_interval_grams([2, 2, 2, 2, 2, 2]), get_interval_grams([2] * 4))
+        self.assertEqual(get_interval_grams([-1, 0, 1, 2], 4), set([63 << 21 | 64 << 14 |
+                                                                     65 << 7 | 66]))
+        self.assertEqual(get_interval_grams([100, 0, 0, -100]),
+                         get_interval_grams([63, 0, 0, -63]))
+
+    def test_find_fragment(self):
+        abc_filenames = list_abc_files(["regression"])
+        self.catalog.update(abc_filenames, melodies=True)
+        tunes = self.catalog.find_fragment("EAAA EFGF", "Amix")
+        self.assertEqual([(score, os.path.basename(filename), lineno)
+                          for (score, filename, lineno, refnum, title) in tunes[0:2]],
+                         [(1.0, "tunebook.abc", 18), (1.0, "yellow_tinker.abc", 1)])
+        self.assertTrue(all(tune[0] < 1.0 for tune in tunes[2:]))
+        # A fifth lower, an octave higher
+        self.assertEqual(self.catalog.find_fragment("B,EEE B,CDC", "Amix"), tunes)
+        self.assertEqual(self.catalog.find_fragment("eaaa efgf", "Amix"), tunes)
+        self.assertEqual(len(self.catalog.find_fragment("EAAA EFGF", "Amix",
+                                                        ["regression/yellow_tinker.abc"])),
+                         1)
+        self.assertRaises(ValueError, self.catalog.find_fragment, "EAAA", "Amix")
+
+    def test_update_melodies(self):
+        abc_filename = self.dirname + "/tunebook.abc"
+        shutil.copy("regression/tunebook.abc", abc_filename)
+        self.assertEqual(self.catalog.update([abc_filename]), 1)
+        self.assertEqual(self.catalog.find_fragment("CDEF GABc"), [])
+        # The melodies are indexed on demand, once
+        self.assertEqual(self.catalog.update([abc_filename], melodies=True), 1)
+        self.assertEqual(self.catalog.update([abc_filename], melodies=True), 0)
+        self.assertEqual(self.catalog.update([abc_filename]), 0)
+        self.assertEqual([tune[0:3] for tune in self.catalog.find_fragment("CDEF GABc")],
+                         [(1.0, os.path.abspath(abc_filename), 11)])
+        os.remove(abc_filename)
+        self.catalog.update([abc_filename])
+        self.assertEqual(self.catalog.db.execute("SELECT COUNT(*) FROM grams").fetchone(),
+                         (0,))
+
+    def test_update_melodies_failure(self):
+        # A tune that fails to be parsed has no melody, the others have one
+        def get_melody_intervals(tc):
+            if tc.title == "C Major":
+                raise RuntimeError("bug")
+            return get_melody_intervals_(tc)
+        get_melody_intervals_ = abc4ly.get_melody_intervals
+        abc4ly.get_melody_intervals = get_melody_intervals
+        try:
+            self.assertEqual(self.catalog.update(["regression/tunebook.abc"], melodies=True), 1)
+        finally:
+            abc4ly.get_melody_intervals = get_melody_intervals_
+        self.assertEqual(len(self.catalog.find()), 3)
+        self.assertEqual(self.catalog.find_fragment("CDEF GABc"), [])
+        self.assertEqual([tune[2] for tune in self.catalog.find_fragment("EAAA EFGF", "Amix")],
+                         [18])
+
+    def test_command_line(self):
+        cmd = "./abc4ly.py --catalog {0}/catalog.sqlite -q rhythm=reel -q key=Amix " \
+              "regression/tunebook.abc > {0}/out.txt".format(self.dirname)
+        self.assertEqual(0, os.system(cmd))
+        with open(self.dirname + "/out.txt") as out:
+            self.assertEqual(out.read(), "regression/tunebook.abc:18: X:3 Yellow Tinker "
+                             "(Reel, 2/2, \\key a \\mixolydian)\n")
+
+
+class TestFingerprint(unittest.TestCase):
+
+    dirname = "regression-out/dedupe"
+
+    tunebook = """X:1
+T:One
+M:4/4
+L:1/8
+K:G
+GABc dBGB|cABG A2D2|
+GABc d2 ef|gedB A2G2:|
+
+X:2
+T:One again, in A
+M:4/4
+L:1/8
+K:A
+ABcd ecAc|dBcA B2E2|ABcd e2 fg|
+afec B2A2:|
+
+X:3
+T:Two
+M:4/4
+L:1/8
+K:G
+GABc dBGB|cABG A2D2|GABc d2 ef|gedB A2G2:|
+|:gfga gfed|gfga b2ag:|
+"""
+
+    def setUp(self):
+        shutil.rmtree(self.dirname, ignore_errors=True)
+        os.makedirs(self.dirname)
+        self.abc_filename = self.dirname + "/tunebook.abc"
+        with open(self.abc_filename, "w") as abc_file:
+            abc_file.write(self.tunebook)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname, ignore_errors=True)
+
+    def get_tunes(self):
+        with open(self.abc_filename) as abc_file:
+            return [read_tune(lines, self.abc_filename, lineno, NullSink())
+                    for (refnum, lineno, lines) in split_tunes(abc_file)]
+
+    def test_tune_tokens(self):
+        tokens = get_tune_tokens(self.get_tunes()[0])
+        self.assertEqual(tokens[0:9], ["12:192", "14:192", "16:192", "17:192", "19:192",
+                                       "16:192", "12:192", "16:192", "|"])
+        self.assertEqual(tokens[-1], ":|")
+        self.assertEqual(get_tune_tokens(TuneContext()), [])
+        self.assertEqual(get_tune_fingerprint(TuneContext()), None)
+
+    def test_fingerprint(self):
+        fingerprints = [get_tune_fingerprint(tc) for tc in self.get_tunes()]
+        self.assertEqual(fingerprints[0], fingerprints[1])
+        self.assertNotEqual(fingerprints[0], fingerprints[2])
+
+    def test_similarity(self):
+        signatures = [get_minhash_signature(get_tune_tokens(tc)) for tc in self.get_tunes()]
+        self.assertEqual(get_similarity(signatures[0], signatures[1]), 1.0)
+        self.assertTrue(0.3 < get_similarity(signatures[0], signatures[2]) < 1.0)
+        with open("regression/yellow_tinker.abc") as abc_file:
+            other = get_minhash_signature(get_tune_tokens(read_tune(abc_file,
+                                                                    sink=NullSink())))
+        self.assertTrue(get_similarity(signatures[0], other) < 0.3)
+
+    def test_body_key(self):
+        lines = self.tunebook.splitlines(True)
+        (key, header_lines) = get_tune_body_key(lines[0:8])
+        self.assertEqual(header_lines, ["T:One\n"])
+        # Another title, composer, comments, white spaces and line breaks
+        copy = ["X:7\n", "T:Two\n", "T:Deux\n", "C:Foo\n", "M:4/4\n", "% a copy\n",
+                "L:1/8\n", "K:G\n", "GABc dBGB|cABG A2D2|  \n", "\n",
+                "  GABc d2\n", "ef|gedB A2G2:|\n"]
+        self.assertEqual(get_tune_body_key(copy),
+                         (key, ["T:Two\n", "T:Deux\n", "C:Foo\n"]))
+        self.assertNotEqual(get_tune_body_key(copy[0:7] + ["K:D\n"] + copy[8:])[0], key)
+        self.assertNotEqual(get_tune_body_key(copy[0:8] + ["GABc dBGB|cABG A2D3|\n"])[0], key)
+        self.assertNotEqual(get_tune_body_key(copy[0:9] + ["M:6/8\n"] + copy[9:])[0], key)
+        # The white spaces of a guitar chord count
+        self.assertNotEqual(get_tune_body_key(['"A m" abc|\n'])[0],
+                            get_tune_body_key(['"Am" abc|\n'])[0])
+        self.assertEqual(get_tune_body_key(['"A m" abc|\n'])[0],
+                         get_tune_body_key(['"A m"a b c |\n'])[0])
+        # A title after the notes
+        self.assertEqual(get_tune_body_key(lines[0:7] + ["T:Late\n"])[0], None)
+
+    def check_duplicate(self, ly_filename, abc_filename, refnum):
+        ref_ly_filename = self.dirname + "/ref.ly"
+        convert(abc_filename, ref_ly_filename, refnums=[refnum], use_index=False)
+        self.assertTrue(filecmp.cmp(ref_ly_filename, ly_filename, shallow=False), ly_filename)
+
+    def test_convert_dedupe(self):
+        with open(self.abc_filename, "a") as abc_file:
+            abc_file.write("\nX:4\nT:One, the same\nC:Foo\nR:Reel\nM:4/4\nL:1/8\nK:G\n"
+                           "GABc dBGB|cABG A2D2|GABc d2 ef|gedB A2G2:|\n")
+        duplicates = []
+        ly_filename = self.dirname + "/tunebook.ly"
+        with TuneProfiler() as profiler:
+            convert(self.abc_filename, ly_filename, split=True, dedupe=True,
+                    duplicates=duplicates)
+        self.assertEqual(duplicates, [(self.dirname + "/tunebook-4.ly",
+                                       self.dirname + "/tunebook-1.ly")])
+        # The duplicate is not parsed, and has its own header
+        self.assertEqual([tune[2] for tune in profiler.tunes], [1, 9, 17])
+        with open(self.dirname + "/tunebook-4.ly") as ly_file:
+            self.assertTrue('title = "One, the same"\n    composer = "Foo"\n' in ly_file.read())
+        for refnum in "1234":
+            self.check_duplicate(self.dirname + "/tunebook-{0}.ly".format(refnum),
+                                 self.abc_filename, refnum)
+
+    def test_convert_batch_dedupe(self):
+        # The duplicates of the tunes of the other files of the batch
+        other_filename = self.dirname + "/other.abc"
+        with open(other_filename, "w") as abc_file:
+            abc_file.write("X:1\nT:Un\nR:Reel\nM:4/4\nL:1/8\nK:G\n"
+                           "GABc dBGB|cABG A2D2|\nGABc d2 ef|gedB A2G2:|\n\n"
+                           "X:2\nT:Tinker\nM:2/2\nL:1/8\nK:Amix\n"
+                           "|: EAAA EFGF | EAAA eAcA | EAAA EDEF | G2B/A/G =cGBG :|\n"
+                           "  A2eA fAeA | AAe2 dBGB | A2eA fAe2 | d2BG DGBG |\n"
+                           "  A2eA fAeA | AAe2 dBGB | eeef ggge | d2BG DGBG |\n")
+        broken_filename = self.dirname + "/broken.abc"
+        with open(broken_filename, "w") as abc_file:
+            abc_file.write("X:1\nT:Broken\nM:C\nK:C\nX |\n\nX:2\nT:Alone\nM:C\nK:C\nc2 d2|\n")
+        with open(self.dirname + "/copy.abc", "w") as abc_file:
+            abc_file.write("X:1\nT:Alone again\nM:C\nK:C\nc2 d2|\n")
+        ly_dirname = self.dirname + "/ly"
+        duplicates = []
+        abc_filenames = [self.abc_filename, "regression/yellow_tinker.abc", broken_filename,
+                         other_filename, self.dirname + "/copy.abc"]
+        results = dict((abc_filename, error) for (abc_filename, error, elapsed)
+                       in convert_batch(abc_filenames, ly_dirname, jobs=2, split=True,
+                                        dedupe=True, duplicates=duplicates))
+        self.assertEqual(sorted(duplicates),
+                         [(ly_dirname + "/other-1.ly", ly_dirname + "/tunebook-1.ly"),
+                          (ly_dirname + "/other-2.ly", ly_dirname + "/yellow_tinker-1.ly")])
+        self.check_duplicate(ly_dirname + "/other-1.ly", other_filename, "1")
+        self.check_duplicate(ly_dirname + "/other-2.ly", other_filename, "2")
+        # The copy of a tune of a file that failed fails too
+        self.assertTrue("'X' is not a pitch" in results[broken_filename])
+        self.assertEqual(results[self.dirname + "/copy.abc"],
+                         '"{0}/copy.abc", line 1: duplicate of {1}/broken-2.ly, not '
+                         'converted'.format(self.dirname, ly_dirname))
+        self.assertEqual([error for (abc_filename, error) in results.items()
+                          if abc_filename in abc_filenames[0:2] + [other_filename]],
+                         [None, None, None])
+
+    def test_find_duplicates(self):
+        (clusters, errors) = find_duplicates([self.abc_filename], jobs=1)
+        self.assertEqual(errors, [])
+        self.assertEqual([[(tune[1], tune[5]) for tune in cluster] for cluster in clusters],
+                         [[(1, 1.0), (9, 1.0)]])
+        (clusters, errors) = find_duplicates([self.abc_filename, "regression/tunebook.abc",
+                                              "regression/yellow_tinker.abc"], jobs=2,
+                                             similarity=0.3)
+        self.assertEqual([[(os.path.basename(tune[0]), tune[1]) for tune in cluster]
+                          for cluster in clusters],
+                         [[("tunebook.abc", 1), ("tunebook.abc", 9), ("tunebook.abc", 17)],
+                          [("tunebook.abc", 18), ("yellow_tinker.abc", 1)]])
+
+
+    def test_find_duplicates_failure(self):
+        # A tune that fails to be fingerprinted is an error, the other
+        # tunes of its file are compared
+        def get_tune_tokens(tc):
+            if tc.title == "Two":
+                raise RuntimeError("bug")
+            return get_tune_tokens_(tc)
+        get_tune_tokens_ = abc4ly.get_tune_tokens
+        abc4ly.get_tune_tokens = get_tune_tokens
+        try:
+            (clusters, errors) = find_duplicates([self.abc_filename], jobs=1)
+        finally:
+            abc4ly.get_tune_tokens = get_tune_tokens_
+        self.assertEqual(errors, ['"{0}", line 17: RuntimeError: bug'.format(self.abc_filename)])
+        self.assertEqual([[tune[1] for tune in cluster] for cluster in clusters], [[1, 9]])
+
+
+class TestCheck(unittest.TestCase):
+
+    def test_check(self):
+        self.assertEqual(check("regression/tunebook.abc"), (3, []))
+        self.assertEqual(check("regression/tunebook.abc", ["2", "4"]), (1, []))
+        (ntunes, errors) = check("regression/missing_time_signature.abc")
+        self.assertEqual(ntunes, 1)
+        self.assertEqual(errors[0].__str__(), """In "regression/missing_time_signature.abc", line 3, column 0:
+
+^
+Missing time signature (M: field)""")
+
+    def test_errors_by_tune(self):
+        # An error stops the check of its tune, not of the next tunes
+        abc_filename = "regression-out/check.abc"
+        with open(abc_filename, "w") as abc_file:
+            abc_file.write("X:1\nM:C\nK:C\nabc |\n\n"
+                           "X:2\nM:C\nK:C\nab% |\nC16 |\n\n"
+                           "X:3\nM:C\nK:C\ncde |\n")
+        (ntunes, errors) = check(abc_filename)
+        self.assertEqual(ntunes, 3)
+        self.assertEqual([(e.lineno, e.colno) for e in errors], [(9, 2)])
+
+    def test_no_formatting(self):
+        tc = check_tune(["M:C\n", "K:C\n", "abc |\n"], "", 1)
+        self.assertTrue(isinstance(tc.emitter, NullEmitter))
+        self.assertEqual(len(tc.events), 4)
+
+    def test_check_batch(self):
+        results = list(check_batch(list_abc_files(["regression"]), jobs=2))
+        self.assertEqual(sum(result[1] for result in results), 20)
+        self.assertEqual(sorted(result[0] for result in results if result[2]),
+                         ["regression/header_no_endl.abc",
+                          "regression/header_with_blank_lines.abc",
+                          "regression/header_with_comments.abc",
+                          "regression/missing_time_signature.abc"])
+
+    def test_command_line(self):
+        self.assertEqual(0, os.system("./abc4ly.py --check regression/tunebook.abc "
+                                      "regression/yellow_tinker.abc 2>/dev/null"))
+        self.assertNotEqual(0, os.system("./abc4ly.py -c -j 1 regression 2>/dev/null"))
+
+
+class TestIncrementalParser(unittest.TestCase):
+
+    def setUp(self):
+        with open("regression/brid_harper_s.abc") as abc_file:
+            self.lines = abc_file.readlines()
+        self.parser = IncrementalParser(self.lines, "brid_harper_s.abc")
+
+    def check_events(self):
+        # The events are the events of the whole tune read again
+        events = self.parser.get_events()
+        errors = []
+        tc = check_tune(self.parser.lines, "brid_harper_s.abc", 1, errors)
+        for field in ["kinds", "pitches", "octaves", "ticks", "flags", "chords",
+                      "chord_names", "anacrusis_ticks", "anacrusis_unit"]:
+            self.assertEqual(getattr(events, field), getattr(tc.events, field), field)
+        self.assertEqual([(e.lineno, e.colno, e.what) for e in self.parser.get_errors()],
+                         [(e.lineno, e.colno, e.what) for e in errors])
+
+    def test_parse(self):
+        self.check_events()
+        self.assertEqual(self.parser.get_errors(), [])
+
+    def test_converge(self):
+        # Only the edited line and the next one (its last note changed)
+        self.assertEqual(self.parser.edit(9, 10, ["|: GEF G2A | Bee dBd | edB AGA | BGE A3 |\n"]),
+                         2)
+        self.check_events()
+        self.assertEqual(self.parser.edit(12, 13, ["|: g2g fed | e2e dBA |\n",
+                                                   '"Em" G2G ABc | BGE EGE |\n']), 2)
+        self.check_events()
+        self.assertEqual(len(self.parser.lines), 15)
+
+    def test_no_converge(self):
+        # A key change is parsed again up to the end of the tune
+        self.assertEqual(self.parser.edit(5, 6, ["K:G\n"]), 9)
+        self.check_events()
+
+    def test_errors(self):
+        self.parser.edit(13, 14, ["   DB,D EGc | BdX g2d | edB AGA | BGE E3 :|\n"])
+        self.parser.edit(8, 9, [])
+        self.parser.edit(0, 0, ["% A tune\n", "\n"])
+        errors = self.parser.get_errors()
+        self.assertEqual([(e.filename, e.lineno, e.colno) for e in errors],
+                         [("brid_harper_s.abc", 15, 16)])
+        self.check_events()
+
+    def test_insert_delete(self):
+        self.parser.edit(10, 10, ["   GEF G2A | Bee dBd |\n"])
+        self.check_events()
+        self.parser.edit(9, 11, [])
+        self.check_events()
+        self.parser.edit(6, 7, [])
+        self.check_events()
+        self.assertEqual([e.what for e in self.parser.get_errors()],
+                         ["Missing time signature (M: field)"])
+
+    def test_invalid_field(self):
+        # Header lines typed character by character, then restored: a
+        # field being typed is a diagnostic, never an exception
+        k = [line[0:2] for line in self.lines].index("M:")
+        line = self.lines[k]
+        for n in range(len(line)):
+            self.parser.edit(k, k + 1, [line[0:n] + "\n"])
+        self.parser.edit(k, k + 1, ["M:6/0\n"])
+        self.assertEqual([(e.lineno, e.colno, e.what) for e in self.parser.get_errors()],
+                         [(k + 1, 2, "Invalid time signature"),
+                          (len(self.lines) + 1, 0, "Missing time signature (M: field)")])
+        self.check_events()
+        self.parser.edit(k, k + 1, [line])
+        self.parser.edit(k + 1, k + 1, ["\n"])
+        for length in "L:1/8":
+            self.parser.edit(k + 1, k + 2, [self.parser.lines[k + 1][:-1] + length + "\n"])
+            if self.parser.lines[k + 1] == "L:1/\n":
+                self.assertEqual([(e.lineno, e.colno, e.what)
+                                  for e in self.parser.get_errors()],
+                                 [(k + 2, 2, "Invalid default note length")])
+                self.check_events()
+        self.parser.edit(k + 1, k + 2, [])
+        self.assertEqual(self.parser.get_errors(), [])
+        self.check_events()
+
+    def test_converge_header(self):
+        # The title is only written to the \header block: only its line is parsed
+        self.assertEqual(self.parser.lines[1][0:2], "T:")
+        self.assertEqual(self.parser.edit(1, 2, ["T:Brid Harper's Jig\n"]), 1)
+        self.check_events()
+
+    def test_no_endl(self):
+        # A header line being typed, without its end of line: "T" alone
+        # is a line of notes
+        line = self.lines[1].rstrip("\n")
+        for n in range(len(line) + 1):
+            self.parser.edit(1, 2, [line[0:n]])
+            if n == 1:
+                self.assertEqual([e.what for e in self.parser.get_errors()],
+                                 ["'T' is not a pitch"])
+            else:
+                self.assertEqual(self.parser.get_errors(), [])
+        self.check_events()
+
+    def test_syntax_error(self):
+        # A syntax error of the line is a diagnostic, a bug of the parser
+        # is an exception
+        def read_line(tc, line):
+            raise AbcSyntaxError("bug", tc.filename, line.rstrip(), tc.lineno, 0)
+        read_line_ = abc4ly.read_line
+        abc4ly.read_line = read_line
+        try:
+            self.parser.edit(9, 10, ["abc\n"])
+        finally:
+            abc4ly.read_line = read_line_
+        self.assertEqual([(e.lineno, e.colno, e.what) for e in self.parser.get_errors()][0],
+                         (10, 0, "bug"))
+        self.parser.edit(9, 10, [self.lines[9]])
+        self.assertEqual(self.parser.get_errors(), [])
+        abc4ly.read_line = lambda tc, line: 1 // 0
+        try:
+            self.assertRaises(ZeroDivisionError, self.parser.edit, 9, 10, ["abc\n"])
+        finally:
+            abc4ly.read_line = read_line_
+
+
+class TestBatch(unittest.TestCase):
+
+    ly_dirname = "regression-out/batch"
+
+    def test_list_abc_files(self):
+        abc_filenames = list_abc_files(["regression", "foo.abc"])
+        self.assertEqual(abc_filenames[0], "regression/brid_harper_s.abc")
+        self.assertEqual(abc_filenames[-1], "foo.abc")
+        self.assertEqual(len(abc_filenames), 20)
+
+    def test_convert_batch(self):
+        abc_filenames = list_abc_files(["regression"])
+        results = list(convert_batch(abc_filenames, self.ly_dirname, jobs=2))
+        self.assertEqual(sorted(result[0] for result in results), abc_filenames)
+
+        errors = dict((abc_filename, error) for (abc_filename, error, elapsed) in results
+                      if error != None)
+        self.assertEqual(sorted(errors.keys()),
+                         ["regression/empty.abc",
+                          "regression/header_no_endl.abc",
+                          "regression/header_with_blank_lines.abc",
+                          "regression/header_with_comments.abc",
+                          "regression/missing_time_signature.abc"])
+        self.assertEqual(errors["regression/missing_time_signature.abc"],
+                         """In "regression/missing_time_signature.abc", line 3, column 0:
+
+^
+Missing time signature (M: field)""")
+
+        for basename in ["hello_world", "hello_chords", "yellow_tinker"]:
+            out = self.ly_dirname + "/" + basename + ".ly"
+            ref = "regression-ref/" + basename + ".ly"
+            self.assertTrue(filecmp.cmp(ref, out),
+                            "Files " + ref + " and " + out + " differ")
+
+    def test_largest_first(self):
+        abc_filenames = ["regression/hello_world.abc", "regression/yellow_tinker.abc",
+                         "regression/c_major.abc"]
+        results = list(convert_batch(abc_filenames, self.ly_dirname, jobs=1))
+        self.assertEqual([result[0] for result in results],
+                         ["regression/yellow_tinker.abc", "regression/hello_world.abc",
+                          "regression/c_major.abc"])
+
+    def test_same_basename(self):
+        for dirname in ["dir1", "dir2"]:
+            os.makedirs(self.ly_dirname + "/" + dirname, exist_ok=True)
+            shutil.copy("regression/hello_world.abc",
+                        self.ly_dirname + "/" + dirname + "/a.abc")
+        abc_filenames = [self.ly_dirname + "/dir1/a.abc", self.ly_dirname + "/dir2/a.abc"]
+        results = list(convert_batch(abc_filenames, self.ly_dirname, jobs=1))
+        errors = dict((abc_filename, error) for (abc_filename, error, elapsed) in results)
+        self.assertEqual(errors[abc_filenames[0]], None)
+        self.assertEqual(errors[abc_filenames[1]],
+                         '"{0}": same output file {1}/a.ly as "{2}"'.format(
+                             abc_filenames[1], self.ly_dirname, abc_filenames[0]))
+        self.assertTrue(filecmp.cmp("regression-ref/hello_world.ly",
+                                    self.ly_dirname + "/a.ly"))
+
+    def test_command_line(self):
+        ret = os.system("./abc4ly.py -j 2 -d {0} regression/c_major.abc "
+                        "regression/hello_ties.abc 2>/dev/null".format(self.ly_dirname))
+        self.assertEqual(0, ret)
+        self.assertTrue(filecmp.cmp("regression-ref/hello_ties.ly",
+                                    self.ly_dirname + "/hello_ties.ly"))
+        ret = os.system("./abc4ly.py -d {0} regression/c_major.abc "
+                        "regression/empty.abc 2>/dev/null".format(self.ly_dirname))
+        self.assertNotEqual(0, ret)
+
+
+class TestWatcher(unittest.TestCase):
+
+    abc_dirname = "regression-out/watch"
+    ly_dirname = "regression-out/watch/ly"
+
+    def setUp(self):
+        shutil.rmtree(self.abc_dirname, ignore_errors=True)
+        os.makedirs(self.ly_dirname)
+        shutil.copy("regression/tunebook.abc", self.abc_dirname)
+        self.watcher = Watcher([self.abc_dirname], self.ly_dirname, split=True, debounce=1.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.abc_dirname, ignore_errors=True)
+
+    def edit(self, old, new):
+        with open(self.abc_dirname + "/tunebook.abc") as abc_file:
+            text = abc_file.read()
+        with open(self.abc_dirname + "/tunebook.abc", "w") as abc_file:
+            abc_file.write(text.replace(old, new))
+
+    def test_debounce(self):
+        self.assertEqual(self.watcher.poll(100.0), [])
+        self.assertEqual(self.watcher.poll(100.5), [])
+        results = self.watcher.poll(101.0)
+        self.assertEqual(results, [(self.ly_dirname + "/tunebook-{0}.ly".format(refnum), None)
+                                   for refnum in "123"])
+        self.assertTrue(filecmp.cmp("regression-ref/yellow_tinker.ly",
+                                    self.ly_dirname + "/tunebook-3.ly"))
+
+        # A burst of saves: converted 1 s after the last one
+        self.edit("T:C Major", "T:C Major scale")
+        self.assertEqual(self.watcher.poll(200.0), [])
+        self.edit("T:C Major scale", "T:The C Major scale")
+        self.assertEqual(self.watcher.poll(200.8), [])
+        self.assertEqual(self.watcher.poll(201.5), [])
+        self.assertEqual(self.watcher.poll(201.8),
+                         [(self.ly_dirname + "/tunebook-2.ly", None)])
+        self.assertEqual(self.watcher.poll(300.0), [])
+
+    def test_errors(self):
+        self.watcher.poll(100.0)
+        self.watcher.poll(101.0)
+        self.edit("K:C\nC2 D2", "K:C\nC2 X2")
+        self.watcher.poll(102.0)
+        results = self.watcher.poll(103.0)
+        self.assertEqual(len(results), 1)
+        self.assertTrue("'X' is not a pitch" in results[0][1])
+        # The previous file is kept
+        with open(self.ly_dirname + "/tunebook-2.ly") as ly_file:
+            self.assertTrue("c'4 d'4" in ly_file.read())
+        self.assertEqual([filename for filename in os.listdir(self.ly_dirname)
+                          if filename.endswith(".tmp")], [])
+
+    def test_broken_files(self):
+        # Nothing stops the watcher: neither an invalid field, nor a failed
+        # write, nor a file that cannot be decoded
+        self.watcher.poll(100.0)
+        self.watcher.poll(101.0)
+        self.edit("T:C Major\n", "T:C Major\nL:1/\n")
+        os.remove(self.ly_dirname + "/tunebook-3.ly")
+        os.mkdir(self.ly_dirname + "/tunebook-3.ly")
+        self.edit("T:Yellow Tinker", "T:Yellow Tinker reel")
+        self.watcher.poll(102.0)
+        results = self.watcher.poll(103.0)
+        self.assertEqual([tune_ly_filename for (tune_ly_filename, error) in results],
+                         [self.ly_dirname + "/tunebook-{0}.ly".format(refnum)
+                          for refnum in "23"])
+        self.assertTrue("Invalid default note length" in results[0][1])
+        self.assertTrue("IsADirectoryError" in results[1][1])
+
+        os.rmdir(self.ly_dirname + "/tunebook-3.ly")
+        with open(self.abc_dirname + "/tunebook.abc", "ab") as abc_file:
+            abc_file.write(b"\nX:4\nT:\xff\xfe\n")
+        self.watcher.poll(104.0)
+        results = self.watcher.poll(105.0)
+        self.assertEqual(len(results), 1)
+        self.assertTrue("UnicodeDecodeError" in results[0][1])
+
+        # A file fixed afterwards is converted again
+        with open(self.abc_dirname + "/tunebook.abc", "w") as abc_file:
+            with open("regression/tunebook.abc") as tunebook:
+                abc_file.write(tunebook.read())
+        self.watcher.poll(106.0)
+        self.assertEqual([error for (tune_ly_filename, error) in self.watcher.poll(107.0)],
+                         [None, None])
+
+
+class TestCache(unittest.TestCase):
+
+    cache_dirname = "regression-out/cache/test"
+
+    def setUp(self):
+        shutil.rmtree(self.cache_dirname, ignore_errors=True)
+        self.cache = ConversionCache(self.cache_dirname)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dirname, ignore_errors=True)
+
+    def test_key(self):
+        key = self.cache.get_key(["X:1\n", "abc|\n"])
+        self.assertEqual(key, self.cache.get_key(["X:1\n", "abc|\n"]))
+        self.assertNotEqual(key, self.cache.get_key(["X:1\n", "abd|\n"]))
+
+    def test_get_put(self):
+        self.assertEqual(None, self.cache.get("0123"))
+        self.cache.put("0123", "{ a' }\n")
+        self.assertEqual("{ a' }\n", self.cache.get("0123"))
+
+    def test_convert(self):
+        abc = "regression/hello_world.abc"
+        ref = "regression-ref/hello_world.ly"
+        out = "regression-out/hello_world.ly"
+        tc = convert(abc, out, cache=self.cache)
+        self.assertEqual(1, len(self.cache.list_entries()))
+        self.assertTrue(filecmp.cmp(ref, out), "Files " + ref + " and " + out + " differ")
+
+        # A hit does not parse the tune
+        read_tune = abc4ly.read_tune
+        def fail(*args):
+            self.fail("read_tune() called on a cache hit")
+        abc4ly.read_tune = fail
+        try:
+            os.remove(out)
+            tc = convert(abc, out, cache=self.cache)
+        finally:
+            abc4ly.read_tune = read_tune
+        self.assertEqual(tc.filename, abc)
+        self.assertTrue(filecmp.cmp(ref, out), "Files " + ref + " and " + out + " differ")
+
+    def test_eviction(self):
+        cache = ConversionCache(self.cache_dirname, max_size=400)
+        for n in range(4):
+            cache.put("{0:04}".format(n), "x" * 100)
+            time.sleep(0.01)
+        self.assertNotEqual(None, cache.get("0000")) # the most recently used
+        time.sleep(0.01)
+        cache.put("0004", "x" * 100)
+        keys = sorted(os.path.basename(path)[:-3]
+                      for (mtime, size, path) in cache.list_entries())
+        self.assertEqual(keys, ["0000", "0003", "0004"])
+
+
+# A minimal Standard MIDI File reader: return the division and the events
+# of the first track, as a list of (time, status, data) with the absolute
+# time in ticks
+
+def read_midi_varlen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7f)
+        if byte & 0x80 == 0:
+            return (value, pos)
+
+def read_midi(data):
+    (chunk, length, format, ntracks, division) = struct.unpack(">4sIHHH", data[:14])
+    assert (chunk, length, format, ntracks) == (b"MThd", 6, 0, 1)
+    (chunk, length) = struct.unpack(">4sI", data[14:22])
+    assert chunk == b"MTrk" and len(data) == 22 + length
+    events = []
+    (pos, time) = (22, 0)
+    while pos < len(data):
+        (delta, pos) = read_midi_varlen(data, pos)
+        time += delta
+        status = data[pos]
+        if status == 0xff:
+            (length, start) = read_midi_varlen(data, pos + 2)
+            events.append((time, (status, data[pos + 1]), data[start:start + length]))
+            pos = start + length
+        else:
+            events.append((time, status, data[pos + 1:pos + 3]))
+            pos += 3
+    return (division, events)
+
+# The notes of a MIDI file: a list of (start, duration, pitch)
+
+def read_midi_notes(data):
+    (division, events) = read_midi(data)
+    (notes, started) = ([], {})
+    for (time, status, payload) in events:
+        if status == 0x90:
+            started[payload[0]] = time
+        elif status == 0x80:
+            start = started.pop(payload[0])
+            notes.append((start, time - start, payload[0]))
+    return sorted(notes)
+
+class TestEngraving(unittest.TestCase):
+
+    dirname = "regression-out/engrave"
+    lilypond = "regression-out/engrave/fake-lilypond"
+
+    # A stand-in for lilypond: "-o OUT FILE.ly" writes OUT.pdf (the text
+    # of the lilypond file) and OUT.midi, logs the run, and fails on
+    # "\error"
+    fake_lilypond = """#!{0}
+import sys, time
+(out, ly_filename) = (sys.argv[2], sys.argv[3])
+with open(ly_filename) as ly_file:
+    text = ly_file.read()
+with open("{1}/runs.log", "a") as log:
+    log.write(ly_filename + "\\n")
+if "\\\\error" in text:
+    print("error: unknown command")
+    sys.exit(1)
+time.sleep(0.05)
+with open(out + ".pdf", "w") as pdf:
+    pdf.write(text)
+with open(out + ".midi", "w") as midi:
+    midi.write("MThd")
+"""
+
+    def setUp(self):
+        shutil.rmtree(self.dirname, ignore_errors=True)
+        os.makedirs(self.dirname)
+        with open(self.lilypond, "w") as script:
+            script.write(self.fake_lilypond.format(sys.executable, self.dirname))
+        os.chmod(self.lilypond, 0o755)
+        self.cache = ArtifactCache(self.dirname + "/cache")
+        for (name, text) in [("a", "\\score { a }\n"), ("b", "\\score { b b }\n"),
+                             ("c", "\\score { c c c }\n")]:
+            self.write(name, text)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname, ignore_errors=True)
+
+    def write(self, name, text):
+        with open("{0}/{1}.ly".format(self.dirname, name), "w") as ly_file:
+            ly_file.write(text)
+
+    def get_runs(self):
+        with open(self.dirname + "/runs.log") as log:
+            return len(log.readlines())
+
+    def engrave(self, names, jobs=2):
+        return list(engrave_batch(["{0}/{1}.ly".format(self.dirname, name) for name in names],
+                                  jobs, self.lilypond, self.cache))
+
+    def test_engrave(self):
+        results = self.engrave("abc")
+        self.assertEqual([(error, cached) for (ly_filename, error, elapsed, cached, queued)
+                          in results], [(None, False)] * 3)
+        with open(self.dirname + "/b.pdf") as pdf:
+            self.assertEqual(pdf.read(), "\\score { b b }\n")
+        self.assertTrue(os.path.exists(self.dirname + "/b.midi"))
+        self.assertEqual(self.get_runs(), 3)
+        self.assertEqual([name for name in os.listdir(self.dirname)
+                          if name.startswith(".engrave-")], [])
+
+    def test_cache(self):
+        self.engrave("abc")
+        os.remove(self.dirname + "/a.pdf")
+        # The lilypond files are written again, only one of them changed
+        self.write("a", "\\score { a }\n")
+        self.write("b", "\\score { b b b }\n")
+        results = dict((os.path.basename(ly_filename), cached)
+                       for (ly_filename, error, elapsed, cached, queued)
+                       in self.engrave("abc"))
+        self.assertEqual(results, {"a.ly":True, "b.ly":False, "c.ly":True})
+        self.assertEqual(self.get_runs(), 4)
+        with open(self.dirname + "/a.pdf") as pdf:
+            self.assertEqual(pdf.read(), "\\score { a }\n")
+
+    def test_no_cache(self):
+        self.cache = None
+        self.engrave("ab")
+        self.engrave("ab")
+        self.assertEqual(self.get_runs(), 4)
+
+    def test_queue_depth(self):
+        results = self.engrave("abc", jobs=1)
+        # The largest file first
+        self.assertEqual([(os.path.basename(ly_filename), queued)
+                          for (ly_filename, error, elapsed, cached, queued) in results],
+                         [("c.ly", 1), ("b.ly", 0), ("a.ly", 0)])
+        self.assertTrue(all(elapsed >= 0.05 for (ly_filename, error, elapsed, cached, queued)
+                            in results))
+
+    def test_error(self):
+        self.write("b", "\\error\n")
+        results = dict((os.path.basename(ly_filename), error)
+                       for (ly_filename, error, elapsed, cached, queued)
+                       in self.engrave("abc"))
+        self.assertEqual(results["a.ly"], None)
+        self.assertTrue(results["b.ly"].startswith('"{0}/b.ly": {1} failed with exit code 1'
+                                                   .format(self.dirname, self.lilypond)))
+        self.assertTrue("error: unknown command" in results["b.ly"])
+        self.assertFalse(os.path.exists(self.dirname + "/b.pdf"))
+        # A failure is not cached
+        self.engrave("b")
+        self.assertEqual(self.get_runs(), 4)
+
+    def test_eviction(self):
+        self.cache.max_size = 40
+        # Each entry: the text of the lilypond file and "MThd" (21, 19 and
+        # 17 bytes), put from the largest file: down to 30 bytes, the
+        # last one is left
+        self.engrave("abc", jobs=1)
+        self.assertEqual([size for (mtime, size, path) in self.cache.list_entries()], [17])
+
+    def test_command_line(self):
+        out = self.dirname + "/tunebook.ly"
+        cmd = "./abc4ly.py -e -s --lilypond {0} --cache-dir {1}/cache -o {2} " \
+              "regression/tunebook.abc 2>/dev/null"
+        self.assertEqual(0, os.system(cmd.format(self.lilypond, self.dirname, out)))
+        for refnum in "123":
+            self.assertTrue(os.path.exists("{0}/tunebook-{1}.pdf".format(self.dirname,
+                                                                         refnum)))
+        self.assertEqual(self.get_runs(), 3)
+        self.assertEqual(0, os.system(cmd.format(self.lilypond, self.dirname, out)))
+        self.assertEqual(self.get_runs(), 3)
+
+
+class TestMidi(unittest.TestCase):
+
+    quarter = mc_midi_division
+
+    def get_notes(self, abc_filename):
+        with open(abc_filename) as abc_file:
+            tc = read_tune(abc_file, abc_filename, sink=NullSink())
+        midi_file = io.BytesIO()
+        write_midi(tc, midi_file)
+        return read_midi_notes(midi_file.getvalue())
+
+    def get_melody(self, notes):
+        return [(duration, pitch) for (start, duration, pitch) in notes]
+
+    def test_varlen(self):
+        for value in [0, 0x7f, 0x80, 0x2000, 0x3fff, 0x4000, 0x0fffffff]:
+            self.assertEqual(read_midi_varlen(get_midi_varlen(value), 0),
+                             (value, len(get_midi_varlen(value))))
+        self.assertEqual(get_midi_varlen(0x80), b"\x81\x00")
+
+    def test_header(self):
+        with open("regression/hello_world.abc") as abc_file:
+            tc = read_tune(abc_file, sink=NullSink())
+        midi_file = io.BytesIO()
+        write_midi(tc, midi_file)
+        (division, events) = read_midi(midi_file.getvalue())
+        self.assertEqual(division, 384)
+        self.assertEqual(events[0], (0, (0xff, 0x03), b"Hello, world!"))
+        self.assertEqual(events[1], (0, (0xff, 0x51), b"\x07\xa1\x20"))
+        self.assertEqual(events[2], (0, (0xff, 0x58), b"\x04\x02\x18\x08"))
+        self.assertEqual(events[-1], (4 * self.quarter, (0xff, 0x2f), b""))
+
+    def test_notes(self):
+        q = self.quarter
+        self.assertEqual(self.get_notes("regression/hello_world.abc"),
+                         [(0, q, 57), (q, q, 59), (2 * q, q, 60), (3 * q, q, 62)])
+
+    def test_repeats(self):
+        q = self.quarter
+        melody = self.get_melody(self.get_notes("regression/hello_repeated_with_alternative.abc"))
+        self.assertEqual(melody, [(q, pitch) for pitch in [60, 62, 64, 65, 67, 69, 71, 72,
+                                                           60, 62, 64, 65, 67, 64, 62, 60]])
+        melody = self.get_melody(self.get_notes("regression/hello_repeated.abc"))
+        self.assertEqual(len(melody), 8)
+        self.assertEqual(melody[:4], melody[4:])
+
+    def test_ties(self):
+        q = self.quarter
+        self.assertEqual(self.get_notes("regression/hello_ties.abc"),
+                         [(0, 3 * q, 60), (3 * q, 3 * q, 62), (6 * q, 2 * q, 64)])
+
+    def test_triplets(self):
+        q = self.quarter
+        self.assertEqual(self.get_notes("regression/hello_triplets.abc"),
+                         [(0, q // 3, 60), (q // 3, q // 3, 62), (2 * q // 3, q // 3, 64),
+                          (q, q, 65), (2 * q, q, 67), (3 * q, q, 69)])
+
+    def test_convert(self):
+        self.assertNotEqual(None, convert("regression/tunebook.abc", "regression-out/tunebook",
+                                          split=True, midi=True))
+        for refnum in ["1", "2", "3"]:
+            out = "regression-out/tunebook-{0}.mid".format(refnum)
+            with open(out, "rb") as midi_file:
+                self.assertTrue(len(read_midi_notes(midi_file.read())) > 0)
+
+    def test_command_line(self):
+        out = "regression-out/hello_world.mid"
+        ret = os.system("./abc4ly.py -m -o {0} regression/hello_world.abc".format(out))
+        self.assertEqual(0, ret)
+        with open(out, "rb") as midi_file:
+            self.assertEqual(self.get_notes("regression/hello_world.abc"),
+                             read_midi_notes(midi_file.read()))
+
+
+class TestSyntheticTunebook(unittest.TestCase):
+
+    def test_reproducible(self):
+        import benchabc4ly
+        text = benchabc4ly.generate_tunebook(tunes=5)
+        self.assertEqual(text, benchabc4ly.generate_tunebook(tunes=5))
+        self.assertNotEqual(text, benchabc4ly.generate_tunebook(tunes=5, seed=1))
+
+    def test_valid(self):
+        # All the generated tunes are converted, whatever the densities
+        import benchabc4ly
+        text = benchabc4ly.generate_tunebook(tunes=20, lines=5, repeats=1.0, chords=1.0,
+                                             triplets=0.5, keys=1.0)
+        self.assertTrue("|1 " in text and "(3" in text and '"' in text)
+        (tunes, nnotes) = benchabc4ly.read_corpus(text)
+        self.assertEqual(len(tunes), 20)
+        self.assertTrue(nnotes > 20 * 5 * 4 * 8)
+        self.assertEqual(sum(1 for line in text.splitlines() if line.startswith("K:")),
+                         20 * 3)
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_profile(self):
+        translate_notes = abc4ly.translate_notes
+        token_regex = abc4ly.mc_token_regex
+        state = TuneContext.__dict__["state"]
+        with TuneProfiler() as profiler:
+            tc = convert("regression/yellow_tinker.abc", "regression-out/yellow_tinker.ly")
+        self.assertTrue(filecmp.cmp("regression-ref/yellow_tinker.ly",
+                                    "regression-out/yellow_tinker.ly"))
+
+        nlines = list(tc.events.kinds).count(mc_event_line)
+        self.assertEqual(profiler.helper_counts["flush_line"], nlines)
+        self.assertEqual(profiler.helper_counts["emit_line"], nlines)
+        self.assertTrue(profiler.helper_counts["mc_token_regex.match"] > nlines)
+        self.assertEqual(profiler.helper_counts["translate_key_signature"], 1)
+        # Every profiled helper runs during a conversion
+        self.assertEqual(sorted(name for (class_name, name) in mc_profiled_helpers
+                                if not name in profiler.helper_counts), [])
+        self.assertTrue(profiler.state_counts["pitch"] > 0)
+        self.assertTrue(profiler.state_times["pitch"] > 0)
+        self.assertEqual([(tune[0], tune[1], tune[4]) for tune in profiler.tunes],
+                         [("regression/yellow_tinker.abc", "1", len(tc.events))])
+
+        # Nothing is instrumented once the profiler is stopped
+        self.assertTrue(abc4ly.translate_notes is translate_notes)
+        self.assertTrue(abc4ly.mc_token_regex is token_regex)
+        self.assertTrue(TuneContext.__dict__["state"] is state)
+        abc4ly.read_tune(["X:1\n", "M:C\n", "K:C\n", "abc|\n"])
+        self.assertEqual(len(profiler.tunes), 1)
+
+    def test_one_profiler(self):
+        with TuneProfiler():
+            self.assertRaises(RuntimeError, TuneProfiler().start)
+
+    def test_dump(self):
+        with TuneProfiler() as profiler:
+            abc4ly.read_tune(["X:1\n", "M:C\n", "K:C\n", "abc|\n"])
+        profiler.dump_stats("regression-out/profile.prof")
+        stats = pstats.Stats("regression-out/profile.prof")
+        # One transition into "pitch" per note
+        self.assertEqual(stats.stats[("abc4ly.py", 0, "state:pitch")][0], 3)
+        profiler.dump_json("regression-out/profile.json")
+        with open("regression-out/profile.json") as json_file:
+            report = json.load(json_file)
+        self.assertEqual(report["helpers"]["flush_line"]["count"], 1)
+        self.assertEqual(len(report["tunes"]), 1)
+
+    def test_command_line(self):
+        out = "regression-out/profile.json"
+        ret = os.system("./abc4ly.py --profile-output {0} -o regression-out/hello_world.ly "
+                        "regression/hello_world.abc 2>/dev/null".format(out))
+        self.assertEqual(0, ret)
+        with open(out) as json_file:
+            self.assertEqual(json.load(json_file)["states"]["pitch"]["count"], 4)
+
+
+class TestRegressionRunner(unittest.TestCase):
+
+    ref_dirname = "regression-out/ref"
+
+    def setUp(self):
+        shutil.rmtree(self.ref_dirname, ignore_errors=True)
+        os.makedirs(self.ref_dirname)
+
+    def tearDown(self):
+        shutil.rmtree(self.ref_dirname, ignore_errors=True)
+
+    def test_list_cases(self):
+        import regressabc4ly
+        cases = regressabc4ly.list_cases("regression", "regression-ref")
+        self.assertEqual(len(cases), 13)
+        self.assertFalse("empty" in cases)
+        self.assertEqual(regressabc4ly.list_cases("regression", "regression-ref",
+                                                  ["c_major", "foo"]), ["c_major"])
+
+    def test_run_cases(self):
+        import regressabc4ly
+        shutil.copy("regression-ref/c_major.ly", self.ref_dirname)
+        with open("regression-ref/hello_world.ly") as ref:
+            text = ref.read()
+        with open(self.ref_dirname + "/hello_world.ly", "w") as ref:
+            ref.write(text.replace("a4", "a2"))
+        results = regressabc4ly.run_cases(["c_major", "hello_world"], "regression",
+                                          self.ref_dirname, "regression-out/batch", jobs=2)
+        self.assertEqual(results["c_major"][0:2], (None, ""))
+        (error, diff, elapsed) = results["hello_world"]
+        self.assertEqual(error, None)
+        self.assertTrue("\n-" in diff and "\n+" in diff)
+
+        out = io.StringIO()
+        self.assertEqual(regressabc4ly.report(results, {}, 2.0, 0.0, file=out),
+                         regressabc4ly.mc_exit_failed)
+        self.assertTrue(out.getvalue().startswith("FAIL hello_world"))
+
+    def test_slower(self):
+        import regressabc4ly
+        self.assertFalse(regressabc4ly.is_slower(0.010, [], 2.0, 0.001))
+        self.assertFalse(regressabc4ly.is_slower(0.010, [0.006, 0.004, 0.100], 2.0, 0.001))
+        self.assertTrue(regressabc4ly.is_slower(0.010, [0.004, 0.004, 0.100], 2.0, 0.001))
+        self.assertFalse(regressabc4ly.is_slower(0.010, [0.004], 2.0, 0.010))
+        results = {"c_major":(None, "", 0.010)}
+        self.assertEqual(regressabc4ly.report(results, {"c_major":[0.001]}, 2.0, 0.0,
+                                              file=io.StringIO()),
+                         regressabc4ly.mc_exit_slower)
+        history = regressabc4ly.update_history({"c_major":[0.001] * 10}, results)
+        self.assertEqual(history["c_major"], [0.001] * 9 + [0.010])
+
+
 class TestCommandLineOptions(unittest.TestCase):
 
     def test_no_option(self):